@@ -27,6 +27,11 @@ build_docs() {
 }
 
 
+run_tests() {
+    make check
+}
+
+
 generate_html_report() {
     cat  >exported-artifacts/index.html <<EOR
     <html>
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""
+Circuit breaker
+================
+
+Keeps track of the failures of the calls to an external service (bugzilla,
+gerrit...), shared between all the hook processes through a small sqlite
+database, so when the service is down the hooks give up right away instead of
+each of them waiting for its own timeouts.
+
+The circuit of each service can be:
+
+* closed: the calls go through, the consecutive failures are counted
+* open: after `threshold` consecutive failures, the calls raise
+  :class:`CircuitOpen` without trying
+* half open: `reset_timeout` seconds after opening, one call is let through
+  as a trial, if it succeeds the circuit is closed again, if not it's kept
+  open
+
+In long running processes (the dispatcher daemon, that sets
+:data:`BACKGROUND_PROBES`), while the circuit is open a background thread
+probes the service from time to time, and closes the circuit as soon as it
+answers. The short lived hook processes would exit before the first probe,
+so they rely only on the trial calls.
+
+API
+====
+"""
+import os
+import math
+import time
+import sqlite3
+import logging
+import threading
+import cache
+
+
+logger = logging.getLogger(__name__)
+
+BREAKERS_DB = 'breakers.db'
+DEFAULT_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 60
+# Seconds between the background probes while the circuit is open
+PROBE_INTERVAL = 10
+# Only the long running processes probe in the background, see start_prober
+BACKGROUND_PROBES = False
+# Seconds to wait for other processes to release the database
+DB_TIMEOUT = 10
+# (database path, name) -> breaker, see get_breaker
+BREAKERS = {}
+BREAKERS_LOCK = threading.Lock()
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS breakers ('
+    ' name TEXT PRIMARY KEY, failures INTEGER, opened_at REAL,'
+    ' trial_at REAL)'
+)
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling a service that is known to be down
+    """
+    def __init__(self, name, retry_in):
+        """
+        :param name: name of the service
+        :param retry_in: seconds until a new call will be tried
+        """
+        super(CircuitOpen, self).__init__(
+            '%s is unavailable, skipped (will retry in %ds)'
+            % (name, max(math.ceil(retry_in), 0))
+        )
+        self.name = name
+        self.retry_in = retry_in
+
+
+def get_breaker(conf, name, failures=(Exception,)):
+    """
+    Get the circuit breaker for the given service from the configuration,
+    shared by the whole process
+
+    It's enabled by default, HOOKS_BREAKER_THRESHOLD sets the number of
+    consecutive failures that open the circuit (0 disables it), and
+    HOOKS_BREAKER_RESET the seconds before trying again.
+
+    :param conf: configuration dict
+    :param name: name of the service, like 'bugzilla:url'
+    :param failures: exceptions that count as failures of the service
+    :returns: the breaker, or None if it's disabled
+    """
+    threshold = conf.get('HOOKS_BREAKER_THRESHOLD')
+    if threshold in (None, ''):
+        threshold = DEFAULT_THRESHOLD
+    threshold = int(threshold)
+    if threshold <= 0:
+        return None
+    reset_timeout = int(
+        conf.get('HOOKS_BREAKER_RESET') or DEFAULT_RESET_TIMEOUT
+    )
+    try:
+        path = os.path.join(cache.get_cache_dir(conf), BREAKERS_DB)
+    except OSError as exc:
+        logger.warning('Unable to create the circuit breaker: %s' % exc)
+        return None
+    with BREAKERS_LOCK:
+        breaker = BREAKERS.get((path, name))
+        if breaker is None:
+            breaker = BREAKERS[(path, name)] = CircuitBreaker(
+                name=name,
+                path=path,
+                threshold=threshold,
+                reset_timeout=reset_timeout,
+                failures=failures,
+            )
+    return breaker
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker with the state shared between processes
+    """
+    def __init__(self, name, path, threshold=DEFAULT_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT, failures=(Exception,),
+                 probe=None):
+        """
+        :param name: name of the service
+        :param path: path to the sqlite database with the state
+        :param threshold: consecutive failures that open the circuit
+        :param reset_timeout: seconds to wait before letting a trial call
+            through an open circuit
+        :param failures: exceptions that count as failures of the service
+        :param probe: function that checks if the service is back, returning
+            True if it is, used by the background prober
+        """
+        self.name = name
+        self.path = path
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = failures
+        self.probe = probe
+        self.prober = None
+        self.prober_lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def conn(self):
+        """
+        Database connection for the current thread
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path, timeout=DB_TIMEOUT, isolation_level=None,
+            )
+            conn.execute(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def before_call(self):
+        """
+        Check if a call can be done
+
+        The state is read without locking the database, only the transition
+        to half open takes the write lock, to claim the trial call.
+
+        :raises CircuitOpen: if the service is down
+        """
+        now = time.time()
+        # if the circuit is closed with no failures, a success changes
+        # nothing, see record_success
+        self.local.clean = False
+        try:
+            row = self.conn.execute(
+                'SELECT failures, opened_at, trial_at FROM breakers '
+                'WHERE name = ?',
+                (self.name,),
+            ).fetchone()
+        except sqlite3.Error as exc:
+            # a broken breaker should never block the calls
+            logger.warning('Circuit breaker failure: %s' % exc)
+            return
+        failures, opened_at, trial_at = row or (0, None, None)
+        if opened_at is None:
+            self.local.clean = not failures
+            return
+        retry_at = max(opened_at, trial_at or 0) + self.reset_timeout
+        if now < retry_at:
+            self.start_prober()
+            raise CircuitOpen(self.name, retry_at - now)
+        # half open, only the process that updates the trial time first gets
+        # to do the trial call
+        try:
+            claimed = self.conn.execute(
+                'UPDATE breakers SET trial_at = ? WHERE name = ? '
+                'AND opened_at = ? AND trial_at IS ?',
+                (now, self.name, opened_at, trial_at),
+            ).rowcount
+        except sqlite3.Error as exc:
+            logger.warning('Circuit breaker failure: %s' % exc)
+            return
+        if not claimed:
+            self.start_prober()
+            raise CircuitOpen(self.name, self.reset_timeout)
+        logger.info('Trying %s again' % self.name)
+
+    def record_success(self):
+        """
+        Close the circuit, if it was not already, skipped if it was closed
+        with no failures on the last before_call of this thread
+        """
+        if getattr(self.local, 'clean', False):
+            return
+        cache.safe_call(
+            lambda: self.conn.execute(
+                'UPDATE breakers SET failures = 0, opened_at = NULL, '
+                'trial_at = NULL WHERE name = ? '
+                'AND (failures > 0 OR opened_at IS NOT NULL)',
+                (self.name,),
+            )
+        )
+
+    def record_failure(self):
+        """
+        Count a failure, opening the circuit if there are too many
+        """
+        self.local.clean = False
+        cache.safe_call(self._record_failure)
+
+    def _record_failure(self):
+        now = time.time()
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT OR IGNORE INTO breakers VALUES (?, 0, NULL, NULL)',
+                (self.name,),
+            )
+            conn.execute(
+                'UPDATE breakers SET failures = failures + 1 '
+                'WHERE name = ?',
+                (self.name,),
+            )
+            failures, opened_at = conn.execute(
+                'SELECT failures, opened_at FROM breakers WHERE name = ?',
+                (self.name,),
+            ).fetchone()
+            if failures >= self.threshold:
+                # (re)open it, also after a failed trial
+                conn.execute(
+                    'UPDATE breakers SET opened_at = ?, trial_at = NULL '
+                    'WHERE name = ?',
+                    (now, self.name),
+                )
+                if opened_at is None:
+                    logger.warning(
+                        '%s failed %d times in a row, skipping it for %ds'
+                        % (self.name, failures, self.reset_timeout)
+                    )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def is_open(self):
+        """
+        Check if the circuit is open (or half open)
+        """
+        row = cache.safe_call(
+            lambda: self.conn.execute(
+                'SELECT opened_at FROM breakers WHERE name = ?',
+                (self.name,),
+            ).fetchone()
+        )
+        return bool(row and row[0] is not None)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func through the breaker
+
+        :raises CircuitOpen: if the service is down
+        """
+        self.before_call()
+        try:
+            res = func(*args, **kwargs)
+        except self.failures:
+            self.record_failure()
+            raise
+        self.record_success()
+        return res
+
+    def start_prober(self):
+        """
+        Start the background prober, if there's a probe, it's not already
+        running and the process is a long running one (BACKGROUND_PROBES)
+        """
+        if self.probe is None or not BACKGROUND_PROBES:
+            return
+        with self.prober_lock:
+            if self.prober is not None and self.prober.is_alive():
+                return
+            self.prober = threading.Thread(target=self.run_prober)
+            self.prober.daemon = True
+            self.prober.start()
+
+    def run_prober(self):
+        while True:
+            time.sleep(PROBE_INTERVAL)
+            if not self.is_open():
+                # closed by someone else
+                return
+            try:
+                if self.probe():
+                    logger.info('%s is back' % self.name)
+                    self.record_success()
+                    return
+            except Exception as exc:
+                logger.debug('Probe of %s failed: %s' % (self.name, exc))
@@ -1,16 +1,214 @@
 #!/usr/bin/env python
 import xmlrpclib
+import httplib
 import re
 import logging
 import argparse
 import json
 import sys
+import threading
+import urlparse
+import os
+import hashlib
+import tempfile
+import socket
+import urllib
+import time
+import Queue
+import errno
+import cache
+import retry
+from footers import get_footers, get_bug_id
+
+# Name of the bugs cache, see get_bug_cache
+BUG_CACHE_NAMESPACE = 'bugzilla-bugs'
+# Max seconds to cache the non existing and private bugs, as those are
+# usually typos that get fixed soon
+NEGATIVE_TTL = 30
+# Bug.get fault codes for non existing (101) and private (102) bugs
+NEGATIVE_FAULT_CODES = (101, 102)
+# Bug fields needed to build the full Bug objects, the default fields to get
+BUG_FIELDS = (
+    'id', 'product', 'summary', 'status', 'flags', 'target_release',
+    'target_milestone', 'classification', 'component', 'external_bugs',
+)
+# Bug fields needed to update the external trackers
+EXTERNAL_BUG_FIELDS = ('id', 'product', 'external_bugs')
+# Fields that Bug.get only returns when asked for in extra_fields
+EXTRA_BUG_FIELDS = ('flags', 'external_bugs')
+
+# Default seconds to wait for the bugzilla server to accept the connection
+# and to answer
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+# Faults returned when the login token is not valid anymore:
+# 410 -> login required, 32000 -> generic error, with 'token' in the message
+TOKEN_FAULT_CODES = (410, 32000)
+# (scheme, connect timeout, read timeout) -> transport, see get_transport
+TRANSPORTS = {}
+TRANSPORTS_LOCK = threading.Lock()
+# Default max number of concurrent requests to the same bugzilla
+DEFAULT_MAX_CONCURRENCY = 4
+# Calls slower than this (in seconds) make the concurrency limit back off
+SLOW_CALL = 5
+# url -> concurrency limiter, see get_limiter
+LIMITERS = {}
+# Threads to run the concurrent requests of map in, kept alive for the whole
+# process so their keep alive connections are reused by the next calls
+MAP_POOL = retry.WorkerPool()
+# Max number of bugs to ask for in each Bug.get request
+BUG_GET_CHUNK_SIZE = 50
+# Separator of the method and parameters of the text batch requests, and the
+# line that ends each response, followed by the return code, see run_batch
+BATCH_SEPARATOR = '\x1f'
+BATCH_END = '__BZ_END__'
+# Errors that mean bugzilla is unreachable, for the circuit breaker
+BZ_FAILURES = (socket.error, httplib.HTTPException, xmlrpclib.ProtocolError)
+# XML-RPC methods that don't change anything, those can be retried and hedged
+READ_METHODS = ('Bug.get', 'Bug.search', 'Bug.comments', 'Bugzilla.version')
+
+
+def get_bug_cache(conf):
+    """
+    Get the shared bugs cache from the configuration
+
+    It's enabled by setting BZ_CACHE_TTL to the number of seconds to keep the
+    bugs, BZ_CACHE_SIZE sets the max number of cached bugs.
+
+    :param conf: configuration dict
+    :returns: the cache, or None if it's disabled
+    """
+    ttl = int(conf.get('BZ_CACHE_TTL') or 0)
+    if ttl <= 0:
+        return None
+    return cache.get_cache(
+        conf,
+        namespace=BUG_CACHE_NAMESPACE,
+        ttl=ttl,
+        max_entries=int(
+            conf.get('BZ_CACHE_SIZE') or cache.DEFAULT_MAX_ENTRIES
+        ),
+    )
+
+
+def get_token_dir(conf):
+    """
+    Get the directory to share the login tokens in, see
+    :func:`cache.get_cache_dir`
+
+    :param conf: configuration dict
+    :returns: the directory, or None if it can't be created, then the tokens
+        are not shared
+    """
+    try:
+        return cache.get_cache_dir(conf)
+    except OSError as exc:
+        logging.warning("Unable to create the tokens dir: %s" % exc)
+        return None
 
 
 class WrongProduct(Exception):
     pass
 
 
+class TimeoutHTTPConnection(httplib.HTTPConnection):
+    """
+    HTTP connection with different timeouts for connecting and for reading
+    the responses
+    """
+    def __init__(self, host, read_timeout=None, **kwargs):
+        httplib.HTTPConnection.__init__(self, host, **kwargs)
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock.settimeout(self.read_timeout)
+
+
+class TimeoutHTTPSConnection(httplib.HTTPSConnection):
+    """
+    HTTPS connection with different timeouts for connecting and for reading
+    the responses
+    """
+    def __init__(self, host, read_timeout=None, **kwargs):
+        httplib.HTTPSConnection.__init__(self, host, **kwargs)
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        httplib.HTTPSConnection.connect(self)
+        self.sock.settimeout(self.read_timeout)
+
+
+class KeepAliveTransport(xmlrpclib.Transport, object):
+    """
+    XML-RPC transport that keeps the HTTP/1.1 connection open between calls,
+    so only the first one pays for the TCP and TLS handshakes.
+
+    Each thread gets its own connection, so the same transport can be shared
+    by all the Bugzilla objects of the process (see get_transport), and the
+    concurrent requests run in long lived threads (see MAP_POOL) to reuse
+    theirs. A connection closed by the server while idle is reopened
+    transparently by the xmlrpclib retry logic.
+    """
+    def __init__(self, https=True, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT):
+        """
+        :param https: if True, connect with https, http otherwise
+        :param connect_timeout: seconds to wait for the connection
+        :param read_timeout: seconds to wait for each response
+        """
+        self.local = threading.local()
+        xmlrpclib.Transport.__init__(self)
+        self.https = https
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    @property
+    def _connection(self):
+        return getattr(self.local, 'connection', (None, None))
+
+    @_connection.setter
+    def _connection(self, value):
+        self.local.connection = value
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        conn_class = TimeoutHTTPConnection
+        if self.https:
+            conn_class = TimeoutHTTPSConnection
+        self._connection = host, conn_class(
+            chost,
+            timeout=self.connect_timeout,
+            read_timeout=self.read_timeout,
+            **(x509 or {})
+        )
+        return self._connection[1]
+
+
+def get_transport(url, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                  read_timeout=DEFAULT_READ_TIMEOUT):
+    """
+    Get the keep alive transport for the given url, shared by the whole
+    process
+
+    :param url: url of the xmlrpc api
+    :param connect_timeout: seconds to wait for the connection
+    :param read_timeout: seconds to wait for each response
+    """
+    https = urlparse.urlparse(url).scheme == 'https'
+    key = (https, connect_timeout, read_timeout)
+    with TRANSPORTS_LOCK:
+        if key not in TRANSPORTS:
+            TRANSPORTS[key] = KeepAliveTransport(
+                https=https,
+                connect_timeout=connect_timeout,
+                read_timeout=read_timeout,
+            )
+    return TRANSPORTS[key]
+
+
 class Bug(object):
     """
     Bug structure
@@ -32,29 +230,391 @@ class Bug(object):
         self.external_bugs = external_bugs
 
 
+class AIMDLimiter(object):
+    """
+    Concurrency limit that adapts to how the server is doing, with additive
+    increase and multiplicative decrease: each fast successful call raises
+    the limit a bit (about one more slot per round of calls), up to the max,
+    and each failed or slow call halves it.
+    """
+    def __init__(self, max_limit=DEFAULT_MAX_CONCURRENCY, min_limit=1,
+                 slow_call=SLOW_CALL):
+        """
+        :param max_limit: max number of concurrent calls
+        :param min_limit: min number of concurrent calls
+        :param slow_call: seconds above which a call is considered slow
+        """
+        self.max_limit = max(max_limit, min_limit)
+        self.min_limit = min_limit
+        self.slow_call = slow_call
+        self.limit = float(self.max_limit)
+        self.running = 0
+        self.cond = threading.Condition()
+        self.local = threading.local()
+
+    def is_holding(self):
+        """
+        If the current thread is already running a call
+        """
+        return getattr(self.local, 'holding', False)
+
+    def acquire(self):
+        with self.cond:
+            while self.running >= int(self.limit):
+                self.cond.wait()
+            self.running += 1
+
+    def release(self, latency, failed=False):
+        """
+        :param latency: seconds the call took
+        :param failed: if the call failed
+        """
+        with self.cond:
+            self.running -= 1
+            if failed or latency > self.slow_call:
+                self.limit = max(self.min_limit, self.limit / 2)
+                logging.debug("Backing off bugzilla concurrency to %d"
+                              % int(self.limit))
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func when there's a free slot, and account for its result. The
+        calls nested inside func use the same slot.
+        """
+        if self.is_holding():
+            return func(*args, **kwargs)
+        self.acquire()
+        self.local.holding = True
+        start = time.time()
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except (xmlrpclib.Fault, xmlrpclib.ProtocolError, IOError):
+            failed = True
+            raise
+        finally:
+            self.local.holding = False
+            self.release(time.time() - start, failed)
+
+
+def get_limiter(url, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """
+    Get the concurrency limiter for the given url, shared by the whole
+    process
+
+    :param url: url of the xmlrpc api
+    :param max_concurrency: max number of concurrent requests
+    """
+    with TRANSPORTS_LOCK:
+        limiter = LIMITERS.get(url)
+        if limiter is None or limiter.max_limit != max_concurrency:
+            limiter = LIMITERS[url] = AIMDLimiter(max_limit=max_concurrency)
+    return limiter
+
+
 class Bugzilla(object):
     """
     Bugzilla Object
+
+    If a cache is passed, the bugs are shared through it with the other
+    hooks, including the non existing or private ones (for a shorter time),
+    and only one process at a time fetches the same bug. The bugs are
+    removed from the cache when they are updated through this object.
     """
 
     def __init__(
         self, user=None, passwd=None,
-        url='https://bugzilla.redhat.com/xmlrpc.cgi'
+        url='https://bugzilla.redhat.com/xmlrpc.cgi', cache=None,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        read_timeout=DEFAULT_READ_TIMEOUT,
+        api_key=None, token_dir=None,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY, breaker=None, policy=None,
     ):
-        self.rpc = xmlrpclib.ServerProxy(url)
+        """
+        :param user: user to log into bugzilla
+        :param passwd: password for the user
+        :param url: url of the bugzilla xmlrpc api
+        :param cache: :class:`cache.DiskCache` for the bugs
+        :param connect_timeout: seconds to wait for the server connection
+        :param read_timeout: seconds to wait for each server response
+        :param api_key: bugzilla api key, used instead of the user and
+            password if passed
+        :param token_dir: directory to keep the login tokens in, to share them
+            with other processes, if not passed they are kept in memory only
+        :param max_concurrency: max number of requests to run at the same
+            time, see map
+        :param breaker: :class:`breaker.CircuitBreaker` to stop calling
+            bugzilla while it's unreachable, it should count BZ_FAILURES
+            as failures
+        :param policy: :class:`retry.RetryPolicy` for the calls, the reads
+            (READ_METHODS and the REST ones) are retried on any transient
+            error and hedged, the writes only if the connection was refused
+        """
+        self.transport = get_transport(
+            url,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+        )
+        self.rpc = xmlrpclib.ServerProxy(url, transport=self.transport)
         self.user = user
         self.passwd = passwd
         self.url = url
+        self.cache = cache
+        self.api_key = api_key
+        self.token_dir = token_dir
+        self.token = None
+        self.token_disabled = False
+        self.token_lock = threading.Lock()
+        self.limiter = get_limiter(url, max_concurrency)
+        self.breaker = breaker
+        if breaker is not None and breaker.probe is None:
+            breaker.probe = self.probe
+        self.policy = policy
+        if policy is not None:
+            policy.transient = policy.transient or self.is_transient
+            policy.rejected = policy.rejected or self.is_rejected
+
+    def guarded(self, func, *args):
+        """
+        Call func through the circuit breaker, if any
+
+        :raises breaker.CircuitOpen: if bugzilla is known to be unreachable
+        """
+        if self.breaker is None:
+            return func(*args)
+        return self.breaker.call(func, *args)
+
+    def remote(self, operation, read, func, *args):
+        """
+        Call func through the retry policy, if any, and the circuit breaker
+
+        :param operation: name of the call, for the latency stats
+        :param read: True if the call does not change anything
+        :param func: function to call
+        :param args: arguments for the function
+        """
+        if self.policy is None:
+            return self.guarded(func, *args)
+        if read:
+            return self.policy.read(operation, self.guarded, func, *args)
+        return self.policy.write(operation, self.guarded, func, *args)
+
+    @staticmethod
+    def is_transient(exc):
+        """
+        Check if a failed read is worth retrying
+        """
+        if isinstance(exc, xmlrpclib.ProtocolError):
+            return exc.errcode >= 500
+        return isinstance(exc, BZ_FAILURES)
+
+    @staticmethod
+    def is_rejected(exc):
+        """
+        Check if a failed write surely did not reach bugzilla
+        """
+        return (
+            isinstance(exc, socket.error)
+            and exc.errno == errno.ECONNREFUSED
+        )
+
+    def probe(self):
+        """
+        Check if bugzilla answers, for the circuit breaker
+
+        :returns bool: True if it does
+        """
+        try:
+            self.rpc.Bugzilla.version()
+        except xmlrpclib.Fault:
+            pass
+        except BZ_FAILURES:
+            return False
+        return True
 
     def wrap(self, dictionary):
-        if self.user:
-            dictionary['Bugzilla_login'] = self.user
-        if self.passwd:
-            dictionary['Bugzilla_password'] = self.passwd
+        """
+        Add the authentication parameters to the given request parameters,
+        the api key if any, or a login token if it was possible to get one,
+        or the user and password otherwise
+        """
+        token = None if self.api_key else self.get_token()
+        if self.api_key:
+            dictionary['Bugzilla_api_key'] = self.api_key
+        elif token:
+            dictionary['Bugzilla_token'] = token
+        else:
+            if self.user:
+                dictionary['Bugzilla_login'] = self.user
+            if self.passwd:
+                dictionary['Bugzilla_password'] = self.passwd
         if self.url:
             dictionary['Bugzilla_url'] = self.url
         return dictionary
 
+    def call(self, method, params):
+        """
+        Call a method of the xmlrpc api, logging in again if the login token
+        expired
+
+        :param method: name of the method, like 'Bug.get'
+        :param params: dict with the method parameters, without the
+            authentication ones
+        :returns: the method response
+        :raises breaker.CircuitOpen: if bugzilla is known to be unreachable
+        """
+        return self.remote(
+            method, method in READ_METHODS, self.do_call, method, params,
+        )
+
+    def do_call(self, method, params):
+        func = self.rpc
+        for attr in method.split('.'):
+            func = getattr(func, attr)
+        try:
+            return func(self.wrap(dict(params)))
+        except xmlrpclib.Fault as fault:
+            if not self.token or not self.is_token_fault(fault):
+                raise
+            logging.info("Bugzilla login token expired, logging in again")
+            self.drop_token()
+            return func(self.wrap(dict(params)))
+
+    def map(self, func, items):
+        """
+        Call func for each of the items concurrently, with at most as many
+        calls running at the same time as the adaptive limiter allows (see
+        :class:`AIMDLimiter`), in the threads of MAP_POOL
+
+        :param func: function to call with each item
+        :param items: list of items
+        :returns list: tuple of (result, exception) for each item, in the
+            same order as the items, the exception is None if it succeeded
+        """
+        items = list(items)
+        results = [None] * len(items)
+        if len(items) == 1 or self.limiter.is_holding():
+            # nested calls run in the slot of the calling thread
+            workers = 0
+        else:
+            workers = min(len(items), self.limiter.max_limit)
+        pending = Queue.Queue()
+        for index, item in enumerate(items):
+            pending.put((index, item))
+        finished = threading.Semaphore(0)
+
+        def worker():
+            try:
+                while True:
+                    try:
+                        index, item = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        results[index] = (self.limiter.call(func, item), None)
+                    except Exception as exc:
+                        results[index] = (None, exc)
+            finally:
+                finished.release()
+
+        if not workers:
+            worker()
+        for _ in range(workers):
+            MAP_POOL.submit(worker)
+        for _ in range(workers):
+            finished.acquire()
+        return results
+
+    @staticmethod
+    def is_token_fault(fault):
+        return fault.faultCode in TOKEN_FAULT_CODES and (
+            fault.faultCode != 32000 or 'token' in fault.faultString.lower()
+        )
+
+    def get_token_path(self):
+        if not self.token_dir:
+            return None
+        name = hashlib.md5('%s|%s' % (self.url, self.user)).hexdigest()
+        return os.path.join(self.token_dir, 'bz-token-%s' % name)
+
+    def get_token(self):
+        """
+        Get the login token, from the token dir if another process already
+        logged in, or logging in if not. If the server does not give tokens
+        the user and password will be sent with each request instead.
+
+        :returns: the token or None if there's no token
+        """
+        if self.token or self.token_disabled:
+            return self.token
+        if not (self.user and self.passwd):
+            return None
+        with self.token_lock:
+            if self.token or self.token_disabled:
+                return self.token
+            return self.login()
+
+    def login(self):
+        """
+        Get a new token, see get_token
+        """
+        token_path = self.get_token_path()
+        if token_path and os.path.exists(token_path):
+            try:
+                with open(token_path) as token_fd:
+                    self.token = token_fd.read().strip() or None
+            except IOError as err:
+                logging.warning("Unable to read the bugzilla token: %s" % err)
+            if self.token:
+                return self.token
+        try:
+            self.token = self.rpc.User.login({
+                'login': self.user,
+                'password': self.passwd,
+                'restrict_login': False,
+            })['token']
+        except (xmlrpclib.Fault, KeyError) as err:
+            logging.warning(
+                "Unable to get a bugzilla login token, using password "
+                "auth: %s" % err
+            )
+            self.token_disabled = True
+            return None
+        if token_path:
+            self.store_token(token_path, self.token)
+        return self.token
+
+    @staticmethod
+    def store_token(token_path, token):
+        """
+        Store the token only readable by the current user, atomically, so
+        other processes never read a partial token
+        """
+        try:
+            token_fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(token_path),
+            )
+            with os.fdopen(token_fd, 'w') as token_file:
+                token_file.write(token)
+            os.rename(tmp_path, token_path)
+        except (IOError, OSError) as err:
+            logging.warning("Unable to store the bugzilla token: %s" % err)
+
+    def drop_token(self):
+        """
+        Forget the current token, for the next request to log in again
+        """
+        self.token = None
+        token_path = self.get_token_path()
+        if token_path and os.path.exists(token_path):
+            try:
+                os.unlink(token_path)
+            except OSError:
+                pass
+
     def __getattr__(self, what):
         return getattr(self.rpc, what)
 
@@ -72,62 +632,237 @@ class Bugzilla(object):
 
         return flag_dict
 
-    def extract_bug_info(self, bug_id):
+    def extract_bug_info(self, bug_id, fields=BUG_FIELDS):
         """
         Extract parameters from bz ticket
 
         :param bug_id: bug number
+        :param fields: bug fields to get, the other attributes of the bug
+            object are None
         :return bug object: bug object that will hold all the bug data info
         """
+        bugs, _ = self.extract_bugs_info([bug_id], fields)
+        return bugs.get(str(bug_id))
+
+    def extract_bugs_info(self, bug_ids, fields=BUG_FIELDS):
+        """
+        Extract parameters from many bz tickets at once, with a single
+        request
+
+        :param bug_ids: list of bug numbers
+        :param fields: bug fields to get, the other attributes of the bug
+            objects are None
+        :return tuple: dict of bug number -> bug object for the bugs that
+            were retrieved, and dict of bug number -> error message for the
+            ones that were not (private or non existing bugs)
+        """
+        bug_ids = [str(bug_id) for bug_id in bug_ids]
         try:
-            bug = self.rpc.Bug.get(
-                self.wrap({
-                    'ids': bug_id, 'extra_fields': ['flags', 'external_bugs'],
-                })
-            )
+            bugs, faults = self.get_bugs(bug_ids, fields)
         except (xmlrpclib.Fault, xmlrpclib.ProtocolError) as err:
+            logging.error("Failed to retrieve bugs {0}:\n{1}".format(
+                ', '.join(bug_ids), err
+            ))
+            return {}, dict((bug_id, str(err)) for bug_id in bug_ids)
+
+        faults = dict(
+            (bug_id, fault.get('faultString', ''))
+            for bug_id, fault in faults.items()
+        )
+        for bug_id, fault in faults.items():
             logging.error("Failed to retrieve bug {0}:\n{1}".format(
-                bug_id, err
+                bug_id, fault
             ))
-            return None
+        return (
+            dict((bug_id, self.make_bug(bug)) for bug_id, bug in bugs.items()),
+            faults,
+        )
+
+    def get_bugs(self, bug_ids, fields=BUG_FIELDS):
+        """
+        Get the fields of the given bugs, from the cache when possible
+
+        :param bug_ids: list of bug numbers
+        :param fields: bug fields to get, the id is always included
+        :return tuple: dict of bug number -> dict of bug fields, and dict of
+            bug number -> dict with the faultCode and faultString for the ones
+            that could not be retrieved
+        """
+        bug_ids = [str(bug_id) for bug_id in bug_ids]
+        fields = tuple(sorted(set(fields) | set(['id'])))
+        if self.cache is None:
+            return self.fetch_bugs(bug_ids, fields)
+
+        bugs, faults = {}, {}
+        missing = self.get_cached_bugs(bug_ids, fields, bugs, faults)
+        if missing:
+            with self.cache.lock(*missing):
+                # another process might have fetched them while we waited
+                missing = self.get_cached_bugs(missing, fields, bugs, faults)
+                if missing:
+                    fetched, fetch_faults = self.fetch_bugs(missing, fields)
+                    self.cache_bugs(fetched, fetch_faults, fields)
+                    bugs.update(fetched)
+                    faults.update(fetch_faults)
+        return bugs, faults
+
+    def fetch_bugs(self, bug_ids, fields=BUG_FIELDS):
+        """
+        Get the fields of the given bugs from the server with a single
+        request, see get_bugs
+        """
+        if not bug_ids:
+            return {}, {}
+        bug_ids = list(bug_ids)
+        chunks = [
+            bug_ids[index:index + BUG_GET_CHUNK_SIZE]
+            for index in range(0, len(bug_ids), BUG_GET_CHUNK_SIZE)
+        ]
+        res = {'bugs': [], 'faults': []}
+        for chunk_res, error in self.map(
+            lambda chunk: self.fetch_bugs_chunk(chunk, fields), chunks,
+        ):
+            if error is not None:
+                raise error
+            res['bugs'].extend(chunk_res['bugs'])
+            res['faults'].extend(chunk_res.get('faults', []))
+        bugs = {}
+        for bug in res['bugs']:
+            bug = dict(
+                (field, bug[field]) for field in fields if field in bug
+            )
+            # make them json friendly, for the cache (xmlrpc dates)
+            bugs[str(bug['id'])] = json.loads(json.dumps(bug, default=str))
+        faults = dict(
+            (str(fault['id']), {
+                'faultCode': fault.get('faultCode'),
+                'faultString': fault.get('faultString', ''),
+            })
+            for fault in res.get('faults', [])
+        )
+        for bug_id in bug_ids:
+            if bug_id not in bugs and bug_id not in faults:
+                faults[bug_id] = {
+                    'faultCode': None,
+                    'faultString': 'Bug not returned by the server',
+                }
+        return bugs, faults
+
+    def fetch_bugs_chunk(self, bug_ids, fields=BUG_FIELDS):
+        """
+        Get only the needed fields of the given bugs
+
+        :param bug_ids: list of bug numbers
+        :param fields: bug fields to get
+        :returns dict: with the 'bugs' and 'faults' lists, as returned by
+            Bug.get
+        """
+        return self.call('Bug.get', {
+            'ids': bug_ids,
+            'include_fields': list(fields),
+            'extra_fields': [
+                field for field in EXTRA_BUG_FIELDS if field in fields
+            ],
+            'permissive': True,
+        })
+
+    @staticmethod
+    def get_cache_key(bug_id, fields):
+        """
+        Get the cache key for the given fields of a bug, the entries are
+        tagged with the bug id to invalidate all of them at once
+        """
+        return '%s:%s' % (bug_id, ','.join(fields))
+
+    def get_cached_bugs(self, bug_ids, fields, bugs, faults):
+        """
+        Fill the bugs and faults dicts with the cached entries for the given
+        ids and fields
+
+        :returns list: ids that are not cached
+        """
+        missing = []
+        for bug_id in bug_ids:
+            entry = cache.safe_call(
+                self.cache.get, self.get_cache_key(bug_id, fields),
+            )
+            if not entry:
+                missing.append(bug_id)
+            elif 'fault' in entry:
+                faults[bug_id] = entry['fault']
+            else:
+                bugs[bug_id] = entry['bug']
+        return missing
 
-        product = bug['bugs'][0]['product']
-        title = bug['bugs'][0]['summary']
-        status = bug['bugs'][0]['status']
-        flags = self.extract_flags(bug['bugs'][0]['flags'])
-        target_rel = bug['bugs'][0]['target_release']
-        milestone = bug['bugs'][0]['target_milestone']
-        classification = bug['bugs'][0]['classification']
-        component = bug['bugs'][0]['component']
-        external_bugs = bug['bugs'][0]['external_bugs']
-
-        bug_data = Bug(
-            product=product, status=status, component=component,
-            title=title, flags=flags, milestone=milestone,
-            classification=classification, target_rel=target_rel,
-            external_bugs=external_bugs,
+    def cache_bugs(self, bugs, faults, fields):
+        """
+        Store the bugs and the non existing/private bugs faults in the cache
+        """
+        for bug_id, bug in bugs.items():
+            cache.safe_call(
+                self.cache.set, self.get_cache_key(bug_id, fields),
+                {'bug': bug}, tags=[bug_id],
+            )
+        for bug_id, fault in faults.items():
+            if fault['faultCode'] in NEGATIVE_FAULT_CODES:
+                cache.safe_call(
+                    self.cache.set, self.get_cache_key(bug_id, fields),
+                    {'fault': fault}, tags=[bug_id],
+                    ttl=min(NEGATIVE_TTL, self.cache.ttl),
+                )
+
+    def invalidate_bugs(self, bug_ids):
+        """
+        Remove the given bugs from the cache
+
+        :param bug_ids: list of bug numbers
+        """
+        if self.cache is None:
+            return
+        cache.safe_call(
+            self.cache.invalidate_tags, [str(bug_id) for bug_id in bug_ids],
+        )
+
+    def make_bug(self, bug):
+        """
+        Build the bug object from the data returned by Bug.get
+
+        :param bug: dict with the bug fields
+        :return bug object: bug object that will hold all the bug data info
+        """
+        return Bug(
+            product=bug.get('product'),
+            status=bug.get('status'),
+            component=bug.get('component'),
+            title=bug.get('summary'),
+            flags=self.extract_flags(bug.get('flags', [])),
+            milestone=bug.get('target_milestone'),
+            classification=bug.get('classification'),
+            target_rel=bug.get('target_release'),
+            external_bugs=bug.get('external_bugs'),
         )
-        return bug_data
 
     def update_bug(self, bug_id, **fields):
-        bug = self.wrap({
+        bug = {
             'ids': bug_id,
-        })
+        }
         bug.update(fields)
-        return self.rpc.Bug.update(bug)['bugs']
+        try:
+            return self.call('Bug.update', bug)['bugs']
+        finally:
+            self.invalidate_bugs(
+                bug_id if isinstance(bug_id, (list, tuple, set))
+                else [bug_id]
+            )
 
     def get_external(self, bug_id, external_bug_id, ensure_product=None):
-        bug = self.rpc.Bug.get(self.wrap({
-            'ids': bug_id,
-            'extra_fields': ['external_bugs'],
-        }))
-        if not bug['bugs']:
+        bugs, faults = self.get_bugs([bug_id], EXTERNAL_BUG_FIELDS)
+        if str(bug_id) not in bugs:
             logging.error("Unable to get bug {0}\n{1}".format(
-                str(bug_id), bug['faults']
+                str(bug_id), faults.get(str(bug_id))
             ))
             return None
-        # Only one response when asking by the commit hash
-        bug = bug['bugs'][0]
+        bug = bugs[str(bug_id)]
         # check product
         if ensure_product is not None and bug['product'] != ensure_product:
             raise WrongProduct(bug['product'])
@@ -136,13 +871,16 @@ class Bugzilla(object):
                 return external
         return None
 
-    def update_external(self, bug_id, external_bug_id, ext_type_id,
-                        status=None, description=None, branch=None,
-                        ensure_product=None):
-        orig_external = self.get_external(
-            bug_id,
-            external_bug_id,
-            ensure_product=ensure_product)
+    @staticmethod
+    def make_external(external_bug_id, ext_type_id, status=None,
+                      description=None, branch=None, orig_external=None):
+        """
+        Build the external tracker fields for add_external_bug or
+        update_external_bug, the ones not passed are taken from the current
+        external tracker if any
+
+        :param orig_external: current external tracker of the bug, if any
+        """
         external = dict()
         external['ext_type_id'] = ext_type_id
         external['ext_bz_bug_id'] = external_bug_id
@@ -156,14 +894,7 @@ class Bugzilla(object):
         if branch:
             external['ext_priority'] = branch
 
-        # if we don't have external bug tracker, add a new one or else update
-        # the exist one
-        if not orig_external:
-            self.ExternalBugs.add_external_bug(self.wrap({
-                'bug_ids': [bug_id],
-                'external_bugs': [external],
-            }))
-        else:
+        if orig_external:
             if description is None:
                 external['ext_description'] = orig_external['ext_description']
 
@@ -173,7 +904,46 @@ class Bugzilla(object):
             if branch is None:
                 external['ext_priority'] = orig_external['ext_priority']
 
-            self.ExternalBugs.update_external_bug(self.wrap(external))
+        return external
+
+    def update_external(self, bug_id, external_bug_id, ext_type_id,
+                        status=None, description=None, branch=None,
+                        ensure_product=None):
+        orig_external = self.get_external(
+            bug_id,
+            external_bug_id,
+            ensure_product=ensure_product)
+        external = self.make_external(
+            external_bug_id, ext_type_id, status=status,
+            description=description, branch=branch,
+        )
+
+        # if we don't have external bug tracker, add a new one or else update
+        # the exist one
+        if not orig_external:
+            try:
+                self.call('ExternalBugs.add_external_bug', {
+                    'bug_ids': [bug_id],
+                    'external_bugs': [external],
+                })
+            except xmlrpclib.Fault as fault:
+                if self.cache is None:
+                    raise
+                # the cached bug might be outdated, and the tracker there
+                self.invalidate_bugs([bug_id])
+                orig_external = self.get_external(bug_id, external_bug_id)
+                if not orig_external:
+                    raise fault
+
+        if orig_external:
+            external = self.make_external(
+                external_bug_id, ext_type_id, status=status,
+                description=description, branch=branch,
+                orig_external=orig_external,
+            )
+            self.call('ExternalBugs.update_external_bug', external)
+
+        self.invalidate_bugs([bug_id])
 
     @staticmethod
     def get_bug_urls(commit, bz_server="https://bugzilla.redhat.com"):
@@ -184,15 +954,7 @@ class Bugzilla(object):
         :param bz_server: bugzilla server
         :return: list of bug urls or empty list
         """
-
-        # greedily match 2 or more new-lines
-        blank_lines_regex = r"(?:\r?\n){2,}"
-        commit_footer = (re.split(blank_lines_regex, commit.strip()))[-1]
-
-        regex_search = r'^Bug-Url:[\s]*(https*:\/\/' + \
-            bz_server.split("//")[-1] + r'\/.*\d+\b)'
-
-        return re.findall(regex_search, commit_footer, flags=re.IGNORECASE | re.MULTILINE)
+        return get_footers(commit).get_bug_urls(bz_server)
 
 
     @staticmethod
@@ -203,28 +965,330 @@ class Bugzilla(object):
         :param bug_urls: list of bug urls
         :return: set of unique bug ids
         """
-        regex_bug_id = r'\d+\b'
-        bug_ids = set()
+        return set(get_bug_id(url) for url in bug_urls)
 
-        # get bug_id from bug_url
-        for url in bug_urls:
-            bug_ids.add(re.findall(regex_bug_id, url)[0])
 
-        return bug_ids
+class BugzillaREST(Bugzilla):
+    """
+    Bugzilla object that reads the bugs through the REST api, asking only for
+    the needed fields, that makes the responses smaller and faster to parse
+    than the XML-RPC ones, specially for bugs with many external trackers.
 
+    The writes still go through XML-RPC (the external trackers are not
+    available in the REST api), and both use the same keep-alive
+    connection.
+    """
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--bz-user', required=False, default=None,
-                        help='User to use when logging into bugzilla')
-    parser.add_argument('--bz-pass', required=False, default=None,
-                        help='Password to use when logging into bugzilla')
-    parser.add_argument('action', help='Action to execute')
-    parser.add_argument('params', action='append', nargs='*',
-                        help='Arguments to be passed to the method')
-    args = parser.parse_args()
+    def __init__(self, *args, **kwargs):
+        super(BugzillaREST, self).__init__(*args, **kwargs)
+        self.rest_url = re.sub(r'/xmlrpc\.cgi$', '', self.url) + '/rest'
+
+    def rest_headers(self):
+        """
+        Authentication headers, same credentials as in wrap
+        """
+        token = None if self.api_key else self.get_token()
+        if self.api_key:
+            return {'X-BUGZILLA-API-KEY': self.api_key}
+        elif token:
+            return {'X-BUGZILLA-TOKEN': token}
+        headers = {}
+        if self.user:
+            headers['X-BUGZILLA-LOGIN'] = self.user
+        if self.passwd:
+            headers['X-BUGZILLA-PASSWORD'] = self.passwd
+        return headers
+
+    def rest_get(self, path, params):
+        """
+        Send a GET request to the REST api, logging in again if the login
+        token expired
+
+        :param path: path of the resource under the REST url, like '/bug'
+        :param params: dict of query parameters
+        :returns: the decoded json response
+        :raises: xmlrpclib.Fault with the bugzilla error code and message if
+            bugzilla returned an error, so it can be handled as the XML-RPC
+            ones
+        :raises breaker.CircuitOpen: if bugzilla is known to be unreachable
+        """
+        return self.remote(
+            'GET ' + path, True, self.do_rest_get, path, params,
+        )
+
+    def do_rest_get(self, path, params):
+        try:
+            return self.rest_request(path, params)
+        except xmlrpclib.Fault as fault:
+            if not self.token or not self.is_token_fault(fault):
+                raise
+            logging.info("Bugzilla login token expired, logging in again")
+            self.drop_token()
+            return self.rest_request(path, params)
+
+    def rest_request(self, path, params):
+        url = urlparse.urlparse(self.rest_url)
+        selector = '%s%s?%s' % (url.path, path, urllib.urlencode(params))
+        headers = dict(self.rest_headers(), Accept='application/json')
+        for attempt in (0, 1):
+            conn = self.transport.make_connection(url.netloc)
+            try:
+                conn.request('GET', selector, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (socket.error, httplib.BadStatusLine):
+                # the server might have closed the idle connection
+                self.transport.close()
+                if attempt:
+                    raise
+        if response.status in retry.RATE_LIMIT_CODES:
+            raise xmlrpclib.ProtocolError(
+                url.netloc + selector, response.status, response.reason,
+                response.msg,
+            )
+        try:
+            res = json.loads(body)
+        except ValueError:
+            raise xmlrpclib.ProtocolError(
+                url.netloc + selector, response.status, response.reason,
+                response.msg,
+            )
+        if res.get('error'):
+            raise xmlrpclib.Fault(res.get('code'), res.get('message', ''))
+        return res
+
+    def fetch_bugs_chunk(self, bug_ids, fields=BUG_FIELDS):
+        res = self.rest_get('/bug', {
+            'id': ','.join(bug_ids),
+            'include_fields': ','.join(fields),
+        })
+        # the search skips the private and non existing bugs
+        found = set(str(bug['id']) for bug in res.get('bugs', []))
+        return {
+            'bugs': res.get('bugs', []),
+            'faults': [
+                {
+                    'id': bug_id,
+                    'faultCode': 101,
+                    'faultString': "Bug #%s does not exist or you are not "
+                                   "authorized to access it" % bug_id,
+                }
+                for bug_id in bug_ids if str(bug_id) not in found
+            ],
+        }
+
+
+# Bugzilla classes for each of the BZ_BACKEND config values
+BACKENDS = {
+    'xmlrpc': Bugzilla,
+    'rest': BugzillaREST,
+}
+
+
+class BugWriteBatch(object):
+    """
+    Collects bug status updates and external tracker changes, to send them
+    to bugzilla together on flush:
+
+    * The bugs that get the same fields are updated with one Bug.update
+    * The current external trackers of all the bugs are read with one
+      Bug.get
+    * The bugs that get the same new external tracker, or the same changes
+      to an existing one, are written with one call
+
+    If any grouped call fails, its bugs are retried one by one, so the
+    result of each bug can be reported.
+    """
+    def __init__(self, bz_obj):
+        """
+        :param bz_obj: :class:`Bugzilla` object to write through
+        """
+        self.bz_obj = bz_obj
+        # list of (sorted fields items, bug id)
+        self.updates = []
+        # list of (bug id, dict of update_external parameters)
+        self.externals = []
+
+    def update_bug(self, bug_id, **fields):
+        """
+        Queue a bug update, see :meth:`Bugzilla.update_bug`
+        """
+        self.updates.append((tuple(sorted(fields.items())), str(bug_id)))
+
+    def update_external(self, bug_id, external_bug_id, ext_type_id,
+                        status=None, description=None, branch=None,
+                        ensure_product=None):
+        """
+        Queue an external tracker add or update, see
+        :meth:`Bugzilla.update_external`
+        """
+        self.externals.append((str(bug_id), dict(
+            external_bug_id=external_bug_id,
+            ext_type_id=ext_type_id,
+            status=status,
+            description=description,
+            branch=branch,
+            ensure_product=ensure_product,
+        )))
+
+    def flush(self):
+        """
+        Send all the queued writes
+
+        :returns dict: bug id -> None if all its writes succeeded, or the
+            exception of the one that failed
+        """
+        results = {}
+        updates, self.updates = self.updates, []
+        externals, self.externals = self.externals, []
+        self.flush_updates(updates, results)
+        self.flush_externals(externals, results)
+        return results
+
+    @staticmethod
+    def group(items):
+        """
+        Group the (key, bug id) items by key, keeping the order
+        """
+        groups = []
+        by_key = {}
+        for key, bug_id in items:
+            if key not in by_key:
+                by_key[key] = []
+                groups.append((key, by_key[key]))
+            if bug_id not in by_key[key]:
+                by_key[key].append(bug_id)
+        return groups
+
+    @staticmethod
+    def set_result(results, bug_ids, error=None):
+        for bug_id in bug_ids:
+            if results.get(bug_id) is None:
+                results[bug_id] = error
+
+    def flush_updates(self, updates, results):
+        groups = self.group(updates)
+        single = []
+        for (fields, bug_ids), (_, error) in zip(groups, self.bz_obj.map(
+            lambda group: self.bz_obj.update_bug(group[1], **dict(group[0])),
+            groups,
+        )):
+            if error is None or len(bug_ids) == 1:
+                self.set_result(results, bug_ids, error)
+                continue
+            logging.warning(
+                "Failed to update bugs {0} together, updating them one "
+                "by one: {1}".format(', '.join(bug_ids), error)
+            )
+            single.extend((fields, bug_id) for bug_id in bug_ids)
+
+        for (fields, bug_id), (_, error) in zip(single, self.bz_obj.map(
+            lambda item: self.bz_obj.update_bug(item[1], **dict(item[0])),
+            single,
+        )):
+            self.set_result(results, [bug_id], error)
+
+    def flush_externals(self, externals, results):
+        if not externals:
+            return
+        try:
+            bugs, _ = self.bz_obj.get_bugs(
+                (bug_id for bug_id, _ in externals), EXTERNAL_BUG_FIELDS,
+            )
+        except (xmlrpclib.Fault, xmlrpclib.ProtocolError) as exc:
+            logging.warning("Failed to get the bugs external trackers: %s"
+                            % exc)
+            bugs = {}
+
+        # list of (method, external fields, bug ids)
+        calls = []
+        adds, updates, single = [], [], []
+        for bug_id, params in externals:
+            bug = bugs.get(bug_id)
+            if bug is None:
+                single.append((bug_id, params))
+                continue
+            ensure_product = params['ensure_product']
+            if ensure_product is not None \
+                    and bug['product'] != ensure_product:
+                self.set_result(
+                    results, [bug_id], WrongProduct(bug['product'])
+                )
+                continue
+            orig_external = None
+            for external in bug['external_bugs']:
+                if external.get('ext_bz_bug_id') == \
+                        str(params['external_bug_id']):
+                    orig_external = external
+            external = self.bz_obj.make_external(
+                params['external_bug_id'], params['ext_type_id'],
+                status=params['status'],
+                description=params['description'],
+                branch=params['branch'],
+                orig_external=orig_external,
+            )
+            key = tuple(sorted(external.items()))
+            if orig_external is None:
+                adds.append((key, bug_id))
+            else:
+                updates.append((key, bug_id))
+        calls.extend(
+            ('ExternalBugs.add_external_bug', dict(key), bug_ids)
+            for key, bug_ids in self.group(adds)
+        )
+        calls.extend(
+            ('ExternalBugs.update_external_bug', dict(key), bug_ids)
+            for key, bug_ids in self.group(updates)
+        )
+
+        for (method, _, bug_ids), (_, error) in zip(calls, self.bz_obj.map(
+            self.call_external, calls,
+        )):
+            self.bz_obj.invalidate_bugs(bug_ids)
+            if error is None:
+                self.set_result(results, bug_ids)
+                continue
+            logging.warning(
+                "Failed to write the external trackers of bugs {0} "
+                "together, writing them one by one: {1}".format(
+                    ', '.join(bug_ids), error)
+            )
+            single.extend(
+                (bug_id, params) for bug_id, params in externals
+                if bug_id in bug_ids
+            )
+
+        for (bug_id, _), (_, error) in zip(single, self.bz_obj.map(
+            lambda item: self.bz_obj.update_external(item[0], **item[1]),
+            single,
+        )):
+            self.set_result(results, [bug_id], error)
+
+    def call_external(self, call):
+        """
+        Add or update the same external tracker on many bugs
+
+        :param call: tuple of method name, external fields and bug ids
+        """
+        method, external, bug_ids = call
+        if method == 'ExternalBugs.add_external_bug':
+            params = {'bug_ids': bug_ids, 'external_bugs': [external]}
+        else:
+            params = dict(external, bug_ids=bug_ids)
+        return self.bz_obj.call(method, params)
+
+
+def parse_cli_params(params):
+    """
+    Parse the method parameters as given in the command line, each of them
+    a name=json_value pair, or a json object with many of them
+
+    :param params: list of command line parameters
+    :returns dict: the method parameters
+    """
     real_params = {}
-    for param in args.params[0]:
+    for param in params:
         if '=' in param:
             name, value = param.split('=', 1)
         else:
@@ -238,18 +1302,125 @@ if __name__ == '__main__':
             real_params[name] = value
         else:
             real_params.update(value)
-    server = Bugzilla(args.bz_user, args.bz_pass)
-    call_obj = server.rpc
-    obj_path = args.action.split('.')
-    while obj_path:
-        call_obj = getattr(call_obj, obj_path.pop(0))
+    return real_params
+
+
+def cli_call(server, action, params):
+    """
+    Call a bugzilla method for the command line
+
+    :param server: :class:`Bugzilla` object
+    :param action: method to call
+    :param params: dict with the method parameters
+    :returns: tuple of (return code, result, error message), the return code
+        is 0 if it went well, 2 if the login failed and 1 otherwise
+    """
     try:
-        res = call_obj(server.wrap(real_params))
+        return 0, server.call(action, params), None
     except xmlrpclib.Fault as fault:
         if fault.faultCode == 300:
-            print "LOGIN ERROR:%s" % fault
-            sys.exit(2)
+            return 2, None, "LOGIN ERROR:%s" % fault
+        return 1, None, "ERROR:%s" % fault
+    except Exception as exc:
+        return 1, None, "ERROR:%s" % exc
+
+
+def run_batch(server, infile, outfile, out_format='json'):
+    """
+    Run the calls read from infile, one per line, writing the response of
+    each as soon as it's done, all of them through the same connection and
+    login
+
+    In json format each request is a json object with the keys `method`,
+    `params` and, optionally, `id`, and each response a json object with
+    the same `id`, the return code in `rc` and the `result` or the `error`
+    message.
+
+    In text format, for the bash libs, each request has the method and the
+    parameters as in the command line separated by the BATCH_SEPARATOR
+    character, and each response is the output of the command line call
+    followed by a BATCH_END line with the return code.
+
+    :param server: :class:`Bugzilla` object
+    :param infile: file to read the requests from
+    :param outfile: file to write the responses to
+    :param out_format: 'json' or 'text'
+    """
+    # readline, as iterating the file reads ahead and would wait for more
+    # requests before answering
+    for line in iter(infile.readline, ''):
+        line = line.rstrip('\n')
+        if not line.strip():
+            continue
+        if out_format == 'text':
+            fields = line.split(BATCH_SEPARATOR)
+            rc, res, error = cli_call(
+                server, fields[0], parse_cli_params(fields[1:]),
+            )
+            outfile.write('%s\n%s %d\n' % (
+                error or json.dumps(res, indent=4, default=str),
+                BATCH_END,
+                rc,
+            ))
         else:
-            print "ERROR:%s" % fault
-            sys.exit(1)
+            try:
+                request = json.loads(line)
+                rc, res, error = cli_call(
+                    server, request['method'], request.get('params') or {},
+                )
+            except (ValueError, KeyError, TypeError) as exc:
+                request = {}
+                rc, res, error = 1, None, "ERROR:bad request %s" % exc
+            response = {'id': request.get('id'), 'rc': rc}
+            if error is None:
+                response['result'] = res
+            else:
+                response['error'] = error
+            outfile.write(json.dumps(response, default=str) + '\n')
+        outfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bz-user', required=False, default=None,
+                        help='User to use when logging into bugzilla')
+    parser.add_argument('--bz-pass', required=False, default=None,
+                        help='Password to use when logging into bugzilla')
+    parser.add_argument('--bz-api-key', required=False,
+                        default=os.environ.get('BZ_API_KEY'),
+                        help='Api key to use instead of user and password')
+    parser.add_argument('--token-dir', required=False,
+                        default=os.environ.get('HOOKS_CACHE_DIR'),
+                        help='Directory with the login tokens shared with '
+                        'the python hooks')
+    parser.add_argument('--batch', required=False, default=None,
+                        choices=['json', 'text'],
+                        help='Read the calls from stdin, one per line, '
+                        'instead of the command line, see run_batch')
+    parser.add_argument('action', nargs='?', help='Action to execute')
+    parser.add_argument('params', action='append', nargs='*',
+                        help='Arguments to be passed to the method')
+    args = parser.parse_args()
+    if args.action is None and args.batch is None:
+        parser.error('An action is needed unless running in batch mode')
+    server = Bugzilla(
+        args.bz_user,
+        args.bz_pass,
+        api_key=args.bz_api_key,
+        token_dir=get_token_dir({'HOOKS_CACHE_DIR': args.token_dir}),
+    )
+    if args.batch:
+        run_batch(server, sys.stdin, sys.stdout, out_format=args.batch)
+        return 0
+    rc, res, error = cli_call(
+        server, args.action, parse_cli_params(args.params[0]),
+    )
+    if error is not None:
+        print error
+        return rc
     print json.dumps(res, indent=4, default=str)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,6 +5,91 @@ source conf.sh
 source tools.sh
 
 
+######
+## @fn bz.start_batch()
+## @brief Starts a bz.py process in the background to send all the next
+## bugzilla calls of the hook through (see bz._call), so it only logs in and
+## connects once, instead of starting a new bz.py for each call. It's
+## stopped by bz.clean, or when the hook exits. bz.login calls it, so the
+## hooks that log in get it already.
+## @note Call it from the main shell of the hook, not from a pipe or a $(...),
+## or it will be gone when those end (then the calls just start a new bz.py
+## each). The calls can then be done from anywhere, but not from many
+## background jobs at the same time.
+## @param bz_user User to log into bugzilla (default: $BZ_USER)
+## @param bz_password Password (default: $BZ_PASS)
+## @retval 0 if it's running
+bz.start_batch(){
+    declare bz_user="${1:-$BZ_USER}"
+    declare bz_password="${2:-$BZ_PASS}"
+    if [[ -n "$BZ_BATCH_PID" ]] && kill -0 "$BZ_BATCH_PID" &>/dev/null; then
+        return 0
+    fi
+    ## stop it on exit, keeping the exit trap of the hook, if any
+    eval "set -- $(trap -p EXIT)"
+    trap "bz.stop_batch${3:+; $3}" EXIT
+    coproc BZ_BATCH {
+        bz.py \
+            ${bz_user:+--bz-user="$bz_user"} \
+            ${bz_password:+--bz-pass="$bz_password"} \
+            ${BZ_API_KEY:+--bz-api-key="$BZ_API_KEY"} \
+            ${HOOKS_CACHE_DIR:+--token-dir="$HOOKS_CACHE_DIR"} \
+            --batch text
+    }
+    ## the coproc fds are closed in the pipes, so use copies of them
+    exec {BZ_BATCH_IN}>&"${BZ_BATCH[1]}" {BZ_BATCH_OUT}<&"${BZ_BATCH[0]}"
+}
+
+
+######
+## @fn bz.stop_batch()
+## @brief Stops the bz.py process started by bz.start_batch, if any
+bz.stop_batch(){
+    [[ -n "$BZ_BATCH_IN" ]] || return 0
+    exec {BZ_BATCH_IN}>&- {BZ_BATCH_OUT}<&-
+    kill "$BZ_BATCH_PID" &>/dev/null
+    wait "$BZ_BATCH_PID" &>/dev/null
+    unset BZ_BATCH_IN BZ_BATCH_OUT BZ_BATCH_PID
+}
+
+
+######
+## @fn bz._call()
+## @brief Calls a bugzilla method, through the bz.py process started by
+## bz.start_batch if any, or with a new one otherwise. The output and return
+## code are the same in both cases.
+## @param method Method to call, like Bug.get
+## @param params... Each of the method parameters, as name=json_value
+## @retval 0 if the call went well
+## @retval 1 if it failed
+## @retval 2 if it failed to log in
+bz._call(){
+    local line param
+    local -a params=()
+    if [[ -n "$BZ_BATCH_IN" ]] && kill -0 "$BZ_BATCH_PID" &>/dev/null; then
+        ## one request per line, with the fields separated by \x1f
+        for param in "$@"; do
+            params+=("${param//$'\n'/ }")
+        done
+        (IFS=$'\x1f'; echo "${params[*]}") >&"$BZ_BATCH_IN"
+        while IFS= read -r line <&"$BZ_BATCH_OUT"; do
+            if [[ "$line" =~ ^__BZ_END__\ ([[:digit:]]+)$ ]]; then
+                return "${BASH_REMATCH[1]}"
+            fi
+            echo "$line"
+        done
+        tools.log "::bz._call::The bz.py batch process exited"
+        return 1
+    fi
+    bz.py \
+        ${BZ_USER:+--bz-user="$BZ_USER"} \
+        ${BZ_PASS:+--bz-pass="$BZ_PASS"} \
+        ${BZ_API_KEY:+--bz-api-key="$BZ_API_KEY"} \
+        ${HOOKS_CACHE_DIR:+--token-dir="$HOOKS_CACHE_DIR"} \
+        "$@"
+}
+
+
 #####
 ## @fn bz.get_bug()
 ## @brief Get's the bug_id bug json information from cache, or if not cached,
@@ -22,9 +107,7 @@ bz.get_bug(){
         if [[ "$bug_cache" == "" ]]; then
             bug_cache="/tmp/bz_cache.$PPID.${bug_id}.json"
         fi
-        bz.py \
-            ${BZ_USER:+--bz-user="$BZ_USER"} \
-            ${BZ_PASS:+--bz-pass="$BZ_PASS"} \
+        bz._call \
             Bug.get "ids=[$bug_id]" \
             "extra_fields=[\"flags\", \"external_bugs\"]" \
         | tee "$bug_cache"
@@ -47,9 +130,7 @@ bz.update_bug(){
     declare -a data="$@"
     local param data rc bug_cache
     local error=0
-    res="$(bz.py \
-            --bz-user="$BZ_USER" \
-            --bz-pass="$BZ_PASS" \
+    res="$(bz._call \
             Bug.update \
             "ids=[$bug_id]" \
             "${data[@]}" \
@@ -122,6 +203,8 @@ bz.get_bug_id(){
 ######
 ## @fn bz.login()
 ## @brief Logs into bugzilla if not logged in already.
+## The login token is stored in the HOOKS_CACHE_DIR dir (~/.cache/gerrit-hooks
+## by default) and reused by the next calls, also by the python hooks.
 ## @param bz_user User to log into bugzilla
 ## @param bz_password Password
 ##
@@ -160,10 +243,13 @@ bz.login(){
     declare bz_password="${2?No password passed}"
     [[ "$bz_user" == "" ]] && { echo "No use supplied"; return 1; }
     [[ "$bz_password" == "" ]] && { echo "No password supplied"; return 1; }
-    ## Login for us is just trying to do a request and not getting error
+    ## Login for us is just trying to do a request and not getting error,
+    ## with a new bz.py, as the batch one (if any) uses its own credentials
     res="$(bz.py \
-        --bz-user "$bz_user" \
-        --bz-pass "$bz_password" \
+        --bz-user="$bz_user" \
+        --bz-pass="$bz_password" \
+        ${BZ_API_KEY:+--bz-api-key="$BZ_API_KEY"} \
+        ${HOOKS_CACHE_DIR:+--token-dir="$HOOKS_CACHE_DIR"} \
         Bug.get "ids=[$bug_id]" \
         "extra_fields=[\"flags\", \"external_bugs\"]" \
     )"
@@ -173,6 +259,8 @@ bz.login(){
         return 1
     }
     [[ -n "$json_bug" ]] && echo "$res" >"$json_bug"
+    ## send the rest of the calls of the hook through a single bz.py
+    bz.start_batch "$bz_user" "$bz_password"
     return 0
 }
 
@@ -270,16 +358,12 @@ bz.add_tracker(){
     externals+="${status:+, \"ext_status\": \"$status\"}"
     externals+="${branch:+, \"ext_priority\": \"$branch\"}"
     externals+="}"
-    bz.py \
-        ${BZ_USER:+--bz-user $BZ_USER} \
-        ${BZ_PASS:+--bz-pass $BZ_PASS} \
+    bz._call \
         ExternalBugs.add_external_bug \
         "bug_ids=[$bug_id]" \
         "externa_bugs=[$externals]" \
         >/dev/null \
-    || bz.py \
-        ${BZ_USER:+--bz-user $BZ_USER} \
-        ${BZ_PASS:+--bz-pass $BZ_PASS} \
+    || bz._call \
         ExternalBugs.update_external_bug \
         "$externals"
 }
@@ -405,6 +489,7 @@ bz.get_external_bugs(){
 ## @brief Cleans up all the cached config and data. Make sure that your last
 ## scripts calls it before exitting
 bz.clean(){
+    bz.stop_batch
     rm -f /tmp/bz_cache.$PPID.*
     conf.t_clean
 }
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+"""
+Cache
+======
+
+Small key/value cache stored in a sqlite database, so it can be shared by all
+the hook processes (and threads) running at the same time.
+
+Each entry has a time to live, and can be tagged so all the entries related
+to something (a change, a bug...) can be invalidated at once. The number of
+entries is bounded, the least recently used ones are evicted first.
+
+The values must be json serializable.
+
+API
+====
+"""
+import os
+import json
+import errno
+import time
+import fcntl
+import hashlib
+import sqlite3
+import logging
+import threading
+import contextlib
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'gerrit-hooks'
+)
+CACHE_DB = 'cache.db'
+DEFAULT_TTL = 60
+DEFAULT_MAX_ENTRIES = 1000
+# Seconds to wait for other processes to release the database
+DB_TIMEOUT = 30
+# The lookups don't write, the counters and access times are stored after
+# this many lookups or seconds (or with the next write), see DiskCache.get
+FLUSH_LOOKUPS = 50
+FLUSH_INTERVAL = 10
+# Max seconds to wait for the keys locked by others, see DiskCache.lock, and
+# seconds between tries
+LOCK_TIMEOUT = 30
+LOCK_POLL_INTERVAL = 0.1
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS entries ('
+    ' namespace TEXT, key TEXT, value TEXT, expires REAL, accessed REAL,'
+    ' PRIMARY KEY (namespace, key))',
+    'CREATE TABLE IF NOT EXISTS tags ('
+    ' namespace TEXT, tag TEXT, key TEXT)',
+    'CREATE INDEX IF NOT EXISTS tags_idx ON tags (namespace, tag)',
+    'CREATE INDEX IF NOT EXISTS tags_key_idx ON tags (namespace, key)',
+    'CREATE TABLE IF NOT EXISTS counters ('
+    ' namespace TEXT, name TEXT, value INTEGER,'
+    ' PRIMARY KEY (namespace, name))',
+)
+
+
+class Missing(object):
+    """
+    Marker for cache misses, as None is a valid value to cache
+    """
+    def __nonzero__(self):
+        return False
+
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = Missing()
+
+
+def get_cache_dir(conf=None):
+    """
+    Get the directory to store the caches in, creating it if needed
+
+    :param conf: configuration dict, the HOOKS_CACHE_DIR value overrides the
+        default directory
+    """
+    cache_dir = (conf or {}).get('HOOKS_CACHE_DIR') or DEFAULT_CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0o700)
+    return cache_dir
+
+
+def get_cache(conf, namespace, ttl, max_entries=DEFAULT_MAX_ENTRIES):
+    """
+    Get a cache stored in the shared cache database
+
+    :param conf: configuration dict, see get_cache_dir
+    :param namespace: name of the cache
+    :param ttl: default seconds to keep each entry
+    :param max_entries: max number of entries to keep
+    """
+    return DiskCache(
+        path=os.path.join(get_cache_dir(conf), CACHE_DB),
+        namespace=namespace,
+        ttl=ttl,
+        max_entries=max_entries,
+    )
+
+
+def safe_call(method, *args, **kwargs):
+    """
+    Call a cache method, a broken cache is logged and ignored, as it only
+    makes the hooks slower
+
+    :param method: cache method to call
+    :param args: positional arguments for the method
+    :param kwargs: keyword arguments for the method
+    :returns: what the method returns, or None if it failed
+    """
+    try:
+        return method(*args, **kwargs)
+    except (sqlite3.Error, OSError, IOError) as exc:
+        logger.warning('Cache failure: %s' % exc)
+        return None
+
+
+class DiskCache(object):
+    """
+    Key/value cache with ttl, tags and size bound, shared between processes
+    """
+    def __init__(self, path, namespace='default', ttl=DEFAULT_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        :param path: path to the sqlite database file
+        :param namespace: name to separate these entries from the ones of
+            other caches using the same database
+        :param ttl: default seconds to keep each entry
+        :param max_entries: max number of entries in the namespace
+        """
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.local = threading.local()
+        # counter name -> increment, and key -> last access time, not stored
+        # yet, see flush
+        self.pending_counts = {}
+        self.pending_accessed = {}
+        self.pending_lock = threading.Lock()
+        self.flushed_at = time.time()
+
+    @property
+    def conn(self):
+        """
+        Database connection for the current thread
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path, timeout=DB_TIMEOUT, isolation_level=None,
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self.local.conn = conn
+        return conn
+
+    def transaction(self):
+        """
+        Start a write transaction, the database is locked for other writers
+        until commit or rollback
+        """
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        return conn
+
+    def get(self, key):
+        """
+        Get the value for the given key
+
+        The lookup is a plain read, the hit/miss counters and the access time
+        (for the eviction) are kept in memory and stored later, see flush.
+
+        :param key: key to look for
+        :returns: the cached value or MISSING if it's not cached or expired
+        """
+        now = time.time()
+        row = self.conn.execute(
+            'SELECT value FROM entries '
+            'WHERE namespace = ? AND key = ? AND expires > ?',
+            (self.namespace, key, now),
+        ).fetchone()
+        name = 'misses' if row is None else 'hits'
+        with self.pending_lock:
+            self.pending_counts[name] = self.pending_counts.get(name, 0) + 1
+            if row is not None:
+                self.pending_accessed[key] = now
+            pending = sum(self.pending_counts.values())
+        if (
+            pending >= FLUSH_LOOKUPS
+            or now - self.flushed_at >= FLUSH_INTERVAL
+        ):
+            self.try_flush()
+        if row is None:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        return json.loads(row[0])
+
+    def flush(self, conn):
+        """
+        Store the pending counters and access times, inside the given write
+        transaction
+        """
+        with self.pending_lock:
+            counts, self.pending_counts = self.pending_counts, {}
+            accessed, self.pending_accessed = self.pending_accessed, {}
+            self.flushed_at = time.time()
+        for name, increment in counts.items():
+            conn.execute(
+                'INSERT OR IGNORE INTO counters VALUES (?, ?, 0)',
+                (self.namespace, name),
+            )
+            conn.execute(
+                'UPDATE counters SET value = value + ? '
+                'WHERE namespace = ? AND name = ?',
+                (increment, self.namespace, name),
+            )
+        conn.executemany(
+            'UPDATE entries SET accessed = MAX(accessed, ?) '
+            'WHERE namespace = ? AND key = ?',
+            [(when, self.namespace, key) for key, when in accessed.items()],
+        )
+
+    def try_flush(self):
+        """
+        Store the pending counters and access times only if the database is
+        not locked by another writer, they are just statistics and hints for
+        the eviction, so they are kept for the next time otherwise (or lost
+        if there's none)
+        """
+        conn = self.conn
+        conn.execute('PRAGMA busy_timeout = 0')
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError:
+            return
+        finally:
+            conn.execute('PRAGMA busy_timeout = %d' % (DB_TIMEOUT * 1000))
+        try:
+            self.flush(conn)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def set(self, key, value, tags=(), ttl=None):
+        """
+        Store a value
+
+        :param key: key to store the value under
+        :param value: json serializable value
+        :param tags: list of tags for the entry, see invalidate_tags
+        :param ttl: seconds to keep the value, the cache ttl if not passed
+        """
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        conn = self.transaction()
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                (self.namespace, key, json.dumps(value), now + ttl, now),
+            )
+            conn.execute(
+                'DELETE FROM tags WHERE namespace = ? AND key = ?',
+                (self.namespace, key),
+            )
+            conn.executemany(
+                'INSERT INTO tags VALUES (?, ?, ?)',
+                [(self.namespace, str(tag), key) for tag in set(tags)],
+            )
+            # the access times are needed to evict the right entries
+            self.flush(conn)
+            self.evict(conn, now)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def evict(self, conn, now):
+        """
+        Remove the expired entries and, if still too many, the least recently
+        used ones
+        """
+        conn.execute(
+            'DELETE FROM entries WHERE namespace = ? AND expires <= ?',
+            (self.namespace, now),
+        )
+        conn.execute(
+            'DELETE FROM entries WHERE namespace = ? AND key IN ('
+            ' SELECT key FROM entries WHERE namespace = ?'
+            ' ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+            (self.namespace, self.namespace, self.max_entries),
+        )
+        conn.execute(
+            'DELETE FROM tags WHERE namespace = ? AND key NOT IN ('
+            ' SELECT key FROM entries WHERE namespace = ?)',
+            (self.namespace, self.namespace),
+        )
+
+    def get_tagged(self, tag):
+        """
+        Get all the non expired values with the given tag
+
+        :param tag: tag to look for
+        :returns list: list of values
+        """
+        rows = self.conn.execute(
+            'SELECT entries.value FROM entries JOIN tags'
+            ' ON entries.namespace = tags.namespace'
+            ' AND entries.key = tags.key'
+            ' WHERE tags.namespace = ? AND tags.tag = ?'
+            ' AND entries.expires > ?',
+            (self.namespace, str(tag), time.time()),
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def invalidate(self, key):
+        """
+        Remove the given key from the cache
+
+        :param key: key to remove
+        """
+        conn = self.transaction()
+        try:
+            conn.execute(
+                'DELETE FROM entries WHERE namespace = ? AND key = ?',
+                (self.namespace, key),
+            )
+            conn.execute(
+                'DELETE FROM tags WHERE namespace = ? AND key = ?',
+                (self.namespace, key),
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def invalidate_tags(self, tags):
+        """
+        Remove all the entries that have any of the given tags
+
+        :param tags: list of tags
+        """
+        tags = [(self.namespace, str(tag)) for tag in set(tags)]
+        if not tags:
+            return
+        conn = self.transaction()
+        try:
+            conn.executemany(
+                'DELETE FROM entries WHERE namespace = ? AND key IN ('
+                ' SELECT key FROM tags WHERE namespace = ? AND tag = ?)',
+                [(namespace, namespace, tag) for namespace, tag in tags],
+            )
+            conn.execute(
+                'DELETE FROM tags WHERE namespace = ? AND key NOT IN ('
+                ' SELECT key FROM entries WHERE namespace = ?)',
+                (self.namespace, self.namespace),
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @contextlib.contextmanager
+    def lock(self, *keys, **kwargs):
+        """
+        Context manager that holds an exclusive lock on the given keys, shared
+        with the other processes and threads, so only one of them gets the
+        values to cache while the others wait for them.
+
+        If the locks can't be taken in time it just logs it and goes on
+        without them, as the only consequence is having duplicated requests.
+
+        :param keys: keys to lock
+        :param timeout: max seconds to wait for the locks, LOCK_TIMEOUT by
+            default
+        """
+        timeout = kwargs.pop('timeout', LOCK_TIMEOUT)
+        lock_dir = os.path.join(os.path.dirname(self.path), 'locks')
+        fds = []
+        try:
+            if not os.path.isdir(lock_dir):
+                os.makedirs(lock_dir, 0o700)
+            deadline = time.time() + timeout
+            # always in the same order to avoid deadlocks
+            for key in sorted(set(keys)):
+                name = hashlib.md5(
+                    '%s:%s' % (self.namespace, key)
+                ).hexdigest()
+                fds.append(os.open(
+                    os.path.join(lock_dir, name),
+                    os.O_CREAT | os.O_RDWR,
+                    0o600,
+                ))
+                self.lock_fd(fds[-1], deadline)
+        except (OSError, IOError) as exc:
+            logger.warning('Unable to lock the cache keys: %s' % exc)
+            for fd in fds:
+                os.close(fd)
+            fds = []
+        try:
+            yield
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    @staticmethod
+    def lock_fd(fd, deadline):
+        """
+        Take an exclusive lock on the given file, retrying until the deadline
+
+        :raises IOError: if the lock could not be taken before the deadline
+        """
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except IOError as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                if time.time() >= deadline:
+                    raise IOError(
+                        exc.errno, 'Timed out waiting for the lock',
+                    )
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    def stats(self):
+        """
+        Get the hit/miss counters
+
+        :returns dict: with the keys 'hits' and 'misses' for this cache
+            object, and 'total_hits' and 'total_misses' for all the processes
+            sharing the cache (the last lookups of the other processes might
+            not be stored yet)
+        """
+        self.try_flush()
+        totals = dict(self.conn.execute(
+            'SELECT name, value FROM counters WHERE namespace = ?',
+            (self.namespace,),
+        ).fetchall())
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'total_hits': totals.get('hits', 0),
+            'total_misses': totals.get('misses', 0),
+        }
@@ -0,0 +1,535 @@
+#!/usr/bin/env python
+"""
+Change index
+=============
+
+Persistent index of the Change-Ids merged in each branch of a repository, so
+checking if a change is in a branch (or in which branches it is) does not
+need to walk the history of the branches.
+
+The index is kept in a sqlite database in the cache dir, shared by all the
+hook processes. Each time it's used, the branch tips are compared with the
+ones it was built from, and only the commits added since then are walked.
+The branches that were rewritten (non fast-forward) are indexed again from
+scratch, and the deleted ones removed.
+
+If gerrit keeps the reviews metadata in the repository (NoteDb, the
+refs/changes/XX/NUMBER/meta refs), the branch, status and Change-Id of each
+review can be indexed too, re-reading only the reviews whose meta ref moved,
+so the open and abandoned changes can be found without asking gerrit. As
+that means going through all the refs/changes, it's never done by the hooks,
+but in the background by the dispatcher daemon (see
+:func:`start_reviews_update`) or from the command line::
+
+    change_index.py update --reviews [--repo GIT_DIR] [--cache-dir DIR]
+
+The updates are done by one process at a time, the readers always see a
+consistent index (sqlite transactions), and never wait for the updates. The
+processes that wait too long for another one to finish an update give up
+(see :class:`IndexBusy`).
+
+API
+====
+"""
+import os
+import re
+import sys
+import time
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+import contextlib
+import cache
+from repository import get_repo
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_DB = 'change-index.db'
+# Seconds to wait for other processes to release the database
+DB_TIMEOUT = 30
+CHANGE_ID_RE = re.compile(r'^Change-Id:\s*(I[0-9a-f]+)\s*$', re.MULTILINE)
+META_REF_RE = re.compile(r'^refs/changes/\d+/(\d+)/meta$')
+# Footers of the NoteDb meta commits, the keys are not capitalized as in the
+# commit messages (Change-id)
+META_FOOTER_RE = re.compile(
+    r'^(Branch|Status|Change-id):\s*(.+?)\s*$', re.MULTILINE | re.IGNORECASE,
+)
+OPEN_STATUSES = ('NEW', 'DRAFT')
+# Max seconds to wait for another process that is updating the index
+LOCK_TIMEOUT = 10
+# Repository path -> thread updating its reviews, see start_reviews_update
+REVIEW_UPDATERS = {}
+REVIEW_UPDATERS_LOCK = threading.Lock()
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS branches ('
+    ' id INTEGER PRIMARY KEY, repo TEXT, name TEXT, tip TEXT,'
+    ' UNIQUE (repo, name))',
+    'CREATE TABLE IF NOT EXISTS changes ('
+    ' change_id TEXT, branch_id INTEGER, sha TEXT,'
+    ' PRIMARY KEY (change_id, branch_id)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS changes_branch_idx ON changes (branch_id)',
+    'CREATE TABLE IF NOT EXISTS reviews ('
+    ' repo TEXT, number INTEGER, meta TEXT, change_id TEXT, branch TEXT,'
+    ' status TEXT, PRIMARY KEY (repo, number))',
+    'CREATE INDEX IF NOT EXISTS reviews_change_idx ON reviews'
+    ' (repo, change_id)',
+    'CREATE TABLE IF NOT EXISTS reviews_updates ('
+    ' repo TEXT PRIMARY KEY, updated_at REAL)',
+)
+
+
+class IndexBusy(Exception):
+    """
+    Raised when the index could not be updated because another process was
+    updating it for too long
+    """
+
+
+def get_change_index(repo_path, conf=None):
+    """
+    Get the change index of the given repository, with the branches up to
+    date, the reviews are updated apart (see start_reviews_update)
+
+    :param repo_path: path to the git repository
+    :param conf: configuration dict, to get the cache dir from
+    :raises IndexBusy: if another process took too long to update it
+    """
+    index = ChangeIndex(
+        path=os.path.join(cache.get_cache_dir(conf), INDEX_DB),
+        repo_path=repo_path,
+    )
+    index.update()
+    return index
+
+
+def start_reviews_update(repo_path, conf=None):
+    """
+    Update the reviews of the given repository in a background thread, if
+    there's none doing it already, for the long running processes (the
+    dispatcher daemon)
+
+    :param repo_path: path to the git repository
+    :param conf: configuration dict, to get the cache dir from
+    """
+    repo_path = os.path.realpath(repo_path)
+
+    def update_worker():
+        try:
+            ChangeIndex(
+                path=os.path.join(cache.get_cache_dir(conf), INDEX_DB),
+                repo_path=repo_path,
+            ).update_reviews()
+        except Exception as exc:
+            logger.warning('Unable to index the reviews: %s' % exc)
+
+    with REVIEW_UPDATERS_LOCK:
+        updater = REVIEW_UPDATERS.get(repo_path)
+        if updater is not None and updater.is_alive():
+            return
+        updater = REVIEW_UPDATERS[repo_path] = threading.Thread(
+            target=update_worker,
+        )
+        updater.daemon = True
+        updater.start()
+
+
+def get_change_ids(message):
+    """
+    Get the Change-Ids of a commit message
+
+    :param message: commit message
+    :returns list: list of Change-Ids
+    """
+    return CHANGE_ID_RE.findall(message)
+
+
+class ChangeIndex(object):
+    """
+    Change-Id -> branches index of a repository
+    """
+    def __init__(self, path, repo_path):
+        """
+        :param path: path to the sqlite database file
+        :param repo_path: path to the git repository
+        """
+        self.path = path
+        self.repo_path = os.path.realpath(repo_path)
+        self.conn = sqlite3.connect(
+            path, timeout=DB_TIMEOUT, isolation_level=None,
+        )
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+
+    def get_indexed_tips(self):
+        """
+        :returns dict: branch name -> tip it was indexed at
+        """
+        return dict(self.conn.execute(
+            'SELECT name, tip FROM branches WHERE repo = ?',
+            (self.repo_path,),
+        ).fetchall())
+
+    def get_indexed_metas(self):
+        """
+        :returns dict: review number -> meta ref sha it was indexed at
+        """
+        return dict(self.conn.execute(
+            'SELECT number, meta FROM reviews WHERE repo = ?',
+            (self.repo_path,),
+        ).fetchall())
+
+    @staticmethod
+    def get_tips(refs):
+        """
+        :param refs: dict with the refs of the repository
+        :returns dict: branch name -> current tip
+        """
+        return dict(
+            (ref[len('refs/heads/'):], sha)
+            for ref, sha in refs.items()
+            if ref.startswith('refs/heads/')
+        )
+
+    @staticmethod
+    def get_metas(refs):
+        """
+        :param refs: dict with the refs of the repository
+        :returns dict: review number -> current meta ref sha
+        """
+        metas = {}
+        for ref, sha in refs.items():
+            match = META_REF_RE.match(ref)
+            if match:
+                metas[int(match.group(1))] = sha
+        return metas
+
+    @contextlib.contextmanager
+    def lock(self, name, timeout=LOCK_TIMEOUT):
+        """
+        Take the lock to update the given part of the index of this
+        repository
+
+        :param name: part of the index, 'branches' or 'reviews'
+        :param timeout: max seconds to wait for it
+        :raises IndexBusy: if it was not released in time
+        """
+        lock_path = '%s.%s.%s.lock' % (
+            self.path, hashlib.md5(self.repo_path).hexdigest(), name,
+        )
+        lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                cache.DiskCache.lock_fd(lock_fd, time.time() + timeout)
+            except IOError as exc:
+                raise IndexBusy(
+                    'Unable to update the %s index of %s: %s'
+                    % (name, self.repo_path, exc)
+                )
+            yield
+        finally:
+            os.close(lock_fd)
+
+    def update(self, timeout=LOCK_TIMEOUT):
+        """
+        Index the commits added to the branches since the last update
+
+        :param timeout: max seconds to wait for another process updating it
+        :raises IndexBusy: if the other process did not finish in time
+        """
+        repo = get_repo(self.repo_path)
+        tips = self.get_tips(repo.get_refs_snapshot('refs/heads/'))
+        if tips == self.get_indexed_tips():
+            return
+        with self.lock('branches', timeout):
+            # others might have updated it while we waited for the lock
+            indexed = self.get_indexed_tips()
+            tips = self.get_tips(repo.get_refs_snapshot('refs/heads/'))
+            for name in set(indexed) - set(tips):
+                logger.debug('Removing deleted branch %s' % name)
+                self.update_branch(name, None, None, [])
+            for name, tip in tips.items():
+                if indexed.get(name) != tip:
+                    self.index_branch(repo, name, indexed.get(name), tip)
+
+    def update_reviews(self, timeout=LOCK_TIMEOUT):
+        """
+        Index the reviews that changed since the last update, it reads all
+        the refs/changes, so it's not meant to be done by the hooks
+
+        :param timeout: max seconds to wait for another process updating them
+        :raises IndexBusy: if the other process did not finish in time
+        """
+        repo = get_repo(self.repo_path)
+        with self.lock('reviews', timeout):
+            self.index_reviews(
+                repo, self.get_metas(repo.get_refs_snapshot('refs/changes/')),
+            )
+
+    def index_branch(self, repo, name, old_tip, new_tip):
+        """
+        Index the new commits of a branch, or all of them if it's new or
+        was rewritten
+        """
+        if old_tip and old_tip not in repo.object_store:
+            # rewritten and garbage collected already
+            old_tip = None
+        changes = []
+        fast_forward = False
+        walker = repo.get_walker(
+            include=[new_tip],
+            exclude=[old_tip] if old_tip else [],
+        )
+        for entry in walker:
+            commit = entry.commit
+            if old_tip in commit.parents:
+                fast_forward = True
+            for change_id in get_change_ids(commit.message):
+                changes.append((change_id, commit.id))
+        if old_tip and not fast_forward:
+            logger.info('Branch %s was rewritten, indexing it again' % name)
+            changes = [
+                (change_id, entry.commit.id)
+                for entry in repo.get_walker(include=[new_tip])
+                for change_id in get_change_ids(entry.commit.message)
+            ]
+        self.update_branch(
+            name, old_tip if fast_forward else None, new_tip, changes,
+        )
+
+    def update_branch(self, name, old_tip, new_tip, changes):
+        """
+        Write the changes of a branch to the index
+
+        :param name: branch name
+        :param old_tip: tip the changes were walked from, None if they are
+            all the branch changes
+        :param new_tip: new tip of the branch, None to remove it
+        :param changes: list of (Change-Id, commit sha) to add
+        """
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute(
+                'SELECT id FROM branches WHERE repo = ? AND name = ?',
+                (self.repo_path, name),
+            ).fetchone()
+            if row is None:
+                branch_id = self.conn.execute(
+                    'INSERT INTO branches (repo, name) VALUES (?, ?)',
+                    (self.repo_path, name),
+                ).lastrowid
+            else:
+                branch_id = row[0]
+            if old_tip is None:
+                self.conn.execute(
+                    'DELETE FROM changes WHERE branch_id = ?', (branch_id,),
+                )
+            if new_tip is None:
+                self.conn.execute(
+                    'DELETE FROM branches WHERE id = ?', (branch_id,),
+                )
+            else:
+                # the walk goes from newest to oldest, keep the newest
+                # commit of each change
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO changes VALUES (?, ?, ?)',
+                    [(change_id, branch_id, sha)
+                     for change_id, sha in changes],
+                )
+                self.conn.execute(
+                    'UPDATE branches SET tip = ? WHERE id = ?',
+                    (new_tip, branch_id),
+                )
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def index_reviews(self, repo, metas):
+        """
+        Index the reviews whose meta ref changed, and remove the deleted ones
+
+        :param metas: dict with the current review number -> meta ref sha
+        """
+        indexed = self.get_indexed_metas()
+        deleted = [
+            (self.repo_path, number)
+            for number in set(indexed) - set(metas)
+        ]
+        reviews = [
+            (self.repo_path, number, meta) + self.read_review(repo, meta)
+            for number, meta in metas.items()
+            if indexed.get(number) != meta
+        ]
+        logger.debug('Indexing %d reviews' % len(reviews))
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany(
+                'DELETE FROM reviews WHERE repo = ? AND number = ?', deleted,
+            )
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO reviews VALUES (?, ?, ?, ?, ?, ?)',
+                reviews,
+            )
+            self.conn.execute(
+                'INSERT OR REPLACE INTO reviews_updates VALUES (?, ?)',
+                (self.repo_path, time.time()),
+            )
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def read_review(repo, meta):
+        """
+        Get the current state of a review from the history of its meta ref,
+        the newest footers win
+
+        :returns tuple: Change-Id, branch name, status (as in the gerrit
+            queries, like NEW or MERGED)
+        """
+        state = {}
+        for entry in repo.get_walker(include=[meta]):
+            for key, value in META_FOOTER_RE.findall(entry.commit.message):
+                state.setdefault(key.lower(), value)
+        branch = state.get('branch')
+        if branch and branch.startswith('refs/heads/'):
+            branch = branch[len('refs/heads/'):]
+        return (
+            state.get('change-id'),
+            branch,
+            state.get('status', 'new').upper(),
+        )
+
+    def has_reviews(self, max_age=None):
+        """
+        Check if the reviews of the repository are indexed, that is, if
+        gerrit keeps their metadata in it, and were updated recently
+
+        :param max_age: max seconds since the last reviews update, None to
+            accept any
+        """
+        row = self.conn.execute(
+            'SELECT updated_at FROM reviews_updates WHERE repo = ?',
+            (self.repo_path,),
+        ).fetchone()
+        if row is None:
+            return False
+        if max_age is not None and time.time() - row[0] > max_age:
+            return False
+        return self.conn.execute(
+            'SELECT 1 FROM reviews WHERE repo = ? LIMIT 1', (self.repo_path,),
+        ).fetchone() is not None
+
+    def get_changes(self, change_id, with_reviews=True):
+        """
+        Get the changes with the given Change-Id, one per branch, as the
+        gerrit queries return them (only with the id, number, branch, status
+        and open keys)
+
+        The branches that have the change merged are reported as MERGED, even
+        if there's no review for them (direct pushes, branches created after
+        the change was merged...).
+
+        :param change_id: Change-Id to look for
+        :param with_reviews: if False, only the merged changes are returned,
+            for when the indexed reviews are not up to date
+        :returns list: list of change dicts
+        """
+        changes = {}
+        rows = []
+        if with_reviews:
+            rows = self.conn.execute(
+                'SELECT number, branch, status FROM reviews'
+                ' WHERE repo = ? AND change_id = ? ORDER BY number',
+                (self.repo_path, change_id),
+            ).fetchall()
+        for number, branch, status in rows:
+            changes[branch] = {
+                'id': change_id,
+                'number': number,
+                'branch': branch,
+                'status': status,
+                'open': status in OPEN_STATUSES,
+            }
+        for branch in self.get_branches(change_id):
+            change = changes.setdefault(branch, {
+                'id': change_id,
+                'branch': branch,
+            })
+            change.update(status='MERGED', open=False)
+        return changes.values()
+
+    def get_branches(self, change_id):
+        """
+        Get the branches that have the given change
+
+        :param change_id: Change-Id to look for
+        :returns dict: branch name -> sha of the commit with the change
+        """
+        return dict(self.conn.execute(
+            'SELECT branches.name, changes.sha FROM changes JOIN branches'
+            ' ON changes.branch_id = branches.id'
+            ' WHERE branches.repo = ? AND changes.change_id = ?',
+            (self.repo_path, change_id),
+        ).fetchall())
+
+    def has_change(self, branch, change_id):
+        """
+        Check if the given branch has the given change
+
+        :param branch: branch name, with or without the refs/heads/ prefix
+        :param change_id: Change-Id to look for
+        """
+        if branch.startswith('refs/heads/'):
+            branch = branch[len('refs/heads/'):]
+        return self.conn.execute(
+            'SELECT 1 FROM changes JOIN branches'
+            ' ON changes.branch_id = branches.id'
+            ' WHERE branches.repo = ? AND branches.name = ?'
+            ' AND changes.change_id = ?',
+            (self.repo_path, branch, change_id),
+        ).fetchone() is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Update the change index of a repository',
+    )
+    parser.add_argument('action', choices=['update'])
+    parser.add_argument(
+        '--repo', default=os.environ.get('GIT_DIR', '.'),
+        help='Repository to index, $GIT_DIR by default',
+    )
+    parser.add_argument(
+        '--reviews', action='store_true',
+        help='Index also the reviews metadata kept by gerrit (NoteDb)',
+    )
+    parser.add_argument(
+        '--cache-dir', default=None,
+        help='Cache dir with the index, the default hooks cache dir if not '
+        'passed',
+    )
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s::%(levelname)s::%(name)s::%(message)s',
+    )
+    conf = {'HOOKS_CACHE_DIR': args.cache_dir}
+    try:
+        index = get_change_index(args.repo, conf)
+        if args.reviews:
+            index.update_reviews()
+    except IndexBusy as exc:
+        logger.error(exc)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -33,10 +33,22 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-CONF_FILES = [
-    pjoin(dirname(abspath(__file__)), '..', 'config'),
-    pjoin(os.environ.get('GIT_DIR', ''), 'hooks', 'config'),
-]
+def get_conf_files(git_dir=None):
+    """
+    Get the list of config files to load, less prioritary first
+
+    :param git_dir: path to the git repository, if not passed it will use the
+        GIT_DIR environment variable at the time of the call
+    """
+    if git_dir is None:
+        git_dir = os.environ.get('GIT_DIR', '')
+    return [
+        pjoin(dirname(abspath(__file__)), '..', 'config'),
+        pjoin(git_dir, 'hooks', 'config'),
+    ]
+
+
+CONF_FILES = get_conf_files()
 
 
 def unquote(string):
@@ -81,5 +93,11 @@ class Config(dict):
             raise
 
 
-def load_config():
-    return Config(CONF_FILES)
+def load_config(git_dir=None):
+    """
+    Load the configuration for the given git repository
+
+    :param git_dir: path to the git repository, if not passed it will use the
+        GIT_DIR environment variable
+    """
+    return Config(get_conf_files(git_dir))
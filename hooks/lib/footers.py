@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Commit footers
+===============
+
+Parser for the footers of the commit messages that the hooks care about
+(Bug-Url, Change-Id, Related-To, Ignore-Hooks and Run-Only-Hooks), the
+message is scanned once and the result kept per commit, so the dispatcher
+and all the hooks of an event share it.
+
+Can be run from the command line, for the bash hooks, to print the values of
+a footer of a commit (one per line), exiting with 1 if it has none::
+
+    footers.py [--git-dir DIR] COMMIT FOOTER
+
+API
+====
+"""
+import os
+import re
+import sys
+import argparse
+import threading
+import subprocess
+from collections import OrderedDict
+
+
+# The url of a Bug-Url can also be in the next line
+FOOTER_RE = re.compile(
+    r'^(?:(Bug-Url):[ \t]*(?:\r?\n[ \t]*(?=https?:))?'
+    r'|(Change-Id|Related-To|Ignore-Hooks|Run-Only-Hooks):[ \t]*)'
+    r'(.*?)[ \t\r]*$',
+    re.MULTILINE | re.IGNORECASE,
+)
+# The footers paragraph starts after the last blank line
+BLANK_LINES_RE = re.compile(r'(?:\r?\n){2,}')
+BUG_ID_RE = re.compile(r'\d+\b')
+SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+# Footers that are taken into account only in the last paragraph
+FOOTER_ONLY = ('bug-url',)
+# Max number of parsed messages to keep, see get_footers
+MAX_CACHED = 100
+# commit sha (or message) -> footers
+FOOTERS_CACHE = OrderedDict()
+FOOTERS_LOCK = threading.Lock()
+
+
+def get_footers(message, sha=None):
+    """
+    Get the footers of a commit message, parsing it only the first time
+
+    :param message: commit message
+    :param sha: sha of the commit, to identify the message by
+    :returns: :class:`Footers`
+    """
+    return get_cached(sha or message, lambda: message)
+
+
+def get_commit_footers(commit, git_dir=None):
+    """
+    Get the footers of a commit of the repository
+
+    :param commit: sha of the commit, or any name git can resolve to it
+    :param git_dir: path to the git repository, GIT_DIR env var by default
+    :returns: :class:`Footers`
+    """
+    # import here, bz.py uses this module and does not need dulwich
+    from repository import get_repo
+
+    git_dir = git_dir or os.environ['GIT_DIR']
+    if not SHA_RE.match(commit):
+        commit = subprocess.check_output(
+            ['git', '--git-dir', git_dir, 'rev-parse', '--verify',
+             commit + '^{commit}'],
+        ).strip()
+    return get_cached(commit, lambda: get_repo(git_dir)[commit].message)
+
+
+def get_cached(key, get_message):
+    """
+    Get the footers for the given key from the cache, parsing the message
+    returned by get_message if they are not there
+    """
+    with FOOTERS_LOCK:
+        footers = FOOTERS_CACHE.pop(key, None)
+        if footers is None:
+            footers = Footers(get_message())
+            if len(FOOTERS_CACHE) >= MAX_CACHED:
+                FOOTERS_CACHE.popitem(last=False)
+        FOOTERS_CACHE[key] = footers
+        return footers
+
+
+def get_bug_id(bug_url):
+    """
+    :param bug_url: bug url, like https://bugzilla.redhat.com/123456
+    :returns: the bug id, or None if the url has none
+    """
+    match = BUG_ID_RE.search(bug_url)
+    return match.group() if match else None
+
+
+class Footers(object):
+    """
+    Footers of a commit message, the ones that can be repeated are lists,
+    for the others only the last one is kept (None if there's none)
+    """
+    def __init__(self, message):
+        """
+        :param message: commit message
+        """
+        self.bug_urls = []
+        self.change_ids = []
+        self.related_to = []
+        self.ignore_hooks = None
+        self.run_only_hooks = None
+        message = message.strip()
+        last_paragraph = 0
+        for match in BLANK_LINES_RE.finditer(message):
+            last_paragraph = match.end()
+        for match in FOOTER_RE.finditer(message):
+            key = (match.group(1) or match.group(2)).lower()
+            value = match.group(3)
+            if key in FOOTER_ONLY and match.start() < last_paragraph:
+                continue
+            if key == 'bug-url':
+                self.bug_urls.append(value)
+            elif key == 'change-id':
+                self.change_ids.append(value)
+            elif key == 'related-to':
+                self.related_to.append(value)
+            elif key == 'ignore-hooks':
+                self.ignore_hooks = value
+            else:
+                self.run_only_hooks = value
+
+    def get(self, name):
+        """
+        Get the values of a footer by its name
+
+        :param name: footer name, like Bug-Url (case insensitive)
+        :returns list: list with the values, empty if there's none
+        """
+        name = name.lower()
+        if name == 'bug-url':
+            return self.bug_urls
+        if name == 'change-id':
+            return self.change_ids
+        if name == 'related-to':
+            return self.related_to
+        if name == 'ignore-hooks':
+            value = self.ignore_hooks
+        elif name == 'run-only-hooks':
+            value = self.run_only_hooks
+        else:
+            raise ValueError('Unknown footer %s' % name)
+        return [] if value is None else [value]
+
+    def get_bug_urls(self, bz_server):
+        """
+        Get the bug urls of the given bugzilla server
+
+        :param bz_server: bugzilla server url, like
+            https://bugzilla.redhat.com
+        :returns list: list of bug urls
+        """
+        url_re = re.compile(
+            r'^https*:\/\/' + re.escape(bz_server.split('//')[-1])
+            + r'\/.*\d+\b',
+            re.IGNORECASE,
+        )
+        return [
+            match.group() for match in
+            (url_re.match(url) for url in self.bug_urls)
+            if match
+        ]
+
+    def get_bug_ids(self, bz_server):
+        """
+        Get the ids of the bugs of the given bugzilla server
+
+        :param bz_server: bugzilla server url
+        :returns set: set of bug ids
+        """
+        return set(get_bug_id(url) for url in self.get_bug_urls(bz_server))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print the values of a footer of a commit, one per line, '
+        'exits with 1 if the commit does not have it',
+    )
+    parser.add_argument(
+        '--git-dir', default=None,
+        help='Repository with the commit, $GIT_DIR by default',
+    )
+    parser.add_argument('commit')
+    parser.add_argument(
+        'footer',
+        help='Bug-Url, Change-Id, Related-To, Ignore-Hooks or Run-Only-Hooks',
+    )
+    args = parser.parse_args()
+    values = get_commit_footers(args.commit, args.git_dir).get(args.footer)
+    for value in values:
+        print value
+    return 0 if values else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
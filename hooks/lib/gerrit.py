@@ -1,26 +1,344 @@
 #!/usr/bin/env python
 # encoding: utf-8
+import os
 import subprocess
 import json
+import tempfile
 import logging
+import hashlib
+import fcntl
+import time
+import cache
 
 logger = logging.getLogger(__name__)
 
+GERRIT_PORT = '29418'
+SSH_OPTIONS = (
+    '-o', 'UserKnownHostsFile=/dev/null',
+    '-o', 'StrictHostKeyChecking=no',
+)
+# Where to keep the ssh master connection sockets, shared by all the hook
+# processes of the same user
+DEFAULT_CONTROL_DIR = os.path.join(
+    os.path.expanduser('~'), '.ssh', 'gerrit-hooks'
+)
+# Seconds the master connection is kept open after the last command
+DEFAULT_CONTROL_PERSIST = 600
+# Seconds between health checks of the master connection
+MASTER_CHECK_INTERVAL = 60
+# Max seconds to wait for the master connection to start, or for another
+# process that is starting it, before falling back to a plain ssh command
+MASTER_TIMEOUT = 10
+MASTER_LOCK_POLL_INTERVAL = 0.1
+# Max seconds to wait for the server to accept the connection of a circuit
+# breaker probe, and to answer it once connected (keepalives interval times
+# max missed ones)
+PROBE_TIMEOUT = 10
+PROBE_ALIVE_INTERVAL = 5
+PROBE_ALIVE_COUNT = 2
+# Boolean options of the gerrit query command, as keyword arguments
+QUERY_FLAGS = (
+    'all_approvals', 'all_reviewers', 'comment', 'commit_message',
+    'current_patch_set', 'dependencies', 'files', 'patch_sets',
+    'submit_records',
+)
+# Limits for the OR'ed queries built by Gerrit.query_many
+QUERY_CHUNK_SIZE = 50
+MAX_QUERY_LENGTH = 2000
+# Name of the query results cache, see get_query_cache
+QUERY_CACHE_NAMESPACE = 'gerrit-query'
+# Return code of ssh when it can't reach the server
+SSH_ERROR = 255
+
+
+class CommandError(Exception):
+    """
+    A gerrit command failed
+    """
+    def __init__(self, cmd, returncode, err):
+        """
+        :param cmd: command line that failed
+        :param returncode: return code of the command
+        :param err: error output of the command
+        """
+        super(CommandError, self).__init__(
+            "Execution of %s returned %d:\n%s"
+            % (' '.join(cmd), returncode, err)
+        )
+        self.returncode = returncode
+
+
+def get_query_cache(conf):
+    """
+    Get the shared query results cache from the configuration
+
+    It's enabled by setting GERRIT_CACHE_TTL to the number of seconds to keep
+    the results, GERRIT_CACHE_SIZE sets the max number of cached queries.
+
+    :param conf: configuration dict
+    :returns: the cache, or None if it's disabled
+    """
+    ttl = int(conf.get('GERRIT_CACHE_TTL') or 0)
+    if ttl <= 0:
+        return None
+    return cache.get_cache(
+        conf,
+        namespace=QUERY_CACHE_NAMESPACE,
+        ttl=ttl,
+        max_entries=int(
+            conf.get('GERRIT_CACHE_SIZE') or cache.DEFAULT_MAX_ENTRIES
+        ),
+    )
+
 
 class Gerrit(object):
-    def __init__(self, server):
+    """
+    Gerrit ssh cli wrapper
+
+    All the commands to the same server go through a shared ssh master
+    connection (ControlMaster), so only the first one pays for the ssh
+    handshake. The master is started on demand, shared between all the
+    processes that use the same control dir, and exits by itself after
+    `control_persist` seconds without use.
+
+    If a cache is passed, the json results of `query` are stored there, so
+    the same query done by other hooks (or processes) is answered without
+    going to the server until it expires or the change is reviewed.
+
+    If a circuit breaker is passed, the commands that fail to reach the
+    server are counted there, and after too many of them the commands raise
+    :class:`breaker.CircuitOpen` right away instead of waiting for ssh.
+
+    If a retry policy is passed, the queries that fail to reach the server
+    are retried, and the slow ones hedged, as set in the policy. The reviews
+    are never retried, as ssh can't tell if they were done.
+    """
+    def __init__(self, server, multiplex=True, control_dir=None,
+                 control_persist=DEFAULT_CONTROL_PERSIST, cache=None,
+                 breaker=None, policy=None):
+        """
+        :param server: gerrit server, as in user@gerrit.server
+        :param multiplex: if False, use a new ssh connection for each command
+        :param control_dir: directory to create the master sockets in
+        :param control_persist: seconds to keep the master connection idle
+        :param cache: :class:`cache.DiskCache` for the query results
+        :param breaker: :class:`breaker.CircuitBreaker` for the server
+        :param policy: :class:`retry.RetryPolicy` for the queries
+        """
         self.server = server
+        self.cache = cache
+        self.breaker = breaker
+        self.control_persist = control_persist
+        self.control_path = None
+        self.master_checked_at = 0
+        self.master_up = False
+        if multiplex:
+            self.control_path = self.get_control_path(
+                control_dir or DEFAULT_CONTROL_DIR
+            )
+        mux_options = ()
+        if self.control_path:
+            mux_options = (
+                '-o', 'ControlMaster=no',
+                '-o', 'ControlPath=%s' % self.control_path,
+            )
         self.cmd = (
-            'ssh',
-            '-o', 'UserKnownHostsFile=/dev/null',
-            '-o', 'StrictHostKeyChecking=no',
+            ('ssh',) + SSH_OPTIONS + mux_options
+            + (self.server, '-p', GERRIT_PORT, 'gerrit')
+        )
+        # used while the master connection is down
+        self.plain_cmd = (
+            ('ssh',) + SSH_OPTIONS
+            + (self.server, '-p', GERRIT_PORT, 'gerrit')
+        )
+        if breaker is not None and breaker.probe is None:
+            breaker.probe = self.probe
+        self.policy = policy
+        if policy is not None:
+            policy.transient = policy.transient or self.is_transient
+
+    def get_control_path(self, control_dir):
+        """
+        Get the master socket path for this server, creating the control dir
+        if needed
+
+        :param control_dir: directory to create the socket in
+        :returns str: socket path or None if multiplexing can't be used
+        """
+        try:
+            if not os.path.isdir(control_dir):
+                os.makedirs(control_dir, 0o700)
+        except OSError as err:
+            logger.warn("Unable to create the ssh control dir %s, not "
+                        "multiplexing the gerrit connections: %s"
+                        % (control_dir, err))
+            return None
+        # unix socket paths are short, so use a hash instead of the server
+        name = hashlib.md5(self.server + ':' + GERRIT_PORT).hexdigest()[:16]
+        return os.path.join(control_dir, name)
+
+    def ssh_control(self, command):
+        """
+        Send a control command to the master connection
+
+        :param command: control command, like 'check' or 'exit'
+        :returns bool: True if the command succeeded
+        """
+        with open(os.devnull, 'r+') as devnull:
+            return subprocess.call(
+                ('ssh',) + SSH_OPTIONS + (
+                    '-o', 'ControlPath=%s' % self.control_path,
+                    '-O', command,
+                    '-p', GERRIT_PORT,
+                    self.server,
+                ),
+                stdin=devnull, stdout=devnull, stderr=devnull,
+            ) == 0
+
+    def check_master(self):
+        """
+        Check if the master connection is up and healthy
+        """
+        return bool(self.control_path) and self.ssh_control('check')
+
+    def ensure_master(self):
+        """
+        Make sure that there's a healthy master connection to the server,
+        starting a new one if needed. It's safe to call from concurrent
+        processes, only one of them will start the master, the others wait
+        for it up to MASTER_TIMEOUT seconds.
+
+        :returns bool: True if the master connection can be used
+        """
+        if not self.control_path:
+            return False
+        if time.time() - self.master_checked_at < MASTER_CHECK_INTERVAL:
+            return self.master_up
+        with open(self.control_path + '.lock', 'a') as lock_fd:
+            if not self.lock_master(lock_fd):
+                logger.warn("Timed out waiting for the ssh master connection "
+                            "to %s, using a new connection" % self.server)
+                return False
+            try:
+                self.master_up = self.check_master() or self.start_master()
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        self.master_checked_at = time.time()
+        return self.master_up
+
+    @staticmethod
+    def lock_master(lock_fd):
+        """
+        Take the master lock, waiting up to MASTER_TIMEOUT seconds for it
+
+        :returns bool: True if it was taken
+        """
+        deadline = time.time() + MASTER_TIMEOUT
+        while True:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError:
+                if time.time() >= deadline:
+                    return False
+            time.sleep(MASTER_LOCK_POLL_INTERVAL)
+
+    def start_master(self):
+        """
+        Start a new background master connection, removing any stale socket,
+        if the server can't be reached it's reported to the circuit breaker
+
+        :returns bool: True if it was started
+        """
+        if os.path.exists(self.control_path):
+            logger.debug("Removing stale ssh master socket %s"
+                         % self.control_path)
+            os.unlink(self.control_path)
+        master_cmd = ('ssh',) + SSH_OPTIONS + (
+            '-o', 'ControlMaster=yes',
+            '-o', 'ControlPath=%s' % self.control_path,
+            '-o', 'ControlPersist=%d' % self.control_persist,
+            '-o', 'ConnectTimeout=%d' % MASTER_TIMEOUT,
+            '-N', '-f',
+            '-p', GERRIT_PORT,
             self.server,
-            '-p', '29418',
-            'gerrit',
         )
+        logger.debug("Starting ssh master connection %s"
+                     % ' '.join(master_cmd))
+        # the master goes to the background, make sure it does not keep any
+        # of our pipes open
+        with open(os.devnull, 'r+') as devnull:
+            returncode = subprocess.call(
+                master_cmd, stdin=devnull, stdout=devnull, stderr=devnull,
+            )
+        if returncode:
+            logger.warn("Unable to start the ssh master connection to "
+                        "%s, using a new connection for each command"
+                        % self.server)
+            self.report_result(returncode)
+        return returncode == 0
+
+    def close_master(self):
+        """
+        Stop the master connection, if running
+        """
+        if self.check_master():
+            self.ssh_control('exit')
+        self.master_checked_at = 0
+
+    def report_result(self, returncode):
+        """
+        Tell the circuit breaker, if any, if a command reached the server
+
+        :param returncode: return code of the ssh command
+        """
+        if self.breaker is None:
+            return
+        if returncode == SSH_ERROR:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    @staticmethod
+    def is_transient(exc):
+        """
+        Check if a failed query is worth retrying, only if ssh failed
+        """
+        return (
+            isinstance(exc, CommandError)
+            and exc.returncode == SSH_ERROR
+        )
+
+    def probe(self):
+        """
+        Check if the server answers, for the circuit breaker, with a new
+        connection that gives up if the server does not answer in time
+
+        :returns bool: True if it does
+        """
+        probe_cmd = ('ssh',) + SSH_OPTIONS + (
+            '-o', 'ConnectTimeout=%d' % PROBE_TIMEOUT,
+            '-o', 'ServerAliveInterval=%d' % PROBE_ALIVE_INTERVAL,
+            '-o', 'ServerAliveCountMax=%d' % PROBE_ALIVE_COUNT,
+            self.server, '-p', GERRIT_PORT, 'gerrit', 'version',
+        )
+        with open(os.devnull, 'r+') as devnull:
+            return subprocess.call(
+                probe_cmd,
+                stdin=devnull,
+                stdout=devnull,
+                stderr=devnull,
+            ) == 0
 
     def generate_cmd(self, action, *options):
-        cmd = list(self.cmd)
+        """
+        Build the ssh command line for the given gerrit action
+
+        :raises breaker.CircuitOpen: if the server is known to be unreachable
+        """
+        if self.breaker is not None:
+            self.breaker.before_call()
+        cmd = list(self.cmd if self.ensure_master() else self.plain_cmd)
         cmd.append(action)
         cmd.extend(options)
         return cmd
@@ -44,11 +362,10 @@ class Gerrit(object):
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE)
         out, err = cmd.communicate()
+        self.report_result(cmd.returncode)
         if cmd.returncode:
-            raise Exception("Execution of %s returned %d:\n%s"
-                            % (' '.join(gerrit_cmd),
-                               cmd.returncode,
-                               err))
+            raise CommandError(gerrit_cmd, cmd.returncode, err)
+        self.invalidate_cache(commit)
         return 0
 
     def query(
@@ -57,25 +374,35 @@ class Gerrit(object):
         dependencies=False, files=False, patch_sets=False, start=0,
         submit_records=False, out_format='json'
     ):
-        cmd_params = [
-            '--format=%s' % out_format,
-            '--start=%d' % start,
-        ]
-        flags = [
-            'all_approvals', 'all_reviewers', 'comment', 'commit_message',
-            'current_patch_set', 'dependencies', 'files', 'patch_sets',
-            'submit_records'
-        ]
-        for flag in flags:
-            if vars().get(flag, False):
-                cmd_params.append('--' + flag.replace('_', '-'))
-        cmd_params.extend([
-            '--',
-            query
-        ])
-        gerrit_cmd = self.generate_cmd(
-            'query',
-            *cmd_params
+        flags = dict(
+            (flag, value) for flag, value in locals().items()
+            if flag in QUERY_FLAGS
+        )
+        if self.cache is None or out_format != 'json':
+            return self.run_query(query, start, out_format, **flags)
+        key = self.get_cache_key(query, start, **flags)
+        res = cache.safe_call(self.cache.get, key)
+        if res is cache.MISSING or res is None:
+            res = self.run_query(query, start, out_format, **flags)
+            cache.safe_call(
+                self.cache.set, key, res,
+                tags=self.get_cache_tags(query, res),
+            )
+        return res
+
+    def run_query(self, query, start=0, out_format='json', **flags):
+        """
+        Run a query on the server, see query for the parameters
+        """
+        if self.policy is None:
+            return self.do_run_query(query, start, out_format, flags)
+        return self.policy.read(
+            'query', self.do_run_query, query, start, out_format, flags,
+        )
+
+    def do_run_query(self, query, start, out_format, flags):
+        gerrit_cmd = self.generate_query_cmd(
+            query, start=start, out_format=out_format, **flags
         )
         logger.debug("Executing %s" % ' '.join(gerrit_cmd))
         cmd = subprocess.Popen(
@@ -84,15 +411,9 @@ class Gerrit(object):
             stderr=subprocess.PIPE,
         )
         out, err = cmd.communicate()
+        self.report_result(cmd.returncode)
         if cmd.returncode:
-            raise Exception(
-                "Execution of %s returned %d:\n%s"
-                % (
-                    ' '.join(gerrit_cmd),
-                    cmd.returncode,
-                    err
-                )
-            )
+            raise CommandError(gerrit_cmd, cmd.returncode, err)
         if out_format == 'json':
             res = []
             try:
@@ -105,14 +426,390 @@ class Gerrit(object):
             res = out
         return res
 
+    def get_cache_key(self, query, start=0, **flags):
+        """
+        Get the cache key for a query, made of the server, the query and the
+        flags
+        """
+        return json.dumps([
+            self.server,
+            query,
+            start,
+            sorted(flag for flag in QUERY_FLAGS if flags.get(flag)),
+        ])
+
+    @staticmethod
+    def get_cache_tags(query, rows):
+        """
+        Get the tags to invalidate a query result by, that is the query
+        itself plus the numbers, Change-Ids and revisions of the changes in
+        the result
+
+        :param query: query string
+        :param rows: json result of the query
+        """
+        tags = set([query])
+        for row in rows:
+            if row.get('type') == 'stats':
+                continue
+            tags.update(
+                str(row[field]) for field in ('number', 'id') if field in row
+            )
+            patchsets = list(row.get('patchSets', []))
+            if 'currentPatchSet' in row:
+                patchsets.append(row['currentPatchSet'])
+            tags.update(
+                patchset['revision'] for patchset in patchsets
+                if 'revision' in patchset
+            )
+        return tags
+
+    def invalidate_cache(self, commit):
+        """
+        Remove from the cache all the query results for the change of the
+        given commit
+
+        :param commit: commit hash or change,patchset as passed to review,
+            where change can also be the project~branch~Change-Id triplet
+        """
+        if self.cache is None:
+            return
+        change = commit.split(',')[0]
+        tags = set([commit, change, change.split('~')[-1]])
+        # The cached rows for the commit also give the change number and
+        # id, for the results of queries by them
+        for rows in cache.safe_call(self.cache.get_tagged, commit) or []:
+            tags.update(self.get_cache_tags(commit, rows))
+        cache.safe_call(self.cache.invalidate_tags, tags)
+
+    def generate_query_cmd(self, query, start=0, out_format='json',
+                           **flags):
+        """
+        Build the command line for a gerrit query
+
+        :param query: gerrit query string
+        :param start: number of results to skip
+        :param out_format: output format, 'json' or 'text'
+        :param flags: any of the QUERY_FLAGS, set to True to pass them
+        """
+        cmd_params = [
+            '--format=%s' % out_format,
+            '--start=%d' % start,
+        ]
+        for flag in QUERY_FLAGS:
+            if flags.get(flag, False):
+                cmd_params.append('--' + flag.replace('_', '-'))
+        cmd_params.extend([
+            '--',
+            query
+        ])
+        return self.generate_cmd('query', *cmd_params)
+
+    def iter_query(self, query, start=0, stats=None, **flags):
+        """
+        Lazily iterate over all the results of a query, following the
+        pagination of the server.
+
+        The results are decoded as ssh outputs them, so they are never all
+        in memory, and if the caller stops iterating the running query is
+        killed. The stats rows are not yielded, if `stats` is passed it will
+        be updated with the ones of the last page, plus the total number of
+        rows under the 'totalRowCount' key.
+
+        :param query: gerrit query string
+        :param start: number of results to skip
+        :param stats: dict to store the query stats into
+        :param flags: any of the QUERY_FLAGS, set to True to pass them
+        """
+        stats = stats if stats is not None else {}
+        stats['totalRowCount'] = 0
+        while True:
+            page_stats = {}
+            for row in self.iter_query_page(query, start, page_stats,
+                                            **flags):
+                yield row
+            stats.update(page_stats)
+            row_count = page_stats.get('rowCount', 0)
+            stats['totalRowCount'] += row_count
+            if not page_stats.get('moreChanges') or not row_count:
+                return
+            start += row_count
+
+    def iter_query_page(self, query, start, stats, **flags):
+        """
+        Lazily iterate over one page of results of a query
+
+        :param query: gerrit query string
+        :param start: number of results to skip
+        :param stats: dict to store the stats row of the page into
+        :param flags: any of the QUERY_FLAGS, set to True to pass them
+        """
+        gerrit_cmd = self.generate_query_cmd(query, start=start, **flags)
+        logger.debug("Executing %s" % ' '.join(gerrit_cmd))
+        # stderr to a file, so a chatty ssh never blocks us reading stdout
+        with tempfile.TemporaryFile() as err_fd:
+            cmd = subprocess.Popen(
+                gerrit_cmd,
+                stdout=subprocess.PIPE,
+                stderr=err_fd,
+            )
+            finished = False
+            try:
+                for line in iter(cmd.stdout.readline, ''):
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        logger.error("Unable to decode json from:\n%s"
+                                     % line)
+                        raise
+                    if row.get('type') == 'stats':
+                        stats.update(row)
+                        continue
+                    yield row
+                finished = True
+            finally:
+                if not finished and cmd.poll() is None:
+                    # stopped before the end, no need for the rest, after
+                    # the end just wait for ssh to exit by itself
+                    cmd.kill()
+                cmd.stdout.close()
+                cmd.wait()
+                self.report_result(cmd.returncode)
+            if cmd.returncode:
+                err_fd.seek(0)
+                raise CommandError(gerrit_cmd, cmd.returncode, err_fd.read())
+
+    @staticmethod
+    def chunk_query_terms(terms, chunk_size=QUERY_CHUNK_SIZE,
+                          max_query_len=MAX_QUERY_LENGTH):
+        """
+        Split the given query terms in groups that can be OR'ed together
+        without exceeding the given limits
+
+        :param terms: list of query terms, as in ['change:1234', ...]
+        :param chunk_size: max number of terms per group
+        :param max_query_len: max length of the OR'ed terms of each group
+        :returns list: list of lists of terms
+        """
+        chunks = []
+        cur_chunk = []
+        cur_len = 0
+        for term in terms:
+            term_len = len(term) + len(' OR ')
+            if cur_chunk and (
+                len(cur_chunk) >= chunk_size
+                or cur_len + term_len > max_query_len
+            ):
+                chunks.append(cur_chunk)
+                cur_chunk, cur_len = [], 0
+            cur_chunk.append(term)
+            cur_len += term_len
+        if cur_chunk:
+            chunks.append(cur_chunk)
+        return chunks
+
+    def query_many(self, idents, extra_query=None,
+                   chunk_size=QUERY_CHUNK_SIZE,
+                   max_query_len=MAX_QUERY_LENGTH, **kwargs):
+        """
+        Get the changes for many change numbers and/or Change-Ids using as
+        few queries as possible
+
+        :param idents: list of change numbers or Change-Ids
+        :param extra_query: query to AND with the idents, like
+            'project:ovirt-engine'
+        :param chunk_size: max number of idents per query
+        :param max_query_len: max length of the OR'ed idents of each query
+        :param kwargs: any other options to pass to Gerrit.iter_query
+        :returns dict: ident -> list of changes matching it (a Change-Id
+            might match one change per branch)
+        """
+        results = {}
+        seen = set()
+        for ident in idents:
+            results.setdefault(str(ident), [])
+        chunks = self.chunk_query_terms(
+            ['change:' + ident for ident in results],
+            chunk_size=chunk_size,
+            max_query_len=max_query_len,
+        )
+        for chunk in chunks:
+            query = '(' + ' OR '.join(chunk) + ')'
+            if extra_query:
+                query += ' ' + extra_query
+            for change in self.iter_query(query, **kwargs):
+                number = str(change.get('number'))
+                for key in (number, change.get('id')):
+                    if key in results and (key, number) not in seen:
+                        seen.add((key, number))
+                        results[key].append(change)
+        return results
+
     def query_patchsets(self, *args, **kwargs):
         res = self.query(*args, **kwargs)
         if not res:
             raise Exception('Error trying to get patches:\n%s' % res)
         return res[0].get('patchSets', [])
 
+    def query_change(self, *args, **kwargs):
+        """
+        Like query_patchsets, but returns the first change found as a
+        :class:`ChangeRecord`
+        """
+        res = self.query(*args, **kwargs)
+        if not res or res[0].get('type') == 'stats':
+            raise Exception('Error trying to get patches:\n%s' % res)
+        return ChangeRecord.from_json(res[0])
+
+
+class PatchSet(object):
+    """
+    Compact view of a patchset as returned by Gerrit.query, with the
+    approvals indexed by label and user so the flag values can be looked up
+    without walking the whole approvals list.
+    """
+    __slots__ = ('number', 'revision', 'kind', 'approvals')
+
+    def __init__(self, number, revision, kind=None, approvals=None):
+        """
+        :param number: patchset number
+        :param revision: commit hash of the patchset
+        :param kind: kind of patchset (REWORK, NO_CODE_CHANGE...)
+        :param approvals: dict of label -> dict of user name -> value
+        """
+        self.number = number
+        self.revision = revision
+        self.kind = kind
+        self.approvals = approvals if approvals is not None else {}
+
+    @classmethod
+    def from_json(cls, patchset):
+        """
+        :param patchset: dict with the patchset info as returned by
+            Gerrit.query
+        """
+        approvals = {}
+        for approval in patchset.get('approvals', []):
+            by_label = approvals.setdefault(approval.get('type'), {})
+            by_label[approval.get('by').get('name')] = int(
+                approval.get('value')
+            )
+        return cls(
+            number=patchset.get('number'),
+            revision=patchset.get('revision'),
+            kind=patchset.get('kind'),
+            approvals=approvals,
+        )
+
+    def has_code_change(self):
+        return self.kind != 'NO_CODE_CHANGE'
+
+    def get_flag_values(self, flag_name, by_users=None):
+        """
+        :param flag_name: Name of the flag to get the review values for
+        :param by_users: List of users to filter the reviews by, if empty or
+            not set will get them all
+        :returns dict: user name -> value
+        """
+        values = self.approvals.get(flag_name, {})
+        if not by_users:
+            return dict(values)
+        return dict(
+            (user, values[user]) for user in by_users if user in values
+        )
+
+    def get_reviewers_name(self, flag_name):
+        return list(self.approvals.get(flag_name, {}))
+
+    def get_ci_value(self, by_users=None):
+        """
+        Get the global patchset CI flag value, taking into account that +1 is
+        more prioritary than -1
+
+        :param by_users: list of user names whose reviews will be taken into
+            account to calculate the global value, if empty or None will not
+            filter the reviewers
+        """
+        cur_ci = 0
+        for value in self.get_flag_values(
+            'Continuous-Integration', by_users,
+        ).values():
+            if value < 0:
+                cur_ci = value
+            if value > 0:
+                return value
+        return cur_ci
+
+
+class ChangeRecord(object):
+    """
+    Compact view of a change as returned by Gerrit.query, with its
+    patchsets as :class:`PatchSet` objects, sorted by history, and indexed
+    by revision.
+    """
+    __slots__ = ('number', 'id', 'project', 'branch', 'status', 'patchsets',
+                 'revisions')
+
+    def __init__(self, number, id, project, branch, status, patchsets):
+        """
+        :param number: change number
+        :param id: Change-Id of the change
+        :param project: project name
+        :param branch: branch of the change
+        :param status: status of the change (NEW, MERGED...)
+        :param patchsets: list of :class:`PatchSet`, oldest first
+        """
+        self.number = number
+        self.id = id
+        self.project = project
+        self.branch = branch
+        self.status = status
+        self.patchsets = patchsets
+        self.revisions = dict(
+            (patchset.revision, index)
+            for index, patchset in enumerate(patchsets)
+        )
+
+    @classmethod
+    def from_json(cls, change):
+        """
+        :param change: dict with the change info as returned by Gerrit.query
+        """
+        return cls(
+            number=change.get('number'),
+            id=change.get('id'),
+            project=change.get('project'),
+            branch=change.get('branch'),
+            status=change.get('status'),
+            patchsets=[
+                PatchSet.from_json(patchset)
+                for patchset in change.get('patchSets', [])
+            ],
+        )
+
+    def get_patchset(self, revision):
+        """
+        :param revision: commit hash of the patchset
+        :returns: the :class:`PatchSet` or None if it's not in the change
+        """
+        index = self.revisions.get(revision)
+        if index is None:
+            return None
+        return self.patchsets[index]
+
+    def get_newer_patchsets(self, revision):
+        """
+        :param revision: commit hash of the patchset
+        :returns list: the patchsets after the given one, oldest first
+        """
+        return self.patchsets[self.revisions[revision] + 1:]
+
 
 class Change:
+    """
+    Helpers to work with the patchset dicts as returned by Gerrit.query,
+    see :class:`PatchSet` to do it for many flags on the same patchset
+    """
     @staticmethod
     def has_code_change(change):
         return change.get('kind', None) != 'NO_CODE_CHANGE'
@@ -128,20 +825,7 @@ class Change:
             account to calculate the global value, if empty or None will not
             filter the reviewers
         """
-        by_users = by_users or []
-        ci_values = Change.get_flag_values(
-            change=change,
-            flag_name='Continuous-Integration',
-            by_users=by_users,
-        ).values()
-        # calculate the sum of the values, +1 has priority
-        cur_ci = 0
-        for value in ci_values:
-            if value < 0:
-                cur_ci = value
-            if value > 0:
-                return value
-        return cur_ci
+        return PatchSet.from_json(change).get_ci_value(by_users)
 
     @staticmethod
     def get_ci_reviewers_name(change):
@@ -158,24 +842,12 @@ class Change:
         :param by_users: List of users to filter the reviews by, if empty or
             not set will get them all
         """
-        by_users = by_users or []
-        approvals = change.get('approvals', [])
-        # if any more recent change has ci flag by given users, take that
-        return dict(
-            (approval.get('by').get('name'), int(approval.get('value')))
-            for approval in approvals
-            if approval.get('type') == flag_name
-            and (
-                (by_users and approval.get('by').get('name') in by_users)
-                or not by_users
-            )
-        )
+        return PatchSet.from_json(change).get_flag_values(flag_name, by_users)
 
     @staticmethod
     def get_reviewers_name(change, flag_name):
-        approvals = change.get('approvals', [])
         return [
             approval.get('by').get('name')
-            for approval in approvals
+            for approval in change.get('approvals', [])
             if approval.get('type') == flag_name
         ]
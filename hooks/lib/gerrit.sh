@@ -29,17 +29,7 @@ gerrit.get_patch(){
 ## @retval 1 otherwise
 gerrit.is_related(){
     declare commit=${1:-HEAD}
-    local line
-    local related_regexp='^[^#]*Related-To:(.*)$'
-    pushd "${GIT_DIR?}" &>/dev/null
-    while read line; do
-        if [[ "$line"  =~ $related_regexp ]]; then
-            popd &>/dev/null
-            return 0
-        fi
-    done < <( git log "$commit^1..$commit" --format=%b )
-    popd &>/dev/null
-    return 1
+    footers.py --git-dir "${GIT_DIR?}" "$commit" Related-To &>/dev/null
 }
 
 
@@ -10,12 +10,50 @@ import sys
 import socket
 import re
 import ast
+import copy
+import json
+import time
 from config import load_config
-from gerrit import Gerrit
-from bz import Bugzilla, WrongProduct
-from tools import get_parser_pc, get_newer_branches, get_branches
+from gerrit import Gerrit, get_query_cache
+from breaker import get_breaker, CircuitOpen
+from retry import get_policy
+from outbox import get_outbox
+from change_index import get_change_index
+from footers import get_footers
+from bz import (
+    Bugzilla, BugWriteBatch, BACKENDS, WrongProduct, get_bug_cache,
+    get_token_dir, BUG_FIELDS,
+    DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, DEFAULT_MAX_CONCURRENCY,
+    BZ_FAILURES,
+)
+from tools import (
+    get_parser_pc, get_newer_branches, get_branch_lattice, parse_version,
+)
 from termcolor import colored
 logger = logging.getLogger(__name__)
+# bugzilla and gerrit objects, kept between runs when the hooks are run
+# in-process by the dispatcher
+OBJECTS_CACHE = {}
+# Environment variable with the path to the event context prefetched by the
+# dispatcher
+CONTEXT_ENV = 'GERRIT_HOOKS_CONTEXT'
+# context file path -> loaded context
+CONTEXT_CACHE = {}
+# Max seconds to wait for the dispatcher to finish prefetching the context,
+# and seconds between checks
+CONTEXT_TIMEOUT = 30
+CONTEXT_POLL_INTERVAL = 0.05
+# Bug fields needed by the checks of the bug classification and product, of
+# the bug target milestone, and to update the bug status
+PRODUCT_BUG_FIELDS = ('classification', 'product')
+MILESTONE_BUG_FIELDS = ('classification', 'target_milestone', 'flags')
+STATUS_BUG_FIELDS = (
+    'classification', 'product', 'status', 'target_milestone',
+    'external_bugs',
+)
+# Max seconds since the last update of the indexed reviews to use them, see
+# get_local_changes
+REVIEWS_MAX_AGE = 300
 
 
 class NotRelevant(Exception):
@@ -74,6 +112,58 @@ def init_logging(verbose=False, log_file=False):
         )
 
 
+def get_context():
+    """
+    Get the event context prefetched by the hook dispatcher, if any. It might
+    have the keys:
+
+    * commit: commit hash the context belongs to
+    * config: raw configuration dict
+    * change: gerrit change for the commit, as returned by Gerrit.query
+    * bug_urls: list of bug urls from the commit message
+    * bug_ids: list of bug ids from the bug urls
+
+    The dispatcher fetches it while the hooks start, so it waits for it to
+    be ready, up to CONTEXT_TIMEOUT seconds. If it's not ready by then, or
+    could not be fetched, the hooks get the data themselves.
+
+    :return: dict with the context, empty if there's none
+    """
+    path = os.environ.get(CONTEXT_ENV)
+    if not path:
+        return {}
+    if path not in CONTEXT_CACHE:
+        deadline = time.time() + CONTEXT_TIMEOUT
+        while not os.path.exists(path) and time.time() < deadline:
+            time.sleep(CONTEXT_POLL_INTERVAL)
+        try:
+            with open(path) as context_fd:
+                CONTEXT_CACHE[path] = json.load(context_fd)
+        except (IOError, ValueError) as err:
+            logger.warn("Unable to load the event context {0}: {1}".format(
+                path, err))
+            CONTEXT_CACHE[path] = {}
+    return CONTEXT_CACHE[path]
+
+
+def get_context_value(key, commit=None):
+    """
+    Get a value from the prefetched event context
+
+    :param key: key to get from the context
+    :param commit: if passed, only return the value if the context is for
+        that commit
+    :return: a copy of the value, or None if not in the context
+    """
+    context = get_context()
+    if commit is not None and context.get('commit') != commit:
+        return None
+    value = context.get(key)
+    if value is not None:
+        logger.debug("==> using prefetched {0}".format(key))
+    return copy.deepcopy(value)
+
+
 def print_review_results(
     message, cr_value='0', v_value='0',
 ):
@@ -124,14 +214,18 @@ def print_title(title):
     logger.debug(colored('-' * len(title), 'blue'))
 
 
-def get_configuration():
+def get_configuration(git_dir=None):
     """
     Gets configuration parameters from config file
 
+    :param git_dir: repository to get the configuration for, the current
+        hook one if not passed
     :return: dict of config keys and values
     """
-    # load the configuration file
-    config = load_config()
+    # load the configuration file, if not already loaded by the dispatcher
+    config = None if git_dir else get_context_value('config')
+    if config is None:
+        config = load_config(git_dir)
 
     # check the configuration file
     check_config(config=config)
@@ -158,17 +252,50 @@ def set_objects(config):
     :param config: dict of configuration keys and values
     :return: bugzilla and gerrit objects
     """
+    key = (
+        config['BZ_USER'], config['BZ_PASS'], config['BZ_URL'],
+        config['GERRIT_SRV'],
+    )
+    if key in OBJECTS_CACHE:
+        return OBJECTS_CACHE[key]
 
     # set bugzilla object
-    bz_obj = Bugzilla(
+    bz_class = BACKENDS.get(config.get('BZ_BACKEND') or 'xmlrpc')
+    if bz_class is None:
+        logger.error("Unknown BZ_BACKEND {0}, using xmlrpc".format(
+            config['BZ_BACKEND']))
+        bz_class = Bugzilla
+    bz_obj = bz_class(
         user=config['BZ_USER'],
         passwd=config['BZ_PASS'],
         url=config['BZ_URL'],
+        cache=get_bug_cache(config),
+        connect_timeout=int(
+            config.get('BZ_CONNECT_TIMEOUT') or DEFAULT_CONNECT_TIMEOUT
+        ),
+        read_timeout=int(
+            config.get('BZ_READ_TIMEOUT') or DEFAULT_READ_TIMEOUT
+        ),
+        api_key=config.get('BZ_API_KEY') or None,
+        token_dir=get_token_dir(config),
+        max_concurrency=int(
+            config.get('BZ_MAX_CONCURRENCY') or DEFAULT_MAX_CONCURRENCY
+        ),
+        breaker=get_breaker(
+            config, 'bugzilla:' + config['BZ_URL'], failures=BZ_FAILURES,
+        ),
+        policy=get_policy(config, 'bugzilla'),
     )
 
     # set gerrit object
-    gerrit_obj = Gerrit(config['GERRIT_SRV'])
+    gerrit_obj = Gerrit(
+        config['GERRIT_SRV'],
+        cache=get_query_cache(config),
+        breaker=get_breaker(config, 'gerrit:' + config['GERRIT_SRV']),
+        policy=get_policy(config, 'gerrit'),
+    )
 
+    OBJECTS_CACHE[key] = bz_obj, gerrit_obj
     return bz_obj, gerrit_obj
 
 
@@ -202,6 +329,9 @@ def get_commit_message(gerrit_obj, commit):
     :param commit: patch commit id
     :return: string of the commit message
     """
+    change = get_context_value('change', commit=commit)
+    if change is not None:
+        return change.get('commitMessage')
 
     # get the change from commit id
     change = gerrit_obj.query(commit)[0]
@@ -219,8 +349,11 @@ def get_bug_ids(bz_obj, bug_urls):
     :param bug_urls: list of bug urls
     :return: list of bug ids
     """
-    # get bug ids from bug urls
-    bug_ids = bz_obj.get_bug_ids(bug_urls=bug_urls)
+    if bug_urls == get_context_value('bug_urls'):
+        bug_ids = set(get_context_value('bug_ids'))
+    else:
+        # get bug ids from bug urls
+        bug_ids = bz_obj.get_bug_ids(bug_urls=bug_urls)
     logger.debug("==> bug_ids: {0}\n".format(bug_ids))
 
     return bug_ids
@@ -237,10 +370,12 @@ def get_bug_urls(bz_obj, gerrit_obj, commit, bz_server):
     :return: list of bug urls
     """
     # get bug url\s from the commit message
-    bug_urls = bz_obj.get_bug_urls(
-        commit=get_commit_message(gerrit_obj=gerrit_obj, commit=commit),
-        bz_server=bz_server
-    )
+    bug_urls = get_context_value('bug_urls', commit=commit)
+    if bug_urls is None:
+        bug_urls = get_footers(
+            get_commit_message(gerrit_obj=gerrit_obj, commit=commit),
+            sha=commit,
+        ).get_bug_urls(bz_server)
     logger.debug("==> bug_urls: {0}".format(bug_urls))
 
     if not bug_urls:
@@ -250,28 +385,52 @@ def get_bug_urls(bz_obj, gerrit_obj, commit, bz_server):
     return bug_urls
 
 
-def get_bug_info(bz_obj, bug_id):
+def get_bug_info(bz_obj, bug_id, fields=BUG_FIELDS):
     """
     Get bug information from the passed bug id
 
     :param bz_obj: bugzilla object
     :param bug_id: bug id
+    :param fields: bug fields to get
     :return: tuple of object with all the bug info and a reason string
     """
-    reason = ''
-    bug_info = None
+    bugs_info = get_bugs_info(bz_obj=bz_obj, bug_ids=[bug_id], fields=fields)
+    return bugs_info[bug_id]
 
-    logger.debug("==> checking bug_id: {0}".format(bug_id))
-    try:
-        bug_info = bz_obj.extract_bug_info(bug_id=bug_id)
 
-        if bug_info is None:
-            reason = "(private bug or bug doesn't exist)"
+def get_bugs_info(bz_obj, bug_ids, fields=BUG_FIELDS):
+    """
+    Get the information of all the passed bug ids with a single request
 
-    except socket.gaierror:
+    :param bz_obj: bugzilla object
+    :param bug_ids: list of bug ids
+    :param fields: bug fields to get, only those are set in the bug objects
+    :return: dict of bug id -> tuple of object with all the bug info (None if
+        it could not be retrieved) and a reason string
+    """
+    bug_ids = list(bug_ids)
+    logger.debug("==> checking bug_ids: {0}".format(
+        ', '.join(str(bug_id) for bug_id in bug_ids)
+    ))
+    try:
+        bugs, faults = bz_obj.extract_bugs_info(
+            bug_ids=bug_ids, fields=fields,
+        )
+    except CircuitOpen as err:
+        reason = "({0})".format(err)
+        return dict((bug_id, (None, reason)) for bug_id in bug_ids)
+    except socket.error:
         reason = "(network issues). Please contact infra@ovirt.org."
+        return dict((bug_id, (None, reason)) for bug_id in bug_ids)
 
-    return bug_info, reason
+    bugs_info = {}
+    for bug_id in bug_ids:
+        bug_info = bugs.get(str(bug_id))
+        reason = ''
+        if bug_info is None:
+            reason = "(private bug or bug doesn't exist)"
+        bugs_info[bug_id] = bug_info, reason
+    return bugs_info
 
 
 def check_bug_url(bz_obj, bug_urls, branch, classifications, products):
@@ -303,12 +462,14 @@ def check_bug_url(bz_obj, bug_urls, branch, classifications, products):
         message = "{0}::{1}".format(HDR, status)
         messages = [message]
     else:
-        for bug_url in bug_urls:
-
-            bug_id = re.findall(r'\d+\b', bug_url)[0]
+        bug_ids = [re.findall(r'\d+\b', bug_url)[0] for bug_url in bug_urls]
+        bugs_info = get_bugs_info(
+            bz_obj=bz_obj, bug_ids=set(bug_ids), fields=PRODUCT_BUG_FIELDS,
+        )
+        for bug_id in bug_ids:
 
             # check that we receive bug info
-            bug_info, reason = get_bug_info(bz_obj=bz_obj, bug_id=bug_id)
+            bug_info, reason = bugs_info[bug_id]
 
             if bug_info is None:
                 status = "WARN, failed to get bug info "
@@ -338,19 +499,21 @@ def check_bug_url(bz_obj, bug_urls, branch, classifications, products):
     return "\n".join(messages), v_value, cr_value
 
 
-def check_tracker(gerrit_obj, tracker_number, branch):
+def check_tracker(gerrit_obj, tracker_number, branch, changes=None):
     """
     Check that the external tracker is MERGED by querying gerrit
 
     :param gerrit_obj: gerrit object
     :param tracker_number: external tracker number (gerrit patch number)
     :param branch: patch branch (i.e ovirt-engine-4.1)
+    :param changes: changes for the tracker number, if already queried
     :return: bool value, True if the change is not MERGED, False otherwise
     """
     if tracker_number is None:
         return False
 
-    changes = gerrit_obj.query(tracker_number)
+    if changes is None:
+        changes = gerrit_obj.query(tracker_number)
     for change in changes:
         if not change.get('status'):
             continue
@@ -379,18 +542,22 @@ def check_external_trackers(trackers, gerrit_obj, change):
         status += "(no external tracker info found)"
         return status, True
 
-    for tracker in trackers:
-        if not tracker.get('type'):
-            continue
-
-        description = tracker['type'].get('description')
-        if description is None or description != 'oVirt gerrit':
-            continue
+    tracker_numbers = [
+        tracker.get('ext_bz_bug_id')
+        for tracker in trackers
+        if tracker.get('type')
+        and tracker['type'].get('description') == 'oVirt gerrit'
+    ]
+    # get all the tracker changes at once
+    tracker_changes = gerrit_obj.query_many(
+        [number for number in tracker_numbers if number is not None]
+    )
 
-        tracker_number = tracker.get('ext_bz_bug_id')
+    for tracker_number in tracker_numbers:
         if check_tracker(
             gerrit_obj=gerrit_obj, tracker_number=tracker_number,
             branch=change.get('branch'),
+            changes=tracker_changes.get(str(tracker_number)),
         ):
             status = "WARN, can't change bug status to 'MODIFIED' "
             status += "(There are still open patches)"
@@ -399,7 +566,7 @@ def check_external_trackers(trackers, gerrit_obj, change):
     return '', False
 
 
-def set_status(bz_obj, bug_id, change, bug_info, gerrit_obj):
+def set_status(bz_obj, bug_id, change, bug_info, gerrit_obj, batch=None):
     """
     Sets bug status to 'MODIFIED' only if the current status is 'POST'
 
@@ -408,7 +575,10 @@ def set_status(bz_obj, bug_id, change, bug_info, gerrit_obj):
     :param change: dict with patch information
     :param bug_info: bug object
     :param gerrit_obj: gerrit object
-    :return: status message string
+    :param batch: if passed, queue the status update in this
+        :class:`bz.BugWriteBatch` instead of doing it right away
+    :return: status message string, or None if the update was queued (see
+        get_set_status_message)
     """
     change_status = change.get('status')
     bug_status = bug_info.status if hasattr(bug_info, 'status') else ''
@@ -457,12 +627,50 @@ def set_status(bz_obj, bug_id, change, bug_info, gerrit_obj):
             return "IGNORE, not relevant for bug with '{0}' status".format(
                 bug_status)
 
+    if batch is not None:
+        batch.update_bug(bug_id=bug_id, status=change_status)
+        return None
+
     try:
         bz_obj.update_bug(bug_id=bug_id, status=change_status)
-        status = "OK, bug status updated to '{0}'".format(change_status)
+        error = None
     except socket.error as err:
-        status = "ERROR, failed to change bug status ({0})".format(err)
-    return status
+        error = err
+    return get_set_status_message(change_status, error)
+
+
+def get_set_status_message(change_status, error=None, queued=False):
+    """
+    Get the status message for a bug status update
+
+    :param change_status: status the bug was updated to
+    :param error: exception if the update failed
+    :param queued: True if the update was added to the outbox instead of
+        sent to bugzilla
+    :return: status message string
+    """
+    if error is not None:
+        return "ERROR, failed to change bug status ({0})".format(error)
+    if queued:
+        return "OK, bug status will be updated to '{0}'".format(change_status)
+    return "OK, bug status updated to '{0}'".format(change_status)
+
+
+def get_write_batch(bz_obj, outbox=None, commit=None, project=None):
+    """
+    Get the batch to send the bug writes of the hook through
+
+    :param bz_obj: bugzilla object
+    :param outbox: :class:`outbox.Outbox` to queue the writes in, if not
+        passed they are sent to bugzilla right away
+    :param commit: commit of the change, to report the queued writes
+        failures to
+    :param project: project of the change
+    :return: :class:`bz.BugWriteBatch` or :class:`outbox.OutboxBatch`
+    """
+    if outbox is None:
+        return BugWriteBatch(bz_obj)
+    return outbox.batch(commit=commit, project=project, header=HDR)
 
 
 def get_version_suffix(string):
@@ -472,11 +680,8 @@ def get_version_suffix(string):
     :param string: string with
     :return: version suffix
     """
-    pattern = r'\d+(\.\d)+\b'
-    search_pattern = re.search(pattern=pattern, string=string)
-    suffix = search_pattern.group() if search_pattern is not None else ''
-
-    return suffix
+    version = parse_version(string)
+    return '.'.join(str(part) for part in version) if version else ''
 
 
 def cmp_change_branch_and_bug_tm(bug_info, change):
@@ -498,31 +703,22 @@ def cmp_change_branch_and_bug_tm(bug_info, change):
         return status, True
 
     # get bug milestone suffix version (ovirt-X.Y.Z ==> X.Y.Z)
-    bm_suffix = get_version_suffix(string=bm)
-    logging.debug("==> milestone suffix: {0}".format(bm_suffix))
+    bm_version = parse_version(bm)
+    logging.debug("==> milestone version: {0}".format(bm_version))
 
     # get change branch suffix version (ovirt-engine-X.Y.Z ==> X.Y.Z)
-    cb_suffix = get_version_suffix(string=cb)
-    logging.debug("==> branch suffix: {0}".format(cb_suffix))
+    cb_version = parse_version(cb)
+    logging.debug("==> branch version: {0}".format(cb_version))
 
     # if bug milestone suffix version not equal to change brunch suffix
     # version, the bug status should be changed from POST ==> MODIFIED
     # only if the newer branch doesn't exist
-    if bm_suffix != cb_suffix:
-
-        # get all the branches for the current git project
-        branches = get_branches(repo_path=os.environ['GIT_DIR'])
+    if bm_version != cb_version:
 
-        nb = ''
         # check if newer branch exist
-        pattern = re.compile(r'.*' + bm_suffix + r'.*')
-        for branch in branches:
-            search_obj = re.search(pattern, branch)
-            if search_obj is not None:
-                nb = search_obj.group()
-                break
-
-        if nb != '':
+        nb = get_branch_lattice(os.environ['GIT_DIR']).get_branch(bm_version)
+
+        if nb is not None:
             status = "WARN, bug status won't be changed to MODIFIED "
             status += "(detected a newer branch '{0}' ".format(nb)
             status += "that matches the milestone)"
@@ -533,7 +729,7 @@ def cmp_change_branch_and_bug_tm(bug_info, change):
 
 def update_bug_status(
         bz_obj, gerrit_obj, bug_ids, change, classifications, products,
-        draft=None
+        draft=None, outbox=None, commit=None,
 ):
     """
     Update bugs status only for the specified classification
@@ -545,16 +741,28 @@ def update_bug_status(
     :param classifications: list of classifications
     :param products: list of products
     :param draft: bool value (true if it's draft patch, false otherwise)
+    :param outbox: :class:`outbox.Outbox` to queue the updates in, if not
+        passed they are sent to bugzilla right away
+    :param commit: patch commit id, to report the queued updates failures
     :return: tuple of message and v_value
     """
     v_value = "0"
     cr_value = "0"
     messages = []
 
+    bugs_info = get_bugs_info(
+        bz_obj=bz_obj, bug_ids=bug_ids, fields=STATUS_BUG_FIELDS,
+    )
+    batch = get_write_batch(
+        bz_obj=bz_obj, outbox=outbox, commit=commit,
+        project=change.get('project'),
+    )
+    statuses = []
     for bug_id in bug_ids:
 
-        bug_info, reason = get_bug_info(bz_obj=bz_obj, bug_id=bug_id)
+        bug_info, reason = bugs_info[bug_id]
         if bug_info is None:
+            batch.flush()
             status = "WARN, failed to get bug info "
             status += reason if reason != '' else ''
             message = "{0}::#{1}::{2}".format(HDR, bug_id, status)
@@ -582,12 +790,23 @@ def update_bug_status(
         if classification in classifications or product in products:
             status = set_status(
                 bz_obj=bz_obj, bug_id=bug_id, change=change,
-                bug_info=bug_info, gerrit_obj=gerrit_obj)
+                bug_info=bug_info, gerrit_obj=gerrit_obj, batch=batch)
         else:
             status = "IGNORE, not relevant for "
             status += "classification: '{0}'".format(classification)
             status += ", product: '{0}'".format(product)
 
+        statuses.append((bug_id, status))
+
+    # send all the status updates together, and report each bug result
+    results = batch.flush()
+    for bug_id, status in statuses:
+        if status is None:
+            status = get_set_status_message(
+                change_status=change.get('status'),
+                error=results.get(str(bug_id)),
+                queued=outbox is not None,
+            )
         message = "{0}::#{1}::{2}".format(HDR, bug_id, status)
         messages.append(message)
 
@@ -602,8 +821,10 @@ def get_change(gerrit_obj, commit):
     :param commit: patch commit id
     :return: dict with change info
     """
-    # get the change from commit id
-    change = gerrit_obj.query(commit)[0]
+    change = get_context_value('change', commit=commit)
+    if change is None:
+        # get the change from commit id
+        change = gerrit_obj.query(commit)[0]
     logger.debug("==> change: {0}".format(change))
     for key, value in change.items():
         if key == 'commitMessage':
@@ -707,16 +928,54 @@ def check_patch_merged(branches):
     return message, v_value, cr_value
 
 
-def check_backport(gerrit_obj, change_id, current_branch, project):
+def get_local_changes(change_id, newer_branches, repo_path, conf=None):
+    """
+    Get the changes with the given Change-Id from the repository, without
+    asking gerrit
+
+    The merged changes are found in the branches, and the open and abandoned
+    ones in the reviews metadata, if gerrit keeps it in the repository
+    (NoteDb) and it was indexed recently (see REVIEWS_MAX_AGE). The changes
+    are only returned if there's one for each of the newer branches, as a
+    missing one might be a review not indexed yet.
+
+    :param change_id: patch change id
+    :param newer_branches: list with newer branches
+    :param repo_path: path to the git repository
+    :param conf: configuration dict
+    :return: list of changes, or None if gerrit has to be asked
+    """
+    try:
+        index = get_change_index(repo_path, conf)
+        changes = index.get_changes(
+            change_id,
+            with_reviews=index.has_reviews(max_age=REVIEWS_MAX_AGE),
+        )
+    except Exception as exc:
+        logger.warning('Unable to use the change index: %s' % exc)
+        return None
+    if set(newer_branches) <= set(change['branch'] for change in changes):
+        return changes
+    return None
+
+
+def check_backport(gerrit_obj, change_id, current_branch, project,
+                   conf=None):
     """
     Checks that the patch was merged to the relevant (newer) stable branches
 
+    The changes are looked for in the local repository, unless
+    BACKPORT_CHECK_MODE is set to 'gerrit', gerrit is only asked when the
+    repository does not have the answer.
+
     :param gerrit_obj: gerrit object
     :param change_id: patch change id
     :param current_branch: current_branch (i.e master, ovirt-engine-3.6.9)
     :param project: project (i.e ovirt-engine)
+    :param conf: configuration dict
     :return: tuple of message and v_value
     """
+    conf = conf or {}
     if 'master' in current_branch:
         message = 'IGNORE, not relevant for branch: {0}'.format(current_branch)
         NotRelevant(message)
@@ -728,7 +987,15 @@ def check_backport(gerrit_obj, change_id, current_branch, project):
     logger.debug("==> relevant_branches: {0}".format(newer_branches))
 
     # get all the changes that have the same change_id
-    changes = gerrit_obj.query(change_id + ' project:' + project)
+    changes = None
+    if conf.get('BACKPORT_CHECK_MODE', 'local') != 'gerrit':
+        changes = get_local_changes(
+            change_id, newer_branches, os.environ['GIT_DIR'], conf,
+        )
+    if changes is None:
+        changes = gerrit_obj.query_many(
+            [change_id], extra_query='project:' + project,
+        )[change_id]
     logger.debug("==> changes: {0}".format(changes))
 
     # check if current branch exist in the newer branches list
@@ -747,15 +1014,14 @@ def get_maj_version(full_version):
     :param full_version: full version (i.e *-X.Y.Z[-*] or *-X.Y[-*])
     :return: string with major version (i.e X.Y)
     """
-    regex_version = r'\d+.\d+\b'
-
     # get major version of branch or target milestone
-    version = re.findall(regex_version, full_version)
+    version = parse_version(full_version)
 
     # if target milestone empty or equal to '---' return '999.999'
-    maj_version = version[0] if version else '999.999'
+    if version is None:
+        return '999.999'
 
-    return maj_version
+    return '{0}.{1}'.format(*version)
 
 
 def check_clone_flags(flags, tm_maj_version):
@@ -793,8 +1059,11 @@ def check_target_milestone(bz_obj, bug_ids, branch, classifications):
     cr_value = "0"
     messages = []
 
+    bugs_info = get_bugs_info(
+        bz_obj=bz_obj, bug_ids=bug_ids, fields=MILESTONE_BUG_FIELDS,
+    )
     for bug_id in bug_ids:
-        bug_info, reason = get_bug_info(bz_obj=bz_obj, bug_id=bug_id)
+        bug_info, reason = bugs_info[bug_id]
 
         if bug_info is None:
             message = "{0}::#{1}::WARN, failed to get bug info ".format(
@@ -840,7 +1109,9 @@ def check_target_milestone(bz_obj, bug_ids, branch, classifications):
             status = "OK, target milestone"
         # if branch maj version larger than target milestone maj
         # version, check for clone candidate flags
-        elif float(branch_maj_version) > float(tm_maj_version):
+        elif (
+            parse_version(branch_maj_version) > parse_version(tm_maj_version)
+        ):
             status = check_clone_flags(
                 flags=bug_info.flags, tm_maj_version=tm_maj_version)
         else:
@@ -871,8 +1142,11 @@ def check_product(bz_obj, bug_ids, project, classifications):
     cr_value = "0"
     messages = []
 
+    bugs_info = get_bugs_info(
+        bz_obj=bz_obj, bug_ids=bug_ids, fields=PRODUCT_BUG_FIELDS,
+    )
     for bug_id in bug_ids:
-        bug_info, reason = get_bug_info(bz_obj=bz_obj, bug_id=bug_id)
+        bug_info, reason = bugs_info[bug_id]
 
         if bug_info is None:
             message = "{0}::#{1}::WARN, failed to get bug info ".format(
@@ -914,7 +1188,7 @@ def check_product(bz_obj, bug_ids, project, classifications):
 
 def update_tracker(
         bz_obj, bug_ids, change, tracker_id, branch, draft,
-        classifications, products,
+        classifications, products, outbox=None, commit=None,
 ):
     """
     Update bugzilla external tracker info
@@ -928,6 +1202,9 @@ def update_tracker(
     or None if it's a merge
     :param classifications: list of classifications
     :param products: list of products
+    :param outbox: :class:`outbox.Outbox` to queue the updates in, if not
+        passed they are sent to bugzilla right away
+    :param commit: patch commit id, to report the queued updates failures
     :return: tuple of message and cr_value
     """
     v_value = "0"
@@ -936,11 +1213,20 @@ def update_tracker(
 
     draft = ast.literal_eval(draft.capitalize()) if draft else None
 
+    bugs_info = get_bugs_info(
+        bz_obj=bz_obj, bug_ids=bug_ids, fields=PRODUCT_BUG_FIELDS,
+    )
+    batch = get_write_batch(
+        bz_obj=bz_obj, outbox=outbox, commit=commit,
+        project=change.get('project'),
+    )
+    statuses = []
     for bug_id in bug_ids:
         logger.debug("==> updating tracker with bug_id: {0}\n".format(bug_id))
 
-        bug_info, reason = get_bug_info(bz_obj=bz_obj, bug_id=bug_id)
+        bug_info, reason = bugs_info[bug_id]
 
+        status = None
         if bug_info is None:
             status = "WARN, failed to get bug info "
             status += reason if reason != '' else ''
@@ -956,23 +1242,35 @@ def update_tracker(
             logger.debug("==> product: {0}".format(product))
 
             if classification in classifications or product in products:
-                try:
-                    bz_obj.update_external(
-                        bug_id=bug_id, external_bug_id=change['number'],
-                        ext_type_id=tracker_id, description=change['subject'],
-                        status=change['status'], branch=branch,
-                    )
-                except WrongProduct, exc:
-                    status = "WARN, failed to update external tracker ({0})"
-                    status = status.format(exc.message)
-                else:
-                    status = "OK, tracker status updated to '{0}'"
-                    status = status.format(change['status'])
+                batch.update_external(
+                    bug_id=bug_id, external_bug_id=change['number'],
+                    ext_type_id=tracker_id, description=change['subject'],
+                    status=change['status'], branch=branch,
+                )
             else:
                 status = "IGNORE, not relevant for "
                 status += "classification: '{0}', product: '{1}'"
                 status = status.format(classification, product)
 
+        statuses.append((bug_id, status))
+
+    # send all the tracker updates together, and report each bug result
+    results = batch.flush()
+    for bug_id, status in statuses:
+        if status is None:
+            error = results.get(str(bug_id))
+            if isinstance(error, WrongProduct):
+                status = "WARN, failed to update external tracker ({0})"
+                status = status.format(error.message)
+            elif error is not None:
+                status = "ERROR, failed to update external tracker ({0})"
+                status = status.format(error)
+            elif outbox is not None:
+                status = "OK, tracker status will be updated to '{0}'"
+                status = status.format(change['status'])
+            else:
+                status = "OK, tracker status updated to '{0}'"
+                status = status.format(change['status'])
         message = "{0}::#{1}::{2}".format(HDR, bug_id, status)
         messages.append(message)
 
@@ -1019,7 +1317,7 @@ def run_hook_func(*args):
             return check_backport(
                 gerrit_obj=arg['gerrit_obj'], project=arg['args'].project,
                 change_id=arg['change']['id'],
-                current_branch=arg['args'].branch,
+                current_branch=arg['args'].branch, conf=arg['config'],
             )
 
         # update bug status
@@ -1029,6 +1327,7 @@ def run_hook_func(*args):
                 bug_ids=arg['bug_ids'], draft=arg['args'].private,
                 change=arg['change'], products=arg['config']['PRODUCTS'],
                 classifications=arg['config']['CLASSIFICATIONS'],
+                outbox=get_outbox(arg['config']), commit=arg['args'].commit,
             )
 
         # update external tracker
@@ -1039,6 +1338,7 @@ def run_hook_func(*args):
                 products=arg['config']['PRODUCTS'], branch=arg['args'].branch,
                 tracker_id=arg['config']['TRACKER_ID'],
                 classifications=arg['config']['CLASSIFICATIONS'],
+                outbox=get_outbox(arg['config']), commit=arg['args'].commit,
             )
 
 
@@ -1064,27 +1364,35 @@ def main(**kwargs):
 
     # set bugzilla and gerrit objects
     bz_obj, gerrit_obj = set_objects(config=config)
+    # each hook run gets a new retries budget
+    bz_obj.policy.reset_budget()
+    gerrit_obj.policy.reset_budget()
 
-    # get bug urls
-    bug_urls = get_bug_urls(
-        bz_obj=bz_obj, gerrit_obj=gerrit_obj, commit=args.commit,
-        bz_server=config['BZ_SERVER'])
-
-    # get bug ids
-    if HOOK_NAME in [
-        'check_target_milestone', 'check_product', 'set_post',
-        'set_modified', 'update_tracker'
-    ]:
-        bug_ids = get_bug_ids(bz_obj=bz_obj, bug_urls=bug_urls)
-
-    # get gerrit change
-    if HOOK_NAME in [
-        'check_backport', 'set_post', 'set_modified', 'update_tracker'
-    ]:
-        change = get_change(gerrit_obj=gerrit_obj, commit=args.commit)
-
-    # run specific hook function according to the hook name
-    message, v_value, cr_value = run_hook_func(locals())
+    try:
+        # get bug urls
+        bug_urls = get_bug_urls(
+            bz_obj=bz_obj, gerrit_obj=gerrit_obj, commit=args.commit,
+            bz_server=config['BZ_SERVER'])
+
+        # get bug ids
+        if HOOK_NAME in [
+            'check_target_milestone', 'check_product', 'set_post',
+            'set_modified', 'update_tracker'
+        ]:
+            bug_ids = get_bug_ids(bz_obj=bz_obj, bug_urls=bug_urls)
+
+        # get gerrit change
+        if HOOK_NAME in [
+            'check_backport', 'set_post', 'set_modified', 'update_tracker'
+        ]:
+            change = get_change(gerrit_obj=gerrit_obj, commit=args.commit)
+
+        # run specific hook function according to the hook name
+        message, v_value, cr_value = run_hook_func(locals())
+    except CircuitOpen as err:
+        # bugzilla or gerrit are down, don't make every hook wait for them
+        message = "{0}::WARN, {1}".format(HDR, err)
+        v_value, cr_value = '0', '0'
 
     # prints the message, verify and code review values
     print_review_results(message=message, v_value=v_value, cr_value=cr_value)
@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+"""
+Bugzilla outbox
+================
+
+Durable queue for the bugzilla writes of the hooks (bug status and external
+tracker updates), so the hooks don't have to wait for bugzilla to finish.
+
+The hooks add the writes to a sqlite database in the cache dir, and start a
+drainer process in the background, that sends them to bugzilla in batches
+(see :class:`bz.BugWriteBatch`), retrying the ones that failed because
+bugzilla was unreachable. Only one drainer runs at a time, and it keeps
+running until the outbox is empty.
+
+The writes that supersede a pending one replace it, so if a change goes
+through NEW, POST and MERGED before the drainer gets to it, only the last
+tracker status is sent. The writes that can't be done are reported as a
+comment on the change they came from.
+
+Can be run from the command line to drain the outbox::
+
+    outbox.py drain [--cache-dir DIR]
+
+API
+====
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import random
+import sqlite3
+import logging
+import argparse
+import threading
+import subprocess
+from collections import OrderedDict
+import cache
+from bz import BugWriteBatch, BZ_FAILURES
+from breaker import CircuitOpen
+
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_DB = 'outbox.db'
+OUTBOX_LOCK = 'outbox.lock'
+OUTBOX_LOG = 'outbox.log'
+# Seconds to wait for other processes to release the database
+DB_TIMEOUT = 30
+# Times to try each write before giving up
+MAX_ATTEMPTS = 6
+# Seconds to wait before the first retry, doubled for each of the next ones
+RETRY_DELAY = 15
+MAX_RETRY_DELAY = 600
+# Max seconds the drainer sleeps waiting for the next retry, so it notices
+# the new writes that are due right away
+POLL_INTERVAL = 5
+# Max writes to send in each batch
+BATCH_SIZE = 100
+# Drainer processes started by this process, see reap_drainers
+DRAINERS = []
+DRAINERS_LOCK = threading.Lock()
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS writes ('
+    ' key TEXT PRIMARY KEY, version TEXT, kind TEXT, bug_id TEXT,'
+    ' params TEXT, git_dir TEXT, commit_id TEXT, project TEXT, header TEXT,'
+    ' attempts INTEGER, next_try REAL, created REAL)'
+)
+
+
+def get_outbox(conf):
+    """
+    Get the outbox from the configuration, it's enabled by setting BZ_OUTBOX
+    to true
+
+    :param conf: configuration dict
+    :returns: the outbox, or None if it's disabled
+    """
+    if str(conf.get('BZ_OUTBOX', '')).lower() not in ('true', 'yes', '1'):
+        return None
+    return Outbox(os.path.join(cache.get_cache_dir(conf), OUTBOX_DB))
+
+
+class Outbox(object):
+    """
+    Queue of pending bugzilla writes, shared between processes
+    """
+    def __init__(self, path):
+        """
+        :param path: path to the sqlite database file
+        """
+        self.path = path
+        self.conn = sqlite3.connect(
+            path, timeout=DB_TIMEOUT, isolation_level=None,
+        )
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(SCHEMA)
+
+    def batch(self, commit, project, header, git_dir=None):
+        """
+        Get a batch to add writes to, with the same interface as
+        :class:`bz.BugWriteBatch`
+
+        :param commit: commit (or change,patchset) the writes come from, to
+            report the failures to
+        :param project: gerrit project of the change
+        :param header: hook header for the failure messages
+        :param git_dir: repository to load the configuration from, the
+            GIT_DIR environment variable by default
+        """
+        return OutboxBatch(
+            outbox=self,
+            commit=commit,
+            project=project,
+            header=header,
+            git_dir=git_dir or os.environ.get('GIT_DIR', ''),
+        )
+
+    def add(self, writes):
+        """
+        Add writes to the outbox, replacing the pending ones with the same
+        keys
+
+        :param writes: list of dicts with the columns of the writes table
+        """
+        now = time.time()
+        rows = [
+            (
+                write['key'], uuid.uuid4().hex, write['kind'],
+                write['bug_id'], json.dumps(write['params']),
+                write['git_dir'], write['commit_id'], write['project'],
+                write['header'], 0, now, now,
+            )
+            for write in writes
+        ]
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO writes VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows,
+            )
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def get_due(self, limit=BATCH_SIZE):
+        """
+        Get the writes to send now, oldest first
+
+        :param limit: max number of writes to get
+        :returns list: list of dicts with the writes columns
+        """
+        cursor = self.conn.execute(
+            'SELECT * FROM writes WHERE next_try <= ? '
+            'ORDER BY created LIMIT ?',
+            (time.time(), limit),
+        )
+        names = [column[0] for column in cursor.description]
+        writes = [dict(zip(names, row)) for row in cursor.fetchall()]
+        for write in writes:
+            write['params'] = json.loads(write['params'])
+        return writes
+
+    def next_due(self):
+        """
+        :returns: seconds until the next write is due, or None if the outbox
+            is empty
+        """
+        next_try = self.conn.execute(
+            'SELECT MIN(next_try) FROM writes'
+        ).fetchone()[0]
+        if next_try is None:
+            return None
+        return max(next_try - time.time(), 0)
+
+    def done(self, write):
+        """
+        Remove a write, unless it was superseded while it was being sent
+        """
+        self.conn.execute(
+            'DELETE FROM writes WHERE key = ? AND version = ?',
+            (write['key'], write['version']),
+        )
+
+    def retry_later(self, write):
+        """
+        Schedule a failed write to be sent again, with exponential backoff
+
+        :returns bool: False if it ran out of attempts
+        """
+        attempts = write['attempts'] + 1
+        if attempts >= MAX_ATTEMPTS:
+            return False
+        delay = min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+        self.conn.execute(
+            'UPDATE writes SET attempts = ?, next_try = ? '
+            'WHERE key = ? AND version = ?',
+            (
+                attempts, time.time() + random.uniform(delay / 2, delay),
+                write['key'], write['version'],
+            ),
+        )
+        return True
+
+    def drain(self, get_objects):
+        """
+        Send the pending writes, until the outbox is empty
+
+        :param get_objects: function that gets a repository path and returns
+            the bugzilla and gerrit objects for it
+        """
+        while True:
+            writes = self.get_due()
+            if writes:
+                by_repo = {}
+                for write in writes:
+                    by_repo.setdefault(write['git_dir'], []).append(write)
+                for git_dir, repo_writes in by_repo.items():
+                    try:
+                        self.send(repo_writes, *get_objects(git_dir))
+                    except Exception:
+                        logger.exception('Failed to send the writes of %s'
+                                         % git_dir)
+                        for write in repo_writes:
+                            if not self.retry_later(write):
+                                self.done(write)
+                continue
+            wait = self.next_due()
+            if wait is None:
+                return
+            time.sleep(min(wait, POLL_INTERVAL))
+
+    def send(self, writes, bz_obj, gerrit_obj):
+        """
+        Send the given writes, in as few batches as possible, handling their
+        results
+        """
+        if bz_obj.policy is not None:
+            bz_obj.policy.reset_budget()
+        for round_writes in self.split_by_bug(writes):
+            self.send_batch(round_writes, bz_obj, gerrit_obj)
+
+    @staticmethod
+    def split_by_bug(writes):
+        """
+        Split the writes in groups with at most one write per bug, as the
+        batches give only one result per bug (e.g. a status change and a
+        tracker update of the same bug go in different groups)
+
+        :returns list: list of lists of writes, keeping their order
+        """
+        groups = []
+        for write in writes:
+            for group in groups:
+                if write['bug_id'] not in group:
+                    break
+            else:
+                group = OrderedDict()
+                groups.append(group)
+            group[write['bug_id']] = write
+        return [group.values() for group in groups]
+
+    def send_batch(self, writes, bz_obj, gerrit_obj):
+        """
+        Send the given writes, of different bugs, in one batch, handling
+        their results
+        """
+        batch = BugWriteBatch(bz_obj)
+        for write in writes:
+            if write['kind'] == 'status':
+                batch.update_bug(write['bug_id'], **write['params'])
+            else:
+                batch.update_external(write['bug_id'], **write['params'])
+        results = batch.flush()
+        for write in writes:
+            error = results.get(write['bug_id'])
+            if error is None:
+                self.done(write)
+                continue
+            if isinstance(error, BZ_FAILURES + (CircuitOpen,)):
+                if self.retry_later(write):
+                    logger.info('Failed to update bug %s, will retry: %s'
+                                % (write['bug_id'], error))
+                    continue
+            self.done(write)
+            self.report(write, error, gerrit_obj)
+
+    @staticmethod
+    def report(write, error, gerrit_obj):
+        """
+        Report a failed write as a comment in the change it came from
+        """
+        if write['kind'] == 'status':
+            status = "ERROR, failed to change bug status to '{0}' ({1})"
+            status = status.format(write['params'].get('status'), error)
+        else:
+            status = "ERROR, failed to update external tracker ({0})"
+            status = status.format(error)
+        message = "{0}::#{1}::{2}".format(
+            write['header'], write['bug_id'], status,
+        )
+        logger.error(message)
+        try:
+            gerrit_obj.review(
+                commit=write['commit_id'],
+                project=write['project'],
+                message=message,
+            )
+        except Exception as exc:
+            logger.error('Unable to report the failure to gerrit: %s' % exc)
+
+
+class OutboxBatch(object):
+    """
+    Batch of writes to add to the outbox on flush, see Outbox.batch
+    """
+    queued = True
+
+    def __init__(self, outbox, commit, project, header, git_dir):
+        self.outbox = outbox
+        self.commit = commit
+        self.project = project
+        self.header = header
+        self.git_dir = git_dir
+        self.writes = []
+
+    def add(self, key, kind, bug_id, params):
+        self.writes.append({
+            'key': key,
+            'kind': kind,
+            'bug_id': str(bug_id),
+            'params': params,
+            'git_dir': self.git_dir,
+            'commit_id': self.commit,
+            'project': self.project,
+            'header': self.header,
+        })
+
+    def update_bug(self, bug_id, **fields):
+        """
+        Queue a bug update, a newer update of the same bug replaces it
+        """
+        self.add('status:%s' % bug_id, 'status', bug_id, fields)
+
+    def update_external(self, bug_id, external_bug_id, ext_type_id,
+                        status=None, description=None, branch=None,
+                        ensure_product=None):
+        """
+        Queue an external tracker update, a newer update of the same tracker
+        replaces it
+        """
+        self.add(
+            'tracker:%s:%s:%s' % (bug_id, ext_type_id, external_bug_id),
+            'tracker',
+            bug_id,
+            dict(
+                external_bug_id=external_bug_id,
+                ext_type_id=ext_type_id,
+                status=status,
+                description=description,
+                branch=branch,
+                ensure_product=ensure_product,
+            ),
+        )
+
+    def flush(self):
+        """
+        Add the writes to the outbox and start the drainer
+
+        :returns dict: bug id -> exception, for the bugs that could not be
+            queued
+        """
+        writes, self.writes = self.writes, []
+        if not writes:
+            return {}
+        try:
+            self.outbox.add(writes)
+        except sqlite3.Error as exc:
+            logger.error('Unable to add the writes to the outbox: %s' % exc)
+            return dict((write['bug_id'], exc) for write in writes)
+        start_drainer(os.path.dirname(self.outbox.path))
+        return {}
+
+
+def is_draining(cache_dir):
+    """
+    Check if there's a drainer running on the given cache dir, without
+    waiting for it
+
+    A running drainer checks for new writes before exiting, so the writes
+    added before this check are always sent.
+    """
+    with open(os.path.join(cache_dir, OUTBOX_LOCK), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return True
+    return False
+
+
+def start_drainer(cache_dir):
+    """
+    Start a drainer process in the background, if there's none running
+    already
+    """
+    reap_drainers()
+    if is_draining(cache_dir):
+        logger.debug('Another drainer is running')
+        return
+    script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    log_path = os.path.join(cache_dir, OUTBOX_LOG)
+    with open(os.devnull, 'r+') as devnull, open(log_path, 'a') as log:
+        drainer = subprocess.Popen(
+            [sys.executable, script, 'drain', '--cache-dir', cache_dir],
+            stdin=devnull,
+            stdout=log,
+            stderr=log,
+            close_fds=True,
+            preexec_fn=os.setsid,
+        )
+    with DRAINERS_LOCK:
+        DRAINERS.append(drainer)
+
+
+def reap_drainers():
+    """
+    Wait for the drainers started by this process that already exited, so
+    they don't linger as zombies in the long running processes (the
+    dispatcher daemon)
+    """
+    with DRAINERS_LOCK:
+        DRAINERS[:] = [
+            drainer for drainer in DRAINERS if drainer.poll() is None
+        ]
+
+
+def drain(cache_dir):
+    """
+    Drain the outbox in the given cache dir, unless another process is
+    already doing it
+    """
+    # import here, the hooks import this module
+    from hook_functions import get_configuration, set_objects
+
+    def get_objects(git_dir):
+        return set_objects(get_configuration(git_dir=git_dir))
+
+    outbox = Outbox(os.path.join(cache_dir, OUTBOX_DB))
+    with open(os.path.join(cache_dir, OUTBOX_LOCK), 'a') as lock:
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                logger.debug('Another drainer is running')
+                return
+            try:
+                outbox.drain(get_objects)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            # writes added after the last check, but before unlocking, would
+            # be left behind by the drainer they started
+            if outbox.next_due() is None:
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['drain'])
+    parser.add_argument(
+        '--cache-dir', default=None,
+        help='Cache dir with the outbox, the default hooks cache dir if not '
+        'passed',
+    )
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(asctime)s::%(levelname)s::%(name)s::%(message)s',
+    )
+    drain(args.cache_dir or cache.get_cache_dir())
+
+
+if __name__ == '__main__':
+    main()
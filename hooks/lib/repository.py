@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Repository access
+==================
+
+Shared access to the git repositories, so all the hooks of an event (and,
+when they run in the dispatcher, of all the events) use the same dulwich
+repository object for each GIT_DIR:
+
+* The pack indexes are loaded only once
+* The objects read are kept in a bounded LRU cache, they never change
+* The refs are read only when they change, see
+  :meth:`SharedRepo.get_refs_snapshot`
+
+API
+====
+"""
+import os
+import threading
+from collections import OrderedDict
+from dulwich.object_store import DiskObjectStore
+from dulwich.refs import DiskRefsContainer
+from dulwich.repo import Repo, OBJECTDIR
+
+
+# Max number of objects to keep in memory per repository
+DEFAULT_MAX_OBJECTS = 2000
+# real path -> repository, see get_repo
+REPOS = {}
+REPOS_LOCK = threading.Lock()
+
+
+def get_repo(git_dir=None):
+    """
+    Get the shared repository object for the given path
+
+    :param git_dir: path to the git repository, GIT_DIR env var by default
+    :returns: :class:`SharedRepo`
+    """
+    path = os.path.realpath(git_dir or os.environ['GIT_DIR'])
+    with REPOS_LOCK:
+        if path not in REPOS:
+            REPOS[path] = SharedRepo(path)
+        return REPOS[path]
+
+
+class CachedObjectStore(DiskObjectStore):
+    """
+    Object store that keeps the last objects read in memory
+    """
+    def __init__(self, path, max_objects=DEFAULT_MAX_OBJECTS):
+        """
+        :param path: path to the objects directory
+        :param max_objects: max number of objects to keep
+        """
+        super(CachedObjectStore, self).__init__(path)
+        self.max_objects = max_objects
+        self.objects = OrderedDict()
+        # the pack files (and the list of packs) are not safe to use from
+        # many threads, all the object reads go through this lock
+        self.lock = threading.RLock()
+
+    def get_raw(self, name):
+        with self.lock:
+            return super(CachedObjectStore, self).get_raw(name)
+
+    def __contains__(self, sha):
+        with self.lock:
+            return super(CachedObjectStore, self).__contains__(sha)
+
+    def __getitem__(self, sha):
+        with self.lock:
+            obj = self.objects.pop(sha, None)
+            if obj is None:
+                obj = super(CachedObjectStore, self).__getitem__(sha)
+                if len(self.objects) >= self.max_objects:
+                    self.objects.popitem(last=False)
+            self.objects[sha] = obj
+            return obj
+
+
+class SharedRepo(Repo):
+    """
+    Repository with an object cache and memoized refs, to be shared, see
+    get_repo
+    """
+    def __init__(self, root, max_objects=DEFAULT_MAX_OBJECTS):
+        """
+        :param root: path to the git repository
+        :param max_objects: max number of objects to keep in memory
+        """
+        super(SharedRepo, self).__init__(root)
+        self.object_store = CachedObjectStore(
+            os.path.join(self.commondir(), OBJECTDIR),
+            max_objects=max_objects,
+        )
+        # prefix -> (loose refs dirs, refs state, refs)
+        self.snapshots = {}
+        self.refs_lock = threading.Lock()
+
+    def get_refs_dirs(self, prefix):
+        """
+        Get the dirs with the loose refs under the given prefix, the prefix
+        dir itself included even if it does not exist yet
+        """
+        prefix_dir = os.path.join(self.commondir(), prefix.rstrip('/'))
+        dirs = [dirpath for dirpath, _, _ in os.walk(prefix_dir)]
+        return dirs or [prefix_dir]
+
+    def get_refs_state(self, dirs):
+        """
+        Get a value that changes when the refs in the given dirs are created,
+        deleted or updated, without reading them: the mtimes of packed-refs
+        and of the dirs (git replaces the loose refs files, so their dir is
+        always modified, and creating or removing a dir modifies its parent)
+
+        :param dirs: list of the loose refs dirs, see get_refs_dirs
+        """
+        state = []
+        packed_refs = os.path.join(self.commondir(), 'packed-refs')
+        for path in [packed_refs] + list(dirs):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                state.append((path, None, None))
+                continue
+            state.append((path, stat.st_ino, stat.st_mtime))
+        return tuple(state)
+
+    def get_refs_snapshot(self, prefix='refs/'):
+        """
+        Get the refs under the given prefix, reading them only if they
+        changed since the last time
+
+        The same dict is returned while the refs don't change, so it can be
+        used as a cache key, and it must not be modified.
+
+        :param prefix: prefix of the refs to get, like 'refs/heads/'
+        :returns dict: full ref name -> sha
+        """
+        with self.refs_lock:
+            cached = self.snapshots.get(prefix)
+        # only the dirs read the last time are checked, a new dir under them
+        # modifies its parent
+        if cached is not None and self.get_refs_state(cached[0]) == cached[1]:
+            return cached[2]
+        with self.refs_lock:
+            dirs = self.get_refs_dirs(prefix)
+            # before reading, so the changes done while reading are seen
+            # the next time
+            state = self.get_refs_state(dirs)
+            # dulwich reads the packed refs only once, use a new container
+            # to see the changes, and replace the old one only when it's
+            # been read
+            refs_container = DiskRefsContainer(
+                self.commondir(), self.controldir(),
+                logger=self._write_reflog,
+            )
+            base = prefix.rstrip('/')
+            refs = dict(
+                (base + '/' + name, sha)
+                for name, sha in refs_container.as_dict(base).items()
+            )
+            self.refs = refs_container
+            self.snapshots[prefix] = (dirs, state, refs)
+            return refs
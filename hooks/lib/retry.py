@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+Retry policy
+=============
+
+Retries and hedging for the calls to the remote services (bugzilla,
+gerrit...):
+
+* The failed calls are retried with exponential backoff and full jitter, a
+  random delay between 0 and `base_delay * 2^attempt`, up to `max_delay`
+* The rate limit responses of the server (429 and 503) are respected,
+  waiting at least what their Retry-After header asks for, and not hedging
+  anything while throttled
+* The reads that take longer than the given percentile of the latencies seen
+  for the same operation are hedged: a second identical request is sent, and
+  the first answer wins
+* The writes are never hedged, and only retried if the server surely did not
+  process them (rejected, rate limited...)
+* All the retries and hedges of an event share a budget, so an outage can't
+  multiply the load on the server
+
+API
+====
+"""
+import time
+import Queue
+import random
+import bisect
+import logging
+import threading
+import email.utils
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETRIES = 2
+DEFAULT_BUDGET = 10
+DEFAULT_HEDGE_PERCENTILE = 95
+BASE_DELAY = 0.5
+MAX_DELAY = 10
+# Upper bounds of the latency histogram buckets in seconds, from 10ms to
+# ~4min growing by sqrt(2)
+BUCKETS = tuple(0.01 * 2 ** (i / 2.0) for i in range(30))
+# Latencies to see before hedging, the percentiles are meaningless before
+MIN_SAMPLES = 20
+# The counts are halved when reaching this, so the old latencies weigh less
+MAX_SAMPLES = 1000
+# Http codes of the rate limit responses
+RATE_LIMIT_CODES = (429, 503)
+# operation name -> latency histogram, see get_histogram
+HISTOGRAMS = {}
+HISTOGRAMS_LOCK = threading.Lock()
+
+
+def get_policy(conf, name):
+    """
+    Get a retry policy from the configuration
+
+    HOOKS_RETRIES sets the max retries of each call (0 disables them),
+    HOOKS_RETRY_BUDGET the max retries and hedges per event, and
+    HOOKS_HEDGE_PERCENTILE the latency percentile after which the reads are
+    hedged (0 disables hedging).
+
+    :param conf: configuration dict
+    :param name: name of the service, the latencies are kept per service and
+        operation
+    """
+    def get_int(key, default):
+        value = conf.get(key)
+        return default if value in (None, '') else int(value)
+
+    return RetryPolicy(
+        name=name,
+        retries=get_int('HOOKS_RETRIES', DEFAULT_RETRIES),
+        budget=get_int('HOOKS_RETRY_BUDGET', DEFAULT_BUDGET),
+        hedge_percentile=get_int(
+            'HOOKS_HEDGE_PERCENTILE', DEFAULT_HEDGE_PERCENTILE
+        ),
+    )
+
+
+def get_histogram(name):
+    """
+    Get the latency histogram for the given operation, shared by the whole
+    process
+
+    :param name: name of the operation, like 'bugzilla:Bug.get'
+    """
+    with HISTOGRAMS_LOCK:
+        if name not in HISTOGRAMS:
+            HISTOGRAMS[name] = LatencyHistogram()
+        return HISTOGRAMS[name]
+
+
+def get_retry_after(exc):
+    """
+    Get how long the server asked to wait, if the error is a rate limit
+    response
+
+    :param exc: exception, with the http code in `errcode` and the response
+        headers in `headers`, as in xmlrpclib.ProtocolError
+    :returns: seconds to wait, or None if it's not a rate limit response
+    """
+    if getattr(exc, 'errcode', None) not in RATE_LIMIT_CODES:
+        return None
+    headers = getattr(exc, 'headers', None) or {}
+    value = headers.get('Retry-After')
+    if not value:
+        return 0
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return 0
+    return max(email.utils.mktime_tz(date) - time.time(), 0)
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of latencies with exponential buckets, the old samples decay
+    so the percentiles follow the changes of the server
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        """
+        :param latency: seconds the call took
+        """
+        with self.lock:
+            self.counts[bisect.bisect_left(BUCKETS, latency)] += 1
+            self.total += 1
+            if self.total >= MAX_SAMPLES:
+                self.counts = [count // 2 for count in self.counts]
+                self.total = sum(self.counts)
+
+    def percentile(self, pct):
+        """
+        :param pct: percentile, from 0 to 100
+        :returns: upper bound of the bucket with the given percentile, or
+            None if there are not enough samples yet
+        """
+        with self.lock:
+            if self.total < MIN_SAMPLES:
+                return None
+            wanted = self.total * pct / 100.0
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if seen >= wanted:
+                    break
+        if index >= len(BUCKETS):
+            # slower than the last bucket, hedging won't help
+            return None
+        return BUCKETS[index]
+
+
+class RetryBudget(object):
+    """
+    Number of retries and hedges left, shared by all the calls of an event
+    """
+    def __init__(self, size):
+        self.left = size
+        self.lock = threading.Lock()
+
+    def spend(self):
+        """
+        :returns bool: True if there was budget left, and takes one from it
+        """
+        with self.lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+
+class WorkerPool(object):
+    """
+    Threads to run the hedged reads (and other concurrent calls) in, kept
+    alive between calls, so the per thread keep-alive connections can be
+    reused
+    """
+    def __init__(self):
+        self.tasks = Queue.Queue()
+        self.idle = 0
+        self.lock = threading.Lock()
+
+    def submit(self, func):
+        with self.lock:
+            if self.idle:
+                self.idle -= 1
+            else:
+                worker = threading.Thread(target=self.work)
+                worker.daemon = True
+                worker.start()
+        self.tasks.put(func)
+
+    def work(self):
+        while True:
+            self.tasks.get()()
+            with self.lock:
+                self.idle += 1
+
+
+class RetryPolicy(object):
+    """
+    Retry and hedging policy for the calls to a service
+
+    The service tells which errors are worth a retry with the `transient`
+    (for reads) and `rejected` (for writes) functions, the rate limit
+    responses are always retried.
+    """
+    def __init__(self, name, retries=DEFAULT_RETRIES, budget=DEFAULT_BUDGET,
+                 hedge_percentile=DEFAULT_HEDGE_PERCENTILE,
+                 base_delay=BASE_DELAY, max_delay=MAX_DELAY, transient=None,
+                 rejected=None):
+        """
+        :param name: name of the service
+        :param retries: max retries of each call
+        :param budget: max retries and hedges per event, see reset_budget
+        :param hedge_percentile: latency percentile after which the reads
+            are hedged, 0 to never hedge
+        :param base_delay: seconds to wait before the first retry, doubled
+            for each of the next ones (before the jitter)
+        :param max_delay: max seconds to wait before a retry, if the server
+            asks to wait longer the call fails right away
+        :param transient: function that gets an exception raised by a read
+            and returns True if it's worth retrying it
+        :param rejected: function that gets an exception raised by a write
+            and returns True if the server surely did not process it
+        """
+        self.name = name
+        self.retries = retries
+        self.budget_size = budget
+        self.budget = RetryBudget(budget)
+        self.hedge_percentile = hedge_percentile
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.transient = transient
+        self.rejected = rejected
+        self.throttled_until = 0
+        self.pool = WorkerPool()
+
+    def reset_budget(self):
+        """
+        Start a new budget, to call when a new event is handled
+        """
+        self.budget = RetryBudget(self.budget_size)
+
+    def read(self, operation, func, *args):
+        """
+        Call an idempotent func, retrying and hedging it if needed
+
+        :param operation: name of the operation, for the latency histogram
+        :param func: function to call
+        :param args: arguments for the function
+        :returns: what the function returns
+        """
+        return self.call(operation, func, args, read=True)
+
+    def write(self, operation, func, *args):
+        """
+        Call a non idempotent func, retrying it only if it was rejected
+
+        :param operation: name of the operation, for the latency histogram
+        :param func: function to call
+        :param args: arguments for the function
+        :returns: what the function returns
+        """
+        return self.call(operation, func, args, read=False)
+
+    def call(self, operation, func, args, read):
+        histogram = get_histogram('%s:%s' % (self.name, operation))
+        attempt = 0
+        while True:
+            try:
+                if read:
+                    return self.hedged(histogram, func, args)
+                return self.timed(histogram, func, args)
+            except Exception as exc:
+                delay = self.get_delay(exc, attempt, read)
+                if delay is None:
+                    raise
+                logger.info(
+                    '%s %s failed (%s), retrying in %.1fs'
+                    % (self.name, operation, exc, delay)
+                )
+                time.sleep(delay)
+                attempt += 1
+
+    def get_delay(self, exc, attempt, read):
+        """
+        Get the seconds to wait before retrying after the given error
+
+        :returns: the seconds, or None if it should not be retried
+        """
+        retry_after = get_retry_after(exc)
+        if retry_after is not None:
+            self.throttled_until = time.time() + retry_after
+            retriable = True
+        elif read:
+            retriable = self.transient is not None and self.transient(exc)
+        else:
+            retriable = self.rejected is not None and self.rejected(exc)
+        if not retriable or attempt >= self.retries:
+            return None
+        if retry_after is not None and retry_after > self.max_delay:
+            logger.warning(
+                '%s asked to wait %ds, not retrying' % (self.name, retry_after)
+            )
+            return None
+        if not self.budget.spend():
+            logger.warning('%s retry budget exhausted' % self.name)
+            return None
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt)
+        )
+        return max(delay, retry_after or 0)
+
+    @staticmethod
+    def timed(histogram, func, args):
+        start = time.time()
+        res = func(*args)
+        histogram.record(time.time() - start)
+        return res
+
+    def hedged(self, histogram, func, args):
+        """
+        Call func, and if it takes longer than the hedge percentile, call it
+        again in parallel, returning the first answer
+        """
+        delay = None
+        if self.hedge_percentile > 0 and time.time() >= self.throttled_until:
+            delay = histogram.percentile(self.hedge_percentile)
+        if delay is None:
+            return self.timed(histogram, func, args)
+
+        results = Queue.Queue()
+
+        def run():
+            try:
+                results.put((True, self.timed(histogram, func, args)))
+            except Exception as exc:
+                results.put((False, exc))
+
+        self.pool.submit(run)
+        pending = 1
+        try:
+            success, value = results.get(timeout=delay)
+        except Queue.Empty:
+            if self.budget.spend():
+                logger.debug('%s call slower than %.2fs, hedging'
+                             % (self.name, delay))
+                self.pool.submit(run)
+                pending += 1
+            success, value = results.get()
+            pending -= 1
+            if not success and pending:
+                # the other one might still succeed
+                success, value = results.get()
+        if success:
+            return value
+        raise value
@@ -1,16 +1,63 @@
 #!/usr/bin/env python
 import argparse
+import bisect
 import os
 import re
 import sys
 
-from dulwich.repo import Repo
+from change_index import get_change_index, IndexBusy
+from repository import get_repo
+
+
+# Branches with a X.Y.Z version, not taken into account as newer branches
+IGNORE_BRANCH_RE = re.compile(r'[^.]*-\d+\.\d+\..*')
+VERSION_RE = re.compile(r'\d+(?:\.\d+)+')
+# Sorts after any version number, for master
+LATEST = float('inf')
+# repo path -> (refs snapshot, branch lattice), see get_branch_lattice
+BRANCH_LATTICES = {}
 
 
 class NotComparableVersions(Exception):
     pass
 
 
+def get_version_key(branch):
+    """
+    Get the sort key of a branch (or version) name, a newer branch has a
+    greater key, according to:
+
+    master > (X+1).Y > X.(Y+1) > X.Y > X.Y.Z
+
+    :param branch: branch name, like ovirt-engine-4.2 or 4.2.1
+    :raises NotComparableVersions: if it has no version
+    """
+    if branch == 'master':
+        return (LATEST,)
+    # strip the non-numbered part
+    version = branch.rsplit('-', 1)[-1]
+    try:
+        # the shorter version is the newer one, X.Y > X.Y.Z
+        return tuple(int(part) for part in version.split('.')) + (LATEST,)
+    except ValueError:
+        raise NotComparableVersions(
+            "Unable to parse version string (%s)" % branch
+        )
+
+
+def parse_version(string):
+    """
+    Get the first X.Y[.Z...] version in a string
+
+    :param string: string with a version, like ovirt-4.2.3 or ovirt-engine-4.2
+    :returns tuple: tuple with the version numbers, or None if there's none
+    """
+    match = VERSION_RE.search(string or '')
+    if match is None:
+        return None
+    return tuple(int(part) for part in match.group().split('.'))
+
+
 def get_parser_pc(description=None):
     """
     Build the parser for patchset-created hook type
@@ -55,89 +102,196 @@ def get_parser_comment_added(description=None):
     return parser
 
 
+def ver_cmp(version1, version2):
+    """
+    Compare two X.Y(.Z) versions number by number, unlike the branches (see
+    get_version_key) the longer version is the greater, X.Y.Z > X.Y
+
+    :returns int: 0 if they are the same, 1 if version1 is greater and 2 if
+        it is lower, as the tools.ver_cmp bash function
+    :raises NotComparableVersions: if any of them is not a version
+    """
+    try:
+        key1 = tuple(int(part) for part in version1.split('.'))
+        key2 = tuple(int(part) for part in version2.split('.'))
+    except ValueError:
+        raise NotComparableVersions(
+            "Unable to parse version strings (%s, %s)" % (version1, version2)
+        )
+    return 0 if key1 == key2 else 1 if key1 > key2 else 2
+
+
 def ver_is_newer(branch1, branch2):
     """
     Returns true if branch1 isnewer than branch2, according to:
 
     (X+1).Y > X.(Y+1) > X.Y > X.Y.Z
     """
-    try:
-        # Special case for master
-        if branch1 == 'master' and branch2 != 'master':
-            return True
-        elif branch2 == 'master' and branch1 != 'master':
-            return False
-        elif branch1 == branch2:
-            return False
-        # strip the non-numbered part
-        if '-' in branch1:
-            branch1 = branch1.rsplit('-', 1)[1]
-        if '-' in branch2:
-            branch2 = branch2.rsplit('-', 1)[1]
-        # get the first digit of the version string
-        if '.' in branch1:
-            b1_maj, b1_rest = branch1.split('.', 1)
-        else:
-            b1_maj = branch1
-            b1_rest = None
-        if '.' in branch2:
-            b2_maj, b2_rest = branch2.split('.', 1)
-        else:
-            b2_maj = branch2
-            b2_rest = None
-        # make sure we have integers as majors
-        b1_maj = int(b1_maj)
-        b2_maj = int(b2_maj)
-        # Check which one is newer
-        if b1_maj > b2_maj:
-            return True
-        elif b2_maj > b1_maj:
-            return False
-        else:
-            # in case the majors match, strip them and check again
-            if b1_rest and b2_rest:
-                return ver_is_newer(b1_rest, b2_rest)
-            # if b1=X and b2=X.Y, b1 is newer
-            elif b2_rest:
-                return True
-            # if b1=X.Y and b2=X, b1 is newer
-            elif b1_rest:
-                return False
-    except (IndexError, ValueError):
-        raise NotComparableVersions(
-            "Unable to parse version strings (%s, %s)"
-            % (branch1, branch2))
+    return get_version_key(branch1) > get_version_key(branch2)
 
 
-def branch_has_change(branch, change, repo_path):
-    repo = Repo(repo_path)
+def branch_has_change(branch, change, repo_path, conf=None):
+    """
+    Check if the given branch has a commit with the given Change-Id, using
+    the persistent change index (see :mod:`change_index`), or walking the
+    branch if another process is taking too long to update the index
+
+    :param branch: branch name, with or without the refs/heads/ prefix
+    :param change: Change-Id to look for
+    :param repo_path: path to the git repository
+    :param conf: configuration dict, to get the index dir from
+    """
+    try:
+        return get_change_index(repo_path, conf).has_change(branch, change)
+    except IndexBusy:
+        pass
     if not branch.startswith('refs/heads/'):
         branch = 'refs/heads/' + branch
-    branch = repo.refs[branch]
+    repo = get_repo(repo_path)
     msg = '\nChange-Id: ' + change
-    matches = (
-        True for parent in repo.get_walker(include=[branch])
-        if msg in parent.commit.message
+    return any(
+        msg in entry.commit.message
+        for entry in repo.get_walker(include=[repo.refs[branch]])
     )
-    is_in = next(matches, False)
-    return is_in
 
 
 def get_branches(repo_path):
-    repo = Repo(repo_path)
-    return [ref[11:] for ref in repo.get_refs()
-            if ref.startswith('refs/heads/')]
+    return get_branch_lattice(repo_path).branches
 
 
 def get_newer_branches(my_branch, repo_path):
-    newer = []
-    ignore_match = re.compile(r'[^.]*-\d+\.\d+\..*')
-    for branch in get_branches(repo_path):
-        if ignore_match.match(branch):
-            continue
+    return get_branch_lattice(repo_path).get_newer(my_branch)
+
+
+def get_branch_lattice(repo_path):
+    """
+    Get the branch lattice of a repository, it's kept by the process and
+    built again only when the refs change
+
+    :param repo_path: path to the git repository
+    """
+    heads = get_repo(repo_path).get_refs_snapshot('refs/heads/')
+    cached = BRANCH_LATTICES.get(repo_path)
+    # the snapshot is the same object while the refs don't change
+    if cached is not None and cached[0] is heads:
+        return cached[1]
+    lattice = BranchLattice(ref[len('refs/heads/'):] for ref in heads)
+    BRANCH_LATTICES[repo_path] = (heads, lattice)
+    return lattice
+
+
+class BranchLattice(object):
+    """
+    Branches of a repository sorted by version, see get_version_key
+    """
+    def __init__(self, branches):
+        """
+        :param branches: iterable with the branch names
+        """
+        self.branches = list(branches)
+        versioned = []
+        self.by_version = {}
+        for branch in self.branches:
+            try:
+                key = get_version_key(branch)
+            except NotComparableVersions:
+                continue
+            if branch != 'master':
+                self.by_version.setdefault(key[:-1], branch)
+            if not IGNORE_BRANCH_RE.match(branch):
+                versioned.append((key, branch))
+        versioned.sort()
+        self.keys = [key for key, _ in versioned]
+        self.sorted = [branch for _, branch in versioned]
+
+    def get_newer(self, branch):
+        """
+        Get the branches newer than the given one, oldest first, without the
+        X.Y.Z ones
+
+        :param branch: branch name, it does not need to exist
+        :returns list: list of branch names, only master if the branch has
+            no version
+        """
         try:
-            if ver_is_newer(branch, my_branch):
-                newer.append(branch)
+            key = get_version_key(branch)
         except NotComparableVersions:
-            pass
-    return newer
+            return [name for name in self.sorted[-1:] if name == 'master']
+        return self.sorted[bisect.bisect_right(self.keys, key):]
+
+    def get_branch(self, version):
+        """
+        Get the branch with the given version
+
+        :param version: version tuple, see parse_version
+        :returns: the branch name, or None if there's none
+        """
+        if not version:
+            return None
+        return self.by_version.get(tuple(version))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare branch versions, the newer branch is the one '
+        'with greater version, with master being the newest, and X.Y newer '
+        'than X.Y.Z',
+    )
+    parser.add_argument(
+        '--repo', default=os.environ.get('GIT_DIR', '.'),
+        help='Repository to get the branches from, $GIT_DIR by default',
+    )
+    subparsers = parser.add_subparsers(dest='action')
+    cmp_parser = subparsers.add_parser(
+        'cmp',
+        help='Exits with 0 if the branches have the same version, 1 if the '
+        'first is newer and 2 if it is older (3 if not comparable)',
+    )
+    cmp_parser.add_argument('branch1')
+    cmp_parser.add_argument('branch2')
+    vercmp_parser = subparsers.add_parser(
+        'vercmp',
+        help='Exits with 0 if the X.Y(.Z) versions are the same, 1 if the '
+        'first is greater and 2 if it is lower (3 if not comparable)',
+    )
+    vercmp_parser.add_argument('version1')
+    vercmp_parser.add_argument('version2')
+    newer_parser = subparsers.add_parser(
+        'newer', help='Print the branches newer than the given one',
+    )
+    newer_parser.add_argument('branch')
+    branch_parser = subparsers.add_parser(
+        'branch', help='Print the branch with the version in the given '
+        'string (like a milestone), if any',
+    )
+    branch_parser.add_argument('string')
+    args = parser.parse_args()
+
+    if args.action == 'cmp':
+        try:
+            key1 = get_version_key(args.branch1)
+            key2 = get_version_key(args.branch2)
+        except NotComparableVersions as exc:
+            sys.stderr.write('%s\n' % exc)
+            return 3
+        return 0 if key1 == key2 else 1 if key1 > key2 else 2
+    if args.action == 'vercmp':
+        try:
+            return ver_cmp(args.version1, args.version2)
+        except NotComparableVersions as exc:
+            sys.stderr.write('%s\n' % exc)
+            return 3
+    lattice = get_branch_lattice(args.repo)
+    if args.action == 'newer':
+        for branch in lattice.get_newer(args.branch):
+            sys.stdout.write('%s\n' % branch)
+        return 0
+    branch = lattice.get_branch(parse_version(args.string))
+    if branch is None:
+        return 1
+    sys.stdout.write('%s\n' % branch)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
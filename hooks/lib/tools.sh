@@ -159,25 +159,38 @@ tools.match(){
 ## @retval TOOLS_VERCMP_EQUAL if the versions are the same
 ## @retval TOOLS_VERCMP_GT if version1 > version2
 ## @retval TOOLS_VERCMP_LT if version1 < version2
+## @retval 3 if any of them is not a version
 tools.ver_cmp(){
-    declare version1="${1?}"
-    declare version2="${2?}"
-    version1=(${version1//\./ })
-    version2=(${version2//\./ })
-
-    for ((i=0; i<"${#version1[@]}"; i++)); do
-        if [[ "${version1[$i]}" -gt "${version2[$i]}" ]]; then
-            return $TOOLS_VERCMP_GT
-        elif [[ "${version1[$i]}" -lt "${version2[$i]}" ]]; then
-            return $TOOLS_VERCMP_LT
-        fi
-    done
+    tools.py vercmp "${1?}" "${2?}"
+}
+
+
+######
+## @fn tools.branch_cmp()
+## @param branch1 Name of the first branch to compare
+## @param branch2 Name of the second branch to compare
+## @brief Compare two branches by their version (see tools.py), unlike
+## tools.ver_cmp, master is the newest and X.Y is newer than X.Y.Z
+##
+## Example:
+##
+##   tools.branch_cmp ovirt-engine-4.2.1  ovirt-engine-4.2
+##
+## @endcode
+## @retval TOOLS_VERCMP_EQUAL if the versions are the same
+## @retval TOOLS_VERCMP_GT if branch1 is newer than branch2
+## @retval TOOLS_VERCMP_LT if branch1 is older than branch2
+## @retval 3 if the branches have no version
+tools.branch_cmp(){
+    tools.py cmp "${1?}" "${2?}"
+}
 
-    if [[ "${#version1[@]}" -gt "${#version2[@]}" ]]; then
-        return $TOOLS_VERCMP_GT
-    elif [[ "${#version1[@]}" -lt "${#version2[@]}" ]]; then
-        return $TOOLS_VERCMP_LT
-    fi
 
-    return $TOOLS_VERCMP_EQUAL
+######
+## @fn tools.newer_branches()
+## @param branch Name of the branch to get the newer ones of
+## @brief Print the branches of the repository in GIT_DIR that are newer than
+## the given one, oldest first (without the X.Y.Z ones)
+tools.newer_branches(){
+    tools.py newer "${1?}"
 }
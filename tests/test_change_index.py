@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'hooks', 'lib'),
+)
+
+import change_index  # noqa: E402
+
+
+class ChangeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.repo_path = os.path.join(self.tmp_dir, 'repo')
+        os.mkdir(self.repo_path)
+        self.git('init', '-q')
+        self.master = self.commit('I1')
+        self.commit('I2')
+        self.git('branch', 'stable', self.master)
+        self.index = change_index.ChangeIndex(
+            path=os.path.join(self.tmp_dir, 'index.db'),
+            repo_path=os.path.join(self.repo_path, '.git'),
+        )
+        self.index.update()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def git(self, *args):
+        env = dict(
+            os.environ,
+            GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+            GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com',
+        )
+        return subprocess.check_output(
+            ('git', '-C', self.repo_path) + args, env=env,
+        ).strip()
+
+    def commit(self, change_id):
+        self.git(
+            'commit', '-q', '--allow-empty',
+            '-m', 'Change %s\n\nChange-Id: %s' % (change_id, change_id),
+        )
+        return self.git('rev-parse', 'HEAD')
+
+    def test_indexed(self):
+        self.assertEqual(
+            sorted(self.index.get_branches('I1')), ['master', 'stable'],
+        )
+        self.assertEqual(self.index.get_branches('I2').keys(), ['master'])
+        self.assertTrue(self.index.has_change('refs/heads/stable', 'I1'))
+        self.assertFalse(self.index.has_change('stable', 'I2'))
+        self.assertEqual(self.index.get_branches('I3'), {})
+
+    def test_new_commits(self):
+        sha = self.commit('I3')
+        self.index.update()
+        self.assertEqual(self.index.get_branches('I3'), {'master': sha})
+        self.assertTrue(self.index.has_change('master', 'I1'))
+
+    def test_rewritten_branch(self):
+        self.git('reset', '-q', '--hard', self.master)
+        self.commit('I3')
+        self.index.update()
+        self.assertEqual(self.index.get_branches('I2'), {})
+        self.assertEqual(self.index.get_branches('I3').keys(), ['master'])
+        self.assertEqual(
+            sorted(self.index.get_branches('I1')), ['master', 'stable'],
+        )
+
+    def test_deleted_branch(self):
+        self.git('branch', '-D', 'stable')
+        self.index.update()
+        self.assertEqual(self.index.get_branches('I1').keys(), ['master'])
+
+    def add_review(self, number, change_id, branch, status):
+        tree = self.git('hash-object', '-t', 'tree', '-w', '/dev/null')
+        meta = self.git(
+            'commit-tree', tree, '-m',
+            'Update patch set 1\n\nBranch: refs/heads/%s\nStatus: %s\n'
+            'Change-id: %s' % (branch, status, change_id),
+        )
+        self.git(
+            'update-ref', 'refs/changes/%02d/%d/meta' % (number % 100, number),
+            meta,
+        )
+
+    def test_reviews_are_indexed_apart(self):
+        self.add_review(1, 'I4', 'stable', 'new')
+        self.index.update()
+        self.assertFalse(self.index.has_reviews())
+        self.index.update_reviews()
+        self.assertTrue(self.index.has_reviews())
+        self.assertEqual(
+            [(change['number'], change['status'])
+             for change in self.index.get_changes('I4')],
+            [(1, 'NEW')],
+        )
+        self.assertEqual(
+            self.index.get_changes('I4', with_reviews=False), [],
+        )
+
+    def test_old_reviews_are_not_used(self):
+        self.add_review(1, 'I4', 'stable', 'new')
+        self.index.update_reviews()
+        self.index.conn.execute(
+            'UPDATE reviews_updates SET updated_at = updated_at - 600',
+        )
+        self.assertFalse(self.index.has_reviews(max_age=300))
+        self.assertTrue(self.index.has_reviews())
+
+    def test_busy(self):
+        self.commit('I3')
+        with self.index.lock('branches'):
+            other = change_index.ChangeIndex(
+                path=self.index.path, repo_path=self.index.repo_path,
+            )
+            self.assertRaises(
+                change_index.IndexBusy, other.update, timeout=0.2,
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'hooks', 'lib'),
+)
+
+import footers  # noqa: E402
+
+
+BZ_SERVER = 'https://bugzilla.redhat.com'
+MESSAGE = '''Fix something
+
+Bug-Url: https://bugzilla.redhat.com/1 in the body does not count
+Related-To: https://bugzilla.redhat.com/2
+
+Change-Id: I0123456789abcdef
+Bug-Url: https://bugzilla.redhat.com/show_bug.cgi?id=3
+Bug-Url: http://bugzilla.redhat.com/4\r
+bug-url: https://other.bugzilla.org/5
+Ignore-Hooks: check_a, check_b
+Ignore-Hooks: check_c
+'''
+
+
+class FootersTest(unittest.TestCase):
+    def setUp(self):
+        self.footers = footers.Footers(MESSAGE)
+
+    def test_bug_urls_only_from_the_last_paragraph(self):
+        self.assertEqual(self.footers.bug_urls, [
+            'https://bugzilla.redhat.com/show_bug.cgi?id=3',
+            'http://bugzilla.redhat.com/4',
+            'https://other.bugzilla.org/5',
+        ])
+
+    def test_other_footers_from_anywhere(self):
+        self.assertEqual(
+            self.footers.related_to, ['https://bugzilla.redhat.com/2'],
+        )
+        self.assertEqual(self.footers.change_ids, ['I0123456789abcdef'])
+
+    def test_last_single_footer_wins(self):
+        self.assertEqual(self.footers.ignore_hooks, 'check_c')
+        self.assertIsNone(self.footers.run_only_hooks)
+
+    def test_get(self):
+        self.assertEqual(self.footers.get('CHANGE-ID'), ['I0123456789abcdef'])
+        self.assertEqual(self.footers.get('Ignore-Hooks'), ['check_c'])
+        self.assertEqual(self.footers.get('Run-Only-Hooks'), [])
+        with self.assertRaises(ValueError):
+            self.footers.get('Signed-off-by')
+
+    def test_bug_ids_of_a_server(self):
+        self.assertEqual(self.footers.get_bug_ids(BZ_SERVER), set(['3', '4']))
+
+    def test_bug_url_in_the_next_line(self):
+        commit_footers = footers.Footers(
+            'Fix something\n\nBug-Url:\n    https://bugzilla.redhat.com/6\n'
+            'Change-Id: I1\n'
+        )
+        self.assertEqual(commit_footers.get_bug_ids(BZ_SERVER), set(['6']))
+        self.assertEqual(commit_footers.change_ids, ['I1'])
+
+    def test_empty_bug_url_does_not_take_the_next_footer(self):
+        commit_footers = footers.Footers(
+            'Fix something\n\nBug-Url:\nChange-Id: I1\n'
+        )
+        self.assertEqual(commit_footers.bug_urls, [''])
+        self.assertEqual(commit_footers.change_ids, ['I1'])
+
+    def test_parsed_once_per_commit(self):
+        first = footers.get_footers(MESSAGE, sha='a' * 40)
+        self.assertIs(footers.get_footers('other', sha='a' * 40), first)
+
+
+if __name__ == '__main__':
+    unittest.main()
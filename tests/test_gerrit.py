@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import os
+import sys
+import stat
+import fcntl
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'hooks', 'lib'),
+)
+
+import cache  # noqa: E402
+import gerrit  # noqa: E402
+
+
+# prints one row and the stats, and exits a bit after closing stdout
+FAKE_SSH = '''#!/bin/bash
+echo '{"number": 1}'
+echo '{"type": "stats", "rowCount": 1}'
+exec >&-
+sleep 0.3
+exit 0
+'''
+
+# ssh of an unreachable server
+UNREACHABLE_SSH = '''#!/bin/bash
+exit 255
+'''
+
+
+class FakeBreaker(object):
+    probe = None
+
+    def __init__(self):
+        self.failures = 0
+
+    def before_call(self):
+        pass
+
+    def record_failure(self):
+        self.failures += 1
+
+
+class IterQueryPageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        fake_ssh = os.path.join(self.tmp_dir, 'ssh')
+        with open(fake_ssh, 'w') as ssh_fd:
+            ssh_fd.write(FAKE_SSH)
+        os.chmod(fake_ssh, stat.S_IRWXU)
+        self.gerrit = gerrit.Gerrit('user@server', multiplex=False)
+        self.gerrit.cmd = self.gerrit.plain_cmd = (fake_ssh,)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_waits_for_ssh_after_the_end(self):
+        stats = {}
+        rows = list(self.gerrit.iter_query_page('status:open', 0, stats))
+        self.assertEqual(rows, [{'number': 1}])
+        self.assertEqual(stats['rowCount'], 1)
+
+    def test_kills_ssh_when_closed_early(self):
+        page = self.gerrit.iter_query_page('status:open', 0, {})
+        self.assertEqual(next(page), {'number': 1})
+        # killed, but not reported as a failure
+        page.close()
+
+
+class MasterTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        fake_ssh = os.path.join(self.tmp_dir, 'ssh')
+        with open(fake_ssh, 'w') as ssh_fd:
+            ssh_fd.write(UNREACHABLE_SSH)
+        os.chmod(fake_ssh, stat.S_IRWXU)
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = self.tmp_dir + ':' + self.old_path
+        self.breaker = FakeBreaker()
+        self.gerrit = gerrit.Gerrit(
+            'user@server', control_dir=self.tmp_dir, breaker=self.breaker,
+        )
+
+    def tearDown(self):
+        os.environ['PATH'] = self.old_path
+        shutil.rmtree(self.tmp_dir)
+
+    def test_falls_back_to_plain_ssh(self):
+        cmd = self.gerrit.generate_cmd('version')
+        self.assertEqual(cmd, list(self.gerrit.plain_cmd) + ['version'])
+        self.assertEqual(self.breaker.failures, 1)
+        # not tried again until the next check
+        self.gerrit.generate_cmd('version')
+        self.assertEqual(self.breaker.failures, 1)
+
+    def test_does_not_wait_forever_for_the_lock(self):
+        gerrit.MASTER_TIMEOUT, old_timeout = 0.2, gerrit.MASTER_TIMEOUT
+        try:
+            with open(self.gerrit.control_path + '.lock', 'a') as lock_fd:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                self.assertFalse(self.gerrit.ensure_master())
+        finally:
+            gerrit.MASTER_TIMEOUT = old_timeout
+        self.assertEqual(self.breaker.failures, 0)
+
+
+class InvalidateCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gerrit = gerrit.Gerrit(
+            'user@server',
+            multiplex=False,
+            cache=cache.DiskCache(os.path.join(self.tmp_dir, 'cache.db')),
+        )
+        self.rows = [{
+            'number': 42,
+            'id': 'I0123',
+            'currentPatchSet': {'revision': 'abcdef'},
+        }]
+        self.gerrit.cache.set(
+            'key', self.rows,
+            tags=self.gerrit.get_cache_tags('change:I0123', self.rows),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_change_and_patchset(self):
+        self.gerrit.invalidate_cache('I0123,2')
+        self.assertIs(self.gerrit.cache.get('key'), cache.MISSING)
+
+    def test_change_triplet_and_patchset(self):
+        self.gerrit.invalidate_cache('project~master~I0123,2')
+        self.assertIs(self.gerrit.cache.get('key'), cache.MISSING)
+
+    def test_commit(self):
+        self.gerrit.invalidate_cache('abcdef')
+        self.assertIs(self.gerrit.cache.get('key'), cache.MISSING)
+
+    def test_other_change(self):
+        self.gerrit.invalidate_cache('I4567,2')
+        self.assertEqual(self.gerrit.cache.get('key'), self.rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+import os
+import sys
+import fcntl
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'hooks', 'lib'),
+)
+
+import outbox  # noqa: E402
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.outbox = outbox.Outbox(os.path.join(self.tmp_dir, 'outbox.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def batch(self):
+        return self.outbox.batch('commit', 'project', 'header', '/git_dir')
+
+    def add(self, batch):
+        """
+        Add the writes of the batch to the outbox, without starting a drainer
+        """
+        self.outbox.add(batch.writes)
+
+    def test_newer_write_replaces_the_pending_one(self):
+        batch = self.batch()
+        batch.update_bug(1, status='POST')
+        self.add(batch)
+        batch = self.batch()
+        batch.update_bug(1, status='MODIFIED')
+        batch.update_bug(2, status='POST')
+        self.add(batch)
+        writes = self.outbox.get_due()
+        self.assertEqual(
+            sorted((write['bug_id'], write['params']) for write in writes),
+            [('1', {'status': 'MODIFIED'}), ('2', {'status': 'POST'})],
+        )
+
+    def test_trackers_of_the_same_bug_are_kept(self):
+        batch = self.batch()
+        for external_bug_id in ('1', '1', '2'):
+            batch.update_external(1, external_bug_id, 81)
+        batch.update_bug(1, status='POST')
+        self.add(batch)
+        self.assertEqual(len(self.outbox.get_due()), 3)
+
+    def test_superseded_write_is_not_removed(self):
+        batch = self.batch()
+        batch.update_bug(1, status='POST')
+        self.add(batch)
+        sent = self.outbox.get_due()[0]
+        batch = self.batch()
+        batch.update_bug(1, status='MODIFIED')
+        self.add(batch)
+        self.outbox.done(sent)
+        self.assertEqual(
+            [write['params'] for write in self.outbox.get_due()],
+            [{'status': 'MODIFIED'}],
+        )
+
+    def test_split_by_bug(self):
+        batch = self.batch()
+        batch.update_bug(1, status='POST')
+        batch.update_bug(2, status='POST')
+        batch.update_external(1, '1', 81)
+        groups = outbox.Outbox.split_by_bug(batch.writes)
+        self.assertEqual(
+            [[write['bug_id'] for write in group] for group in groups],
+            [['1', '2'], ['1']],
+        )
+
+
+class DrainerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_not_draining(self):
+        self.assertFalse(outbox.is_draining(self.tmp_dir))
+
+    def test_no_new_drainer_while_one_is_running(self):
+        lock_path = os.path.join(self.tmp_dir, outbox.OUTBOX_LOCK)
+        with open(lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.assertTrue(outbox.is_draining(self.tmp_dir))
+            outbox.start_drainer(self.tmp_dir)
+        self.assertEqual(outbox.DRAINERS, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'hooks', 'lib'),
+)
+
+import retry  # noqa: E402
+
+
+class Transient(Exception):
+    pass
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after=None):
+        super(RateLimited, self).__init__('Too many requests')
+        self.errcode = 429
+        self.headers = {}
+        if retry_after is not None:
+            self.headers['Retry-After'] = retry_after
+
+
+class LatencyHistogramTest(unittest.TestCase):
+    def test_not_enough_samples(self):
+        histogram = retry.LatencyHistogram()
+        for _ in range(retry.MIN_SAMPLES - 1):
+            histogram.record(0.1)
+        self.assertIsNone(histogram.percentile(95))
+
+    def test_percentile(self):
+        histogram = retry.LatencyHistogram()
+        for _ in range(90):
+            histogram.record(0.05)
+        for _ in range(10):
+            histogram.record(1)
+        fast = histogram.percentile(50)
+        slow = histogram.percentile(95)
+        self.assertTrue(0.05 <= fast < 0.1, fast)
+        self.assertTrue(1 <= slow < 1.5, slow)
+
+    def test_slower_than_the_last_bucket(self):
+        histogram = retry.LatencyHistogram()
+        for _ in range(retry.MIN_SAMPLES):
+            histogram.record(retry.BUCKETS[-1] * 2)
+        self.assertIsNone(histogram.percentile(95))
+
+    def test_old_samples_decay(self):
+        histogram = retry.LatencyHistogram()
+        for _ in range(retry.MAX_SAMPLES):
+            histogram.record(0.05)
+        self.assertEqual(histogram.total, retry.MAX_SAMPLES // 2)
+        self.assertEqual(sum(histogram.counts), histogram.total)
+
+
+class GetDelayTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = retry.RetryPolicy(
+            'test', retries=2, budget=3, base_delay=1, max_delay=10,
+            transient=lambda exc: isinstance(exc, Transient),
+            rejected=lambda exc: False,
+        )
+
+    def test_transient_read(self):
+        for attempt in range(2):
+            delay = self.policy.get_delay(Transient(), attempt, read=True)
+            self.assertTrue(0 <= delay <= 2 ** attempt, delay)
+
+    def test_not_transient(self):
+        self.assertIsNone(self.policy.get_delay(ValueError(), 0, read=True))
+
+    def test_writes_only_if_rejected(self):
+        self.assertIsNone(self.policy.get_delay(Transient(), 0, read=False))
+
+    def test_max_retries(self):
+        self.assertIsNone(self.policy.get_delay(Transient(), 2, read=True))
+
+    def test_budget(self):
+        for _ in range(3):
+            self.assertIsNotNone(
+                self.policy.get_delay(Transient(), 0, read=True))
+        self.assertIsNone(self.policy.get_delay(Transient(), 0, read=True))
+        self.policy.reset_budget()
+        self.assertIsNotNone(self.policy.get_delay(Transient(), 0, read=True))
+
+    def test_rate_limit_waits_what_was_asked(self):
+        delay = self.policy.get_delay(RateLimited('3'), 0, read=False)
+        self.assertGreaterEqual(delay, 3)
+
+    def test_rate_limit_too_long(self):
+        self.assertIsNone(
+            self.policy.get_delay(RateLimited('60'), 0, read=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'hooks', 'lib'),
+)
+
+import tools  # noqa: E402
+
+
+class GetVersionKeyTest(unittest.TestCase):
+    def test_order(self):
+        branches = [
+            'ovirt-engine-4.1.9', 'ovirt-engine-4.1', 'ovirt-engine-4.2.1',
+            'ovirt-engine-4.2', 'ovirt-engine-4.10', 'master',
+        ]
+        self.assertEqual(
+            sorted(reversed(branches), key=tools.get_version_key), branches,
+        )
+
+    def test_prefix_is_ignored(self):
+        self.assertEqual(
+            tools.get_version_key('ovirt-engine-4.2'),
+            tools.get_version_key('4.2'),
+        )
+
+    def test_no_version(self):
+        with self.assertRaises(tools.NotComparableVersions):
+            tools.get_version_key('feature-branch')
+
+
+class VerCmpTest(unittest.TestCase):
+    def test_compare(self):
+        self.assertEqual(tools.ver_cmp('3.3', '3.3'), 0)
+        self.assertEqual(tools.ver_cmp('3.10', '3.9'), 1)
+        self.assertEqual(tools.ver_cmp('3.2.1', '3.3'), 2)
+
+    def test_longer_is_greater(self):
+        self.assertEqual(tools.ver_cmp('3.3.0', '3.3'), 1)
+
+    def test_no_version(self):
+        with self.assertRaises(tools.NotComparableVersions):
+            tools.ver_cmp('master', '3.3')
+
+
+class BranchLatticeTest(unittest.TestCase):
+    def setUp(self):
+        self.lattice = tools.BranchLattice([
+            'master', 'ovirt-engine-4.2', 'ovirt-engine-4.1',
+            'ovirt-engine-4.2.1', 'ovirt-engine-4.3', 'feature-branch',
+        ])
+
+    def test_get_newer(self):
+        self.assertEqual(
+            self.lattice.get_newer('ovirt-engine-4.1'),
+            ['ovirt-engine-4.2', 'ovirt-engine-4.3', 'master'],
+        )
+
+    def test_get_newer_skips_the_xyz_branches(self):
+        self.assertEqual(
+            self.lattice.get_newer('ovirt-engine-4.2.0'),
+            ['ovirt-engine-4.2', 'ovirt-engine-4.3', 'master'],
+        )
+
+    def test_get_newer_of_missing_branch(self):
+        self.assertEqual(
+            self.lattice.get_newer('ovirt-engine-4.2.5'),
+            ['ovirt-engine-4.2', 'ovirt-engine-4.3', 'master'],
+        )
+
+    def test_get_newer_of_the_newest(self):
+        self.assertEqual(self.lattice.get_newer('master'), [])
+
+    def test_get_newer_without_version(self):
+        self.assertEqual(self.lattice.get_newer('feature-branch'), ['master'])
+
+    def test_get_branch(self):
+        self.assertEqual(
+            self.lattice.get_branch(tools.parse_version('ovirt-4.2.1')),
+            'ovirt-engine-4.2.1',
+        )
+        self.assertEqual(self.lattice.get_branch((4, 3)), 'ovirt-engine-4.3')
+        self.assertIsNone(self.lattice.get_branch((5, 0)))
+        self.assertIsNone(self.lattice.get_branch(None))
+
+
+if __name__ == '__main__':
+    unittest.main()